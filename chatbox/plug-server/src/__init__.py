@@ -2,11 +2,12 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 from flask import Flask
 from src.routes import plug_chat, client_chat, auth
 import src.database.mongodb as mongo
+from src.database.mongodb.indexes import check_indexes
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
 from src.database.chromadb import ChromaClient
 from src.constants.http_status_codes import HTTP_401_UNAUTHORIZED
-from src.database.sqlite import SQLiteConnection
+from src.helper import init_token_counting, clear_token_counter
 import nomic
 
 
@@ -22,17 +23,21 @@ def create_app(test_cofig=None):
     # Create Chroma client
     chroma_client = ChromaClient()
 
-    # Create SQLite connection
-    sqlite_connection = SQLiteConnection()
-    # Store the Chroma client in the Flask application context
-    app.config['SQLITE_CONNECTION'] = sqlite_connection
-
     # Store the Chroma client in the Flask application context
     app.config['CHROMA_CLIENT'] = chroma_client
 
     mongo.create_db_connection()
+    if app.config.get("MONGO_INDEX_CHECK"):
+        try:
+            check_indexes()
+        except Exception as e:
+            print("Index check failed", str(e))
     nomic.login(app.config["NOMIC_API_KEY"])
 
+    # Pre-warm the shared tokenizer and embedding client
+    init_token_counting()
+    app.before_request(clear_token_counter)
+
     CORS(app, resources={r"/*": {"origins": ["http://100.24.32.199", "http://localhost:4200",
          "http://127.0.0.1:4200", "https://www.2gai.ai", "http://54.209.193.185:8001", "http://100.25.30.108:8001", "http://localhost:63342", "*"]}}, supports_credentials=True)
     jwt = JWTManager(app)
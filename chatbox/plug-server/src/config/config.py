@@ -82,6 +82,77 @@ NOMIC_API_KEY = os.environ.get("NOMIC_API_KEY")
 
 ROUTE_PARAMETER_ALLOWED = os.environ.get("ROUTE_PARAMETER_ALLOWED")
 
+# CHAT ENGINE CACHE
+CHAT_ENGINE_CACHE_SIZE = int(os.environ.get("CHAT_ENGINE_CACHE_SIZE", 128))
+CHAT_ENGINE_CACHE_TTL = int(os.environ.get(
+    "CHAT_ENGINE_CACHE_TTL", 600))  # default 10 minutes
+
+# PLUG CACHE (plugs of the public widget API by client key)
+PLUG_CACHE_SIZE = int(os.environ.get("PLUG_CACHE_SIZE", 4096))
+# seconds, plugs changed by web-server show after it unless the change stream evicts them sooner
+PLUG_CACHE_TTL = int(os.environ.get("PLUG_CACHE_TTL", 30))
+# seconds unknown client keys are answered from the cache
+PLUG_CACHE_NEGATIVE_TTL = int(os.environ.get("PLUG_CACHE_NEGATIVE_TTL", 5))
+# 1 to evict plugs as they change, on a change stream of the plug collection (needs a replica set)
+PLUG_CACHE_WATCH = int(os.environ.get("PLUG_CACHE_WATCH", 1))
+
+# SQL PLAN CACHE (text-to-SQL queries reused for questions of the same shape)
+SQL_PLAN_CACHE_SIZE = int(os.environ.get(
+    "SQL_PLAN_CACHE_SIZE", 64))  # plans per plug
+SQL_PLAN_CACHE_PLUGS = int(os.environ.get("SQL_PLAN_CACHE_PLUGS", 256))
+SQL_PLAN_CACHE_TTL = int(os.environ.get(
+    "SQL_PLAN_CACHE_TTL", 3600))  # seconds, 0 for none
+
+# RESPONSE CACHE (client chat answers reused for near-duplicate questions), 1 to enable
+RESPONSE_CACHE_ENABLED = int(os.environ.get("RESPONSE_CACHE_ENABLED", 0))
+# cosine similarity of the question embeddings
+RESPONSE_CACHE_SIMILARITY = float(
+    os.environ.get("RESPONSE_CACHE_SIMILARITY", 0.95))
+RESPONSE_CACHE_SIZE = int(os.environ.get(
+    "RESPONSE_CACHE_SIZE", 256))  # answers per plug
+RESPONSE_CACHE_PLUGS = int(os.environ.get("RESPONSE_CACHE_PLUGS", 256))
+RESPONSE_CACHE_TTL = int(os.environ.get(
+    "RESPONSE_CACHE_TTL", 86400))  # seconds, 0 for none
+
+# TOKEN USAGE LEDGER
+TOKEN_USAGE_FLUSH_INTERVAL = int(os.environ.get(
+    "TOKEN_USAGE_FLUSH_INTERVAL", 5))  # seconds
+TOKEN_USAGE_BATCH_SIZE = int(os.environ.get("TOKEN_USAGE_BATCH_SIZE", 100))
+
+# ANALYTICS ROLLUPS
+# daily counters per client, buffered per worker and applied every interval
+ANALYTICS_FLUSH_INTERVAL = int(os.environ.get(
+    "ANALYTICS_FLUSH_INTERVAL", 5))  # seconds
+
+# AUTH CONTEXT CACHE
+# seconds a user's identity and entitlements (user, subscription, plugs) are reused by a worker,
+# its own writes invalidate them sooner
+AUTH_CONTEXT_TTL = int(os.environ.get("AUTH_CONTEXT_TTL", 30))
+AUTH_CONTEXT_CACHE_SIZE = int(
+    os.environ.get("AUTH_CONTEXT_CACHE_SIZE", 1024))
+
+# CONVERSATION SESSIONS (widget chats find their history by a signed session token)
+CONVERSATION_SESSION_CACHE_SIZE = int(
+    os.environ.get("CONVERSATION_SESSION_CACHE_SIZE", 10000))
+# messages of the widget chats are buffered per worker and inserted in batches
+MESSAGE_WRITER_FLUSH_INTERVAL = int(os.environ.get(
+    "MESSAGE_WRITER_FLUSH_INTERVAL", 2))  # seconds
+MESSAGE_WRITER_BATCH_SIZE = int(os.environ.get("MESSAGE_WRITER_BATCH_SIZE", 200))
+
+# RETRIEVAL
+# "hybrid" fuses vector and BM25 hits with reciprocal rank fusion, "vector" is vector only
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "vector")
+# plugs with this feature use hybrid retrieval whatever the mode
+HYBRID_RETRIEVAL = os.environ.get("HYBRID_RETRIEVAL", "hybrid retrieval")
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", 3))
+# hits taken from each retriever before fusion
+RETRIEVAL_CANDIDATE_K = int(os.environ.get("RETRIEVAL_CANDIDATE_K", 10))
+RRF_K = int(os.environ.get("RRF_K", 60))
+
+# MONGO
+# 1 to report missing indexes and the plans of the hot queries at startup
+MONGO_INDEX_CHECK = int(os.environ.get("MONGO_INDEX_CHECK", 1))
+
 # URL PATH
 URL_PATH = ""
 DEFAULT_BILLING_CALL_BACK_URL = "https://webaipilot.ca"
@@ -0,0 +1,169 @@
+"""
+Index migration and startup check of the mongo collections.
+
+The models declare their indexes (meta 'indexes') with auto_create_index off, they're created
+here instead, once per deploy, and indexes no longer declared are dropped:
+
+    python -m src.database.mongodb.indexes            # create missing, drop extra indexes
+    python -m src.database.mongodb.indexes --dry-run  # only report
+
+Indexes GridFS creates on its own collections (ContextItem is stored in contextItem.files) are
+neither reported nor dropped.
+
+Fields denormalised for an index (History.client, Message.client) are backfilled before the indexes
+are created.
+"""
+import argparse
+from datetime import datetime
+from bson import ObjectId
+from src.models import (
+    Plug, ContextItem, Guest, History, Message, User, IngestionJob, TokenUsage, AnalyticsDaily
+)
+
+MODELS = [Plug, ContextItem, Guest, History, Message, User, IngestionJob, TokenUsage, AnalyticsDaily]
+
+# the hot lookups, their plans should be index scans
+KEY_QUERIES = {
+    "plug by client key": lambda: Plug.objects(client__key=""),
+    "plugs of a user": lambda: Plug.objects(userId=ObjectId()),
+    "plug by client id": lambda: Plug.objects(client__id=ObjectId()),
+    "structured files of a plug": lambda: ContextItem.objects(
+        plugId=ObjectId(), isFile=True, structured=True, progress=100),
+    "file of a plug by name": lambda: ContextItem.objects(
+        source="", plugId=ObjectId(), isFile=True, isParent=False),
+    "guest of a client by ip": lambda: Guest.objects(client=ObjectId(), ip=""),
+    "guests of a client": lambda: Guest.objects(client=ObjectId()).order_by('-id'),
+    "latest history of a guest": lambda: History.objects(guest=ObjectId()).order_by('-id'),
+    "histories of a client": lambda: History.objects(client=ObjectId()).order_by('-id'),
+    "messages of a history": lambda: Message.objects(history=ObjectId()).order_by('id'),
+    "message search of a client": lambda: Message.objects(client=ObjectId()).search_text("hello"),
+    "user by stripe customer": lambda: User.objects(stripeCustomerId=""),
+    "analytics of a client": lambda: AnalyticsDaily.objects(clientId=ObjectId(), day__gte=datetime.utcnow()),
+}
+
+
+# fields of the indexes the GridFS drivers create, by collection suffix, whatever their directions
+GRIDFS_INDEXES = {
+    ".files": ["filename", "uploadDate"],
+    ".chunks": ["files_id", "n"],
+}
+
+
+def is_gridfs_index(collection_name, key):
+    return any(collection_name.endswith(suffix) and [field for field, _ in key] == fields
+               for suffix, fields in GRIDFS_INDEXES.items())
+
+
+def get_plan_stages(plan):
+    """Stages of a winning plan, innermost first, e.g. ["IXSCAN guest_1__id_-1", "FETCH"]."""
+    stages = []
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages += get_plan_stages(child)
+    stage = plan.get("stage", "")
+    if plan.get("indexName"):
+        stage = f'{stage} {plan["indexName"]}'
+    return stages + [stage]
+
+
+def explain(queryset):
+    winning_plan = queryset.explain()["queryPlanner"]["winningPlan"]
+    # sharded clusters nest the plans of the shards
+    if "shards" in winning_plan:
+        winning_plan = winning_plan["shards"][0]["winningPlan"]
+    return get_plan_stages(winning_plan.get("queryPlan", winning_plan))
+
+
+def get_index_key(info):
+    """Key of an existing index as the models declare it, text indexes as their fields by weight."""
+    key = [field for field in info["key"] if field[0] not in ("_fts", "_ftsx")]
+    if len(key) < len(info["key"]):
+        key += [(field, "text") for field in info["weights"]]
+    return key
+
+
+def compare_indexes():
+    # Document.compare_indexes only handles text indexes without prefix fields
+    report = {}
+    for model in MODELS:
+        collection_name = model._get_collection_name()
+        required = model.list_indexes()
+        existing = [get_index_key(info)
+                    for info in model._get_collection().index_information().values()]
+        report[collection_name] = {
+            "missing": [key for key in required if key not in existing],
+            "extra": [key for key in existing
+                      if key not in required and not is_gridfs_index(collection_name, key)]
+        }
+    return report
+
+
+def backfill_history_clients():
+    """Set History.client from the history's guest on histories saved before the field, server side."""
+    History.objects(client=None).aggregate([
+        {"$lookup": {"from": "guest", "localField": "guest", "foreignField": "_id", "as": "guest_doc"}},
+        {"$project": {"client": {"$arrayElemAt": ["$guest_doc.client", 0]}}},
+        {"$match": {"client": {"$ne": None}}},
+        {"$merge": {"into": History._get_collection_name(), "on": "_id",
+                    "whenMatched": "merge", "whenNotMatched": "discard"}}
+    ])
+
+
+def backfill_message_clients():
+    """Set Message.client from the message's history on messages saved before the field, server side."""
+    Message.objects(client=None).aggregate([
+        {"$lookup": {"from": History._get_collection_name(), "localField": "history", "foreignField": "_id",
+                     "as": "history_doc"}},
+        {"$project": {"client": {"$arrayElemAt": ["$history_doc.client", 0]}}},
+        {"$match": {"client": {"$ne": None}}},
+        {"$merge": {"into": Message._get_collection_name(), "on": "_id",
+                    "whenMatched": "merge", "whenNotMatched": "discard"}}
+    ], allowDiskUse=True)
+
+
+def migrate_indexes(dry_run=False):
+    """Create the declared indexes that are missing and drop the ones no longer declared."""
+    report = compare_indexes()
+    if dry_run:
+        return report
+    backfill_history_clients()
+    backfill_message_clients()
+    for model in MODELS:
+        diff = report[model._get_collection_name()]
+        model.ensure_indexes()
+        collection = model._get_collection()
+        for name, info in collection.index_information().items():
+            if name != "_id_" and get_index_key(info) in diff["extra"]:
+                print(f"Dropping index {name} of {collection.name}")
+                collection.drop_index(name)
+    return report
+
+
+def check_indexes():
+    """Report missing indexes and the plans of the key queries, at startup."""
+    for collection, diff in compare_indexes().items():
+        if diff["missing"]:
+            print(f"Missing indexes on {collection}: {diff['missing']}, "
+                  f"run python -m src.database.mongodb.indexes")
+        if diff["extra"]:
+            print(f"Undeclared indexes on {collection}: {diff['extra']}")
+    for name, query in KEY_QUERIES.items():
+        stages = explain(query())
+        warning = "" if any(stage.startswith("IXSCAN") for stage in stages) else " (no index)"
+        print(f"Query plan of {name}: {' > '.join(stages)}{warning}")
+
+
+if __name__ == "__main__":
+    import src.database.mongodb as mongo
+
+    parser = argparse.ArgumentParser(description="Create the declared mongo indexes, drop the others.")
+    parser.add_argument("--dry-run", action="store_true", help="only report the differences")
+    args = parser.parse_args()
+
+    mongo.create_db_connection()
+    if args.dry_run:
+        print(f"Histories without client: {History.objects(client=None).count()}")
+        print(f"Messages without client: {Message.objects(client=None).count()}")
+    for collection, diff in migrate_indexes(dry_run=args.dry_run).items():
+        print(f"{collection}: missing {diff['missing']}, extra {diff['extra']}")
+    check_indexes()
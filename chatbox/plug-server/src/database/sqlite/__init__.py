@@ -1,24 +1,140 @@
 import os
 import re
+import sqlite3
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
 from llama_index import SQLDatabase
+from sqlalchemy import create_engine
+from .pool import SQLitePool
+
 
 load_dotenv()
 sqlite_path = os.environ.get('SQLITE_DB_PATH')
+# plug files kept open per worker, least recently used ones are closed
+SQLITE_OPEN_SHARDS = int(os.environ.get("SQLITE_OPEN_SHARDS", 64))
 
 
 class SQLiteConnection:
-    _instance = None
-
-    def __new__(cls):
-        if cls._instance is None:
-            if not os.path.exists(sqlite_path):
-                os.makedirs(sqlite_path)
-            engine = create_engine(
-                f"sqlite:///{sqlite_path}/structured.sqlite3")
-            cls._instance = SQLDatabase(engine)
-        return cls._instance
+    """
+    Structured tables, one SQLite file per plug in {sqlite_path}/structured. Table names are
+    unchanged ("{plug_id}/{table}"), so the table schemas embedded in Chroma stay valid.
+
+    Pools of recently used plugs are kept open, tables of a plug that still lives in the former
+    single structured.sqlite3 are copied to its own file the first time the plug is opened.
+    A plug's file is only created by its first write (or that copy), plugs without tables have none.
+    """
+    _pools = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_shard_path(plug_id):
+        return f'{sqlite_path}/structured/{plug_id}.sqlite3'
+
+    @staticmethod
+    def get_legacy_path():
+        return f'{sqlite_path}/structured.sqlite3'
+
+    @classmethod
+    def get_pool(cls, plug_id, create=True):
+        """Pool of the plug's file, None when create is off and the plug has no tables (no file)."""
+        plug_id = str(plug_id)
+        with cls._lock:
+            pool = cls._pools.get(plug_id)
+            if pool is not None:
+                cls._pools.move_to_end(plug_id)
+                return pool if create or pool.exists() else None
+
+            os.makedirs(f'{sqlite_path}/structured', exist_ok=True)
+            cls.migrate_legacy_tables(plug_id)
+            if not create and not os.path.exists(cls.get_shard_path(plug_id)):
+                return None
+            pool = SQLitePool(cls.get_shard_path(plug_id))
+            cls._pools[plug_id] = pool
+            while len(cls._pools) > SQLITE_OPEN_SHARDS:
+                cls._pools.popitem(last=False)[1].close()
+            return pool
+
+    @classmethod
+    def get_database(cls, plug_id):
+        """SQLDatabase of the plug's tables, reading through its pool's read-only connections."""
+        pool = cls.get_pool(plug_id, create=False)
+        if pool is None:
+            # no tables, an empty database rather than an empty file
+            return SQLDatabase(create_engine("sqlite://"))
+        return SQLDatabase(pool.get_read_engine())
+
+    @classmethod
+    def delete_plug(cls, plug_id):
+        """Drop every table of the plug, by closing and unlinking its file."""
+        plug_id = str(plug_id)
+        with cls._lock:
+            pool = cls._pools.pop(plug_id, None)
+        if pool is not None:
+            pool.close()
+        path = cls.get_shard_path(plug_id)
+        for file_path in (path, f'{path}-wal', f'{path}-shm'):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def migrate_legacy_tables(cls, plug_id):
+        """Copy the plug's tables (and their indexes) from structured.sqlite3 to its own file, once."""
+        path = cls.get_shard_path(plug_id)
+        legacy_path = cls.get_legacy_path()
+        if os.path.exists(path) or not os.path.exists(legacy_path):
+            return
+        # plugs without tables get no file
+        legacy_connection = sqlite3.connect(f'file:{legacy_path}?mode=ro', uri=True)
+        try:
+            has_tables = legacy_connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name LIKE ? LIMIT 1;",
+                (f'{plug_id}/%',)).fetchone() is not None
+        finally:
+            legacy_connection.close()
+        if not has_tables:
+            return
+
+        # written aside and moved in place, a crashed migration is redone on the next open
+        migration_path = f'{path}.{os.getpid()}.migrating'
+        connection = sqlite3.connect(migration_path)
+        try:
+            connection.execute("ATTACH DATABASE ? AS legacy;", (legacy_path,))
+            tables = connection.execute(
+                "SELECT name, sql FROM legacy.sqlite_master WHERE type='table' AND name LIKE ?;",
+                (f'{plug_id}/%',)).fetchall()
+            indexes = connection.execute(
+                "SELECT sql FROM legacy.sqlite_master WHERE type='index' AND sql IS NOT NULL "
+                "AND tbl_name LIKE ?;", (f'{plug_id}/%',)).fetchall()
+            with connection:
+                for name, sql in tables:
+                    sanitized_name = name.replace('"', '""')
+                    connection.execute(sql)
+                    connection.execute(
+                        f'INSERT INTO main."{sanitized_name}" SELECT * FROM legacy."{sanitized_name}";')
+                for (sql,) in indexes:
+                    connection.execute(sql)
+            connection.execute("DETACH DATABASE legacy;")
+        except Exception:
+            connection.close()
+            os.remove(migration_path)
+            raise
+        connection.close()
+        if not os.path.exists(path):
+            os.replace(migration_path, path)
+        else:
+            os.remove(migration_path)
+
+    @staticmethod
+    def delete_tables_by_name(pool, name):
+        sanitized_name = name.replace('"', '""')
+        try:
+            pool.write(lambda connection: connection.execute(
+                f'DROP TABLE IF EXISTS "{sanitized_name}";'))
+        except Exception as e:
+            print("Delete table failed", str(e))
 
     @staticmethod
     def format_table_name(name):
@@ -0,0 +1,162 @@
+import os
+import re
+import sqlite3
+from collections import Counter
+from dotenv import load_dotenv
+
+
+load_dotenv()
+sqlite_path = os.environ.get('SQLITE_DB_PATH')
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+STOP_WORDS = frozenset([
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "in", "is",
+    "it", "its", "of", "on", "or", "that", "the", "this", "to", "was", "were", "will", "with",
+])
+
+
+def tokenize(text):
+    # the web server (indexing) and the plug server (querying) must tokenize the same way
+    return [token for token in TOKEN_PATTERN.findall((text or "").lower())
+            if token not in STOP_WORDS]
+
+
+class BM25Store:
+    """
+    Persisted BM25 postings of every plug's embedded documents, kept in their own SQLite file.
+
+    The web server adds documents when they are embedded and removes them with their context
+    item, the plug server loads one plug's postings to score keyword queries. Document ids are
+    the Chroma ids so results can be fused with vector hits.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            if not os.path.exists(sqlite_path):
+                os.makedirs(sqlite_path)
+            cls._instance = super().__new__(cls)
+            cls._instance.path = f'{sqlite_path}/bm25.sqlite3'
+            cls._instance.create_tables()
+        return cls._instance
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def create_tables(self):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS bm25_document ("
+                    "plug_id TEXT NOT NULL, doc_id TEXT NOT NULL, context_id TEXT, "
+                    "length INTEGER NOT NULL, PRIMARY KEY (plug_id, doc_id));")
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS bm25_document_context "
+                    "ON bm25_document (plug_id, context_id);")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS bm25_posting ("
+                    "plug_id TEXT NOT NULL, term TEXT NOT NULL, doc_id TEXT NOT NULL, "
+                    "tf INTEGER NOT NULL, PRIMARY KEY (plug_id, doc_id, term));")
+        finally:
+            connection.close()
+
+    def add_documents(self, plug_id, documents):
+        plug_id = str(plug_id)
+        document_rows = []
+        posting_rows = []
+        for document in documents:
+            term_counts = Counter(tokenize(document.get_content()))
+            document_rows.append((plug_id, document.id_, document.metadata.get("context_id"),
+                                  sum(term_counts.values())))
+            posting_rows.extend((plug_id, term, document.id_, tf)
+                                for term, tf in term_counts.items())
+        if not document_rows:
+            return
+
+        connection = self.connect()
+        try:
+            with connection:
+                # re-added documents replace their old postings
+                connection.executemany(
+                    "DELETE FROM bm25_posting WHERE plug_id = ? AND doc_id = ?;",
+                    [(plug_id, row[1]) for row in document_rows])
+                connection.executemany(
+                    "INSERT OR REPLACE INTO bm25_document (plug_id, doc_id, context_id, length) "
+                    "VALUES (?, ?, ?, ?);", document_rows)
+                connection.executemany(
+                    "INSERT INTO bm25_posting (plug_id, term, doc_id, tf) VALUES (?, ?, ?, ?);",
+                    posting_rows)
+        finally:
+            connection.close()
+
+    def delete_documents(self, plug_id, doc_ids):
+        rows = [(str(plug_id), doc_id) for doc_id in doc_ids]
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany(
+                    "DELETE FROM bm25_posting WHERE plug_id = ? AND doc_id = ?;", rows)
+                connection.executemany(
+                    "DELETE FROM bm25_document WHERE plug_id = ? AND doc_id = ?;", rows)
+        finally:
+            connection.close()
+
+    def delete_contexts(self, plug_id, context_ids):
+        plug_id = str(plug_id)
+        rows = [(plug_id, str(context_id)) for context_id in context_ids]
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany(
+                    "DELETE FROM bm25_posting WHERE plug_id = ? AND doc_id IN ("
+                    "SELECT doc_id FROM bm25_document WHERE plug_id = ? AND context_id = ?);",
+                    [(plug_id, plug_id, context_id) for _, context_id in rows])
+                connection.executemany(
+                    "DELETE FROM bm25_document WHERE plug_id = ? AND context_id = ?;", rows)
+        finally:
+            connection.close()
+
+    def delete_plug(self, plug_id):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    "DELETE FROM bm25_posting WHERE plug_id = ?;", (str(plug_id),))
+                connection.execute(
+                    "DELETE FROM bm25_document WHERE plug_id = ?;", (str(plug_id),))
+        finally:
+            connection.close()
+
+    def count(self, plug_id):
+        connection = self.connect()
+        try:
+            return connection.execute(
+                "SELECT COUNT(*) FROM bm25_document WHERE plug_id = ?;", (str(plug_id),)).fetchone()[0]
+        finally:
+            connection.close()
+
+    def load(self, plug_id):
+        """
+        Return (doc_ids, doc_lengths, postings) of one plug, postings maps a term to a list of
+        (index in doc_ids, term frequency).
+        """
+        connection = self.connect()
+        try:
+            doc_ids = []
+            doc_lengths = []
+            doc_index = {}
+            for doc_id, length in connection.execute(
+                    "SELECT doc_id, length FROM bm25_document WHERE plug_id = ?;", (str(plug_id),)):
+                doc_index[doc_id] = len(doc_ids)
+                doc_ids.append(doc_id)
+                doc_lengths.append(length)
+
+            postings = {}
+            for term, doc_id, tf in connection.execute(
+                    "SELECT term, doc_id, tf FROM bm25_posting WHERE plug_id = ?;", (str(plug_id),)):
+                if doc_id in doc_index:
+                    postings.setdefault(term, []).append((doc_index[doc_id], tf))
+            return doc_ids, doc_lengths, postings
+        finally:
+            connection.close()
@@ -0,0 +1,201 @@
+import os
+import queue
+import sqlite3
+import threading
+import weakref
+from concurrent.futures import Future, TimeoutError
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+
+load_dotenv()
+SQLITE_READ_POOL_SIZE = int(os.environ.get("SQLITE_READ_POOL_SIZE", 8))
+# seconds to wait for a free read connection or for a queued write to start
+SQLITE_POOL_TIMEOUT = float(os.environ.get("SQLITE_POOL_TIMEOUT", 30))
+SQLITE_MMAP_SIZE = int(os.environ.get(
+    "SQLITE_MMAP_SIZE", 256 * 1024 * 1024))  # bytes
+# compiled statements kept per connection, table names are per plug so statements are too
+SQLITE_STATEMENT_CACHE_SIZE = int(
+    os.environ.get("SQLITE_STATEMENT_CACHE_SIZE", 256))
+
+
+class SQLitePoolTimeout(Exception):
+    pass
+
+
+# open pools of the process, reset in forked children (connections aren't fork safe)
+_pools = weakref.WeakSet()
+
+
+def _reset_pools_after_fork():
+    for pool in list(_pools):
+        pool._after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_pools_after_fork)
+
+
+class SQLitePool:
+    """
+    Connections to one SQLite file in WAL mode: a pool of read-only connections and a single
+    writer connection owned by a writer thread. Writes of every thread/greenlet are queued to
+    the writer and run one at a time, reads run concurrently with them and are never blocked
+    by a long write (e.g. a large table import). The file is created by the first write.
+    """
+
+    def __init__(self, path, read_pool_size=SQLITE_READ_POOL_SIZE, timeout=SQLITE_POOL_TIMEOUT):
+        self.path = path
+        self.read_pool_size = read_pool_size
+        self.timeout = timeout
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._writes = queue.Queue()
+        self._writer = None
+        self._engine = None
+        self._closed = False
+        self._lock = threading.Lock()
+        # each forked worker opens its own connections
+        _pools.add(self)
+
+    def _after_fork(self):
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._writes = queue.Queue()
+        self._writer = None
+        self._lock = threading.Lock()
+        if self._engine is not None:
+            # the parent's connections are left to the parent
+            self._engine.dispose(close=False)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def connect(self, read_only=False):
+        if read_only:
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=self.timeout,
+                                         check_same_thread=False,
+                                         cached_statements=SQLITE_STATEMENT_CACHE_SIZE)
+        else:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False,
+                                         cached_statements=SQLITE_STATEMENT_CACHE_SIZE)
+            # creates the file, read-only connections can't, WAL is persistent (a no-op once set)
+            connection.execute("PRAGMA journal_mode=WAL;")
+            # WAL stays consistent on power loss with NORMAL, only the last commits may be lost
+            connection.execute("PRAGMA synchronous=NORMAL;")
+        connection.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE};")
+        return connection
+
+    @contextmanager
+    def read(self):
+        """Check out a read-only connection, raises SQLitePoolTimeout when all are in use."""
+        connection = None
+        try:
+            connection = self._readers.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._reader_count < self.read_pool_size:
+                    self._reader_count += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    connection = self.connect(read_only=True)
+                except Exception:
+                    with self._lock:
+                        self._reader_count -= 1
+                    raise
+            else:
+                try:
+                    connection = self._readers.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise SQLitePoolTimeout(
+                        f"No free SQLite read connection after {self.timeout}s") from None
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()
+            if self._closed:
+                connection.close()
+                with self._lock:
+                    self._reader_count -= 1
+            else:
+                self._readers.put(connection)
+
+    def get_read_engine(self):
+        """SQLAlchemy engine over read-only connections of this file, e.g. for llama_index's SQLDatabase."""
+        with self._lock:
+            if self._engine is None:
+                self._engine = create_engine(
+                    "sqlite://", creator=lambda: self.connect(read_only=True), poolclass=QueuePool,
+                    pool_size=self.read_pool_size, max_overflow=0, pool_timeout=self.timeout)
+            return self._engine
+
+    def write(self, fn, timeout=None):
+        """
+        Run fn(connection) on the writer and return its result, committed if it doesn't raise.
+        Raises SQLitePoolTimeout if the write hasn't started after timeout seconds (not run then).
+        """
+        if self._closed:
+            # a caller still holding a closed pool, write on a connection of its own
+            connection = self.connect()
+            try:
+                with connection:
+                    return fn(connection)
+            finally:
+                connection.close()
+
+        timeout = self.timeout if timeout is None else timeout
+        future = Future()
+        self._writes.put((fn, future))
+        self._ensure_writer()
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            if future.cancel():
+                raise SQLitePoolTimeout(
+                    f"SQLite write queued for more than {timeout}s") from None
+            # already running, wait for it
+            return future.result()
+
+    def close(self):
+        """Close idle connections, checked out ones are closed when returned, queued writes still run."""
+        self._closed = True
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        if self._engine is not None:
+            self._engine.dispose()
+        if self._writer is not None and self._writer.is_alive():
+            self._writes.put((None, None))
+
+    def _ensure_writer(self):
+        # started lazily so each forked worker runs its own writer
+        if self._writer is None or not self._writer.is_alive():
+            with self._lock:
+                if self._writer is None or not self._writer.is_alive():
+                    self._writer = threading.Thread(
+                        target=self._run_writer, daemon=True)
+                    self._writer.start()
+
+    def _run_writer(self):
+        connection = self.connect()
+        while True:
+            fn, future = self._writes.get()
+            if fn is None:
+                connection.close()
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with connection:
+                    result = fn(connection)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
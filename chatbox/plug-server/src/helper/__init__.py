@@ -1,12 +1,15 @@
 import os
-import os
 import tiktoken
 import math
+import threading
+from contextvars import ContextVar
 from llama_index.callbacks import CallbackManager, TokenCountingHandler
+from llama_index.callbacks.base_handler import BaseCallbackHandler
 from llama_index.llms import OpenAI
 from llama_index import ServiceContext, set_global_service_context
-from llama_index.embeddings import OpenAIEmbedding
 from llama_index.prompts.prompts import QuestionAnswerPrompt
+from src.helper.cached_embedding import CachedOpenAIEmbedding
+from src.helper.auth_context import get_auth_context
 from functools import wraps
 from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
 from flask import request, jsonify
@@ -51,22 +54,80 @@ def split_list(original_list, n):
     return [original_list[i * n:(i + 1) * n] for i in range((len(original_list) + n - 1) // n)]
 
 
+_request_token_counter = ContextVar("request_token_counter", default=None)
+_token_counting_lock = threading.Lock()
+_tokenizer = None
+_service_context = None
+
+
+class RequestTokenCountingHandler(BaseCallbackHandler):
+    """Forwards llm/embedding events to the token counter of the request (greenlet/thread) that raised them."""
+
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+    def start_trace(self, trace_id=None):
+        return
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        return
+
+    def on_event_start(self, event_type, payload=None, event_id="", **kwargs):
+        token_counter = _request_token_counter.get()
+        if token_counter is not None:
+            token_counter.on_event_start(
+                event_type, payload, event_id=event_id, **kwargs)
+        return event_id
+
+    def on_event_end(self, event_type, payload=None, event_id="", **kwargs):
+        token_counter = _request_token_counter.get()
+        if token_counter is not None:
+            token_counter.on_event_end(
+                event_type, payload, event_id=event_id, **kwargs)
+
+
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        with _token_counting_lock:
+            if _tokenizer is None:
+                _tokenizer = tiktoken.encoding_for_model(
+                    "text-embedding-ada-002").encode
+    return _tokenizer
+
+
+def get_service_context():
+    # one embedding client and callback manager per worker, shared by every request
+    global _service_context
+    if _service_context is None:
+        tokenizer = get_tokenizer()
+        with _token_counting_lock:
+            if _service_context is None:
+                callback_manager = CallbackManager(
+                    [RequestTokenCountingHandler()])
+                embed_model = CachedOpenAIEmbedding(
+                    embed_batch_size=500, mode='similarity', tokenizer=tokenizer)  # ada-002
+                _service_context = ServiceContext.from_defaults(
+                    embed_model=embed_model, callback_manager=callback_manager)
+    return _service_context
+
+
+def init_token_counting():
+    # set once at startup, requests never touch the global service context afterwards
+    set_global_service_context(get_service_context())
+
+
 def get_token_counter(plug):
-    token_counter = TokenCountingHandler(
-        tokenizer=tiktoken.encoding_for_model("text-embedding-ada-002").encode)
-    # token_counter.reset_counts()
-    callback_manager = CallbackManager([token_counter])
-
-    # set the global service_context
-    embed_model = OpenAIEmbedding(
-        embed_batch_size=500, mode='similarity')  # ada-002
-    # llm = OpenAI(model=plug.model, temperature=0)
-    service_context = ServiceContext.from_defaults(
-        embed_model=embed_model, callback_manager=callback_manager)
-    set_global_service_context(service_context)
+    token_counter = TokenCountingHandler(tokenizer=get_tokenizer())
+    _request_token_counter.set(token_counter)
     return token_counter
 
 
+def clear_token_counter():
+    # worker threads are reused, a request (or task) must not count on the previous one's counter
+    _request_token_counter.set(None)
+
+
 def get_qa_prompt():
     custom_prompt = (
         "Given the following sections from the context information, answer the question with that information and tools. Either use tools or answer the query directly.\n"
@@ -88,15 +149,14 @@ def role_restrict(*allowed_roles):
             try:
                 verify_jwt_in_request()  # Verify the JWT token in the request
 
-                user_id = get_jwt_identity()
-                user = User.objects(id=user_id).first()
-                if user and user.role in allowed_roles:
+                if get_auth_context().has_role(*allowed_roles):
                     return fn(*args, **kwargs)
                 else:
                     return jsonify({"code": 403, "message": "Forbidden"}), HTTP_403_FORBIDDEN
 
             except Exception as e:
-                return jsonify({"code": 500, "message": "Internal server error", "error": str(e)}), HTTP_500_INTERNAL_SERVER_ERROR
+                return jsonify(
+                    {"code": 500, "message": "Internal server error", "error": str(e)}), HTTP_500_INTERNAL_SERVER_ERROR
 
         return wrapper
 
@@ -110,18 +170,14 @@ def model_restrict(model):
             try:
                 verify_jwt_in_request()  # Verify the JWT token in the request
 
-                user_id = get_jwt_identity()
-                user = User.objects(id=user_id).first()
-
-                subscription = Subscription.objects(id=user.subscriptionId)
-
-                if subscription and model in subscription.models:
+                if get_auth_context().has_model(model):
                     return fn(*args, **kwargs)
                 else:
                     return jsonify({"code": 403, "message": "Forbidden"}), HTTP_403_FORBIDDEN
 
             except Exception as e:
-                return jsonify({"code": 500, "message": "Internal server error", "error": str(e)}), HTTP_500_INTERNAL_SERVER_ERROR
+                return jsonify(
+                    {"code": 500, "message": "Internal server error", "error": str(e)}), HTTP_500_INTERNAL_SERVER_ERROR
 
         return wrapper
 
@@ -135,18 +191,14 @@ def feature_restrict(feature):
             try:
                 verify_jwt_in_request()  # Verify the JWT token in the request
 
-                user_id = get_jwt_identity()
-                user = User.objects(id=user_id).first()
-
-                subscription = Subscription.objects(id=user.subscriptionId)
-
-                if subscription and feature in subscription.features:
+                if get_auth_context().has_feature(feature):
                     return fn(*args, **kwargs)
                 else:
                     return jsonify({"code": 403, "message": "Forbidden"}), HTTP_403_FORBIDDEN
 
             except Exception as e:
-                return jsonify({"code": 500, "message": "Internal server error", "error": str(e)}), HTTP_500_INTERNAL_SERVER_ERROR
+                return jsonify(
+                    {"code": 500, "message": "Internal server error", "error": str(e)}), HTTP_500_INTERNAL_SERVER_ERROR
 
         return wrapper
 
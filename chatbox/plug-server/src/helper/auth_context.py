@@ -0,0 +1,147 @@
+import threading
+import time
+from collections import OrderedDict
+from bson import ObjectId
+from flask import g, has_request_context
+from flask_jwt_extended import get_jwt_identity
+from src.models import User, Subscription, Plug
+from src.config.config import AUTH_CONTEXT_TTL, AUTH_CONTEXT_CACHE_SIZE
+
+
+class AuthContext:
+    """
+    Identity and entitlements of a user: the user, its subscription, the subscription's models and
+    features and its feature limits by name, plus the user's plugs once looked up.
+
+    Contexts are shared by the requests of a worker while cached, their documents are read only,
+    a handler that updates one loads it again and invalidates the context.
+    """
+
+    def __init__(self, user, subscription):
+        self.user = user
+        self.subscription = subscription
+        self.models = set(subscription.models or []) if subscription else set()
+        self.features = set(subscription.features or []) if subscription else set()
+        # feature name (e.g. "upload files") -> limit, None when unlimited
+        self.feature_limits = {}
+        for feature_limit in (subscription.featuresLimit or []) if subscription else []:
+            unlimited = feature_limit.unlimited or feature_limit.limit is None or int(feature_limit.limit) < 0
+            self.feature_limits[feature_limit.name] = None if unlimited else int(feature_limit.limit)
+        self.createdAt = time.monotonic()
+        self._plugs = {}
+        self._lock = threading.Lock()
+
+    def has_role(self, *roles):
+        return self.user is not None and self.user.role in roles
+
+    def has_model(self, model):
+        return model in self.models
+
+    def has_feature(self, feature):
+        return feature in self.features
+
+    def get_feature_limit(self, name):
+        return self.feature_limits.get(name)
+
+    def get_plug(self, plug_id):
+        """The user's plug, None when it doesn't exist or isn't theirs."""
+        plug_id = str(plug_id)
+        with self._lock:
+            if plug_id in self._plugs:
+                return self._plugs[plug_id]
+        plug = None
+        if self.user is not None and ObjectId.is_valid(plug_id):
+            plug = Plug.objects(id=ObjectId(plug_id), userId=self.user.id).first()
+        with self._lock:
+            self._plugs[plug_id] = plug
+        return plug
+
+
+class AuthContextCache:
+    """
+    Process-local LRU cache of AuthContext by user id, contexts expire after ttl seconds. Writes of
+    the worker invalidate them (Stripe webhooks, plug and admin routes), writes of other workers
+    are seen after ttl at most.
+    """
+
+    def __init__(self, max_size=1024, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._contexts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def load(user_id):
+        user = User.objects(id=ObjectId(user_id)).first() if ObjectId.is_valid(user_id) else None
+        subscription = None
+        if user is not None and user.subscriptionId:
+            subscription = Subscription.objects(id=user.subscriptionId).first()
+        return AuthContext(user, subscription)
+
+    def get(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            context = self._contexts.get(user_id)
+            if context is not None and time.monotonic() - context.createdAt <= self.ttl:
+                self._contexts.move_to_end(user_id)
+                self.hits += 1
+                return context
+            self.misses += 1
+        context = self.load(user_id)
+        with self._lock:
+            self._contexts[user_id] = context
+            self._contexts.move_to_end(user_id)
+            while len(self._contexts) > self.max_size:
+                self._contexts.popitem(last=False)
+        return context
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._contexts.pop(str(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._contexts.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._contexts),
+                "maxSize": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 4) if lookups else 0,
+            }
+
+
+def get_auth_context(user_id=None):
+    """AuthContext of the user (the JWT identity by default), loaded once per request."""
+    user_id = str(user_id or get_jwt_identity())
+    if not has_request_context():
+        return auth_context_cache.get(user_id)
+    contexts = g.setdefault("auth_contexts", {})
+    if user_id not in contexts:
+        contexts[user_id] = auth_context_cache.get(user_id)
+    return contexts[user_id]
+
+
+def invalidate_auth_context(user_id=None):
+    """Drop the user's context (every context when None), the next lookup loads it again."""
+    if user_id is None:
+        auth_context_cache.clear()
+    else:
+        auth_context_cache.invalidate(user_id)
+    if has_request_context():
+        contexts = g.get("auth_contexts", {})
+        if user_id is None:
+            contexts.clear()
+        else:
+            contexts.pop(str(user_id), None)
+
+
+auth_context_cache = AuthContextCache(
+    max_size=AUTH_CONTEXT_CACHE_SIZE, ttl=AUTH_CONTEXT_TTL)
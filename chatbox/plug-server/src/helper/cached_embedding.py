@@ -0,0 +1,59 @@
+from typing import List, Tuple
+
+from llama_index.callbacks.schema import CBEventType, EventPayload
+from llama_index.embeddings import OpenAIEmbedding
+
+from src.database.sqlite.embedding_cache import EmbeddingCache
+
+
+class CachedOpenAIEmbedding(OpenAIEmbedding):
+    """
+    OpenAIEmbedding that looks every text up in the shared EmbeddingCache first. Only the misses
+    are sent to OpenAI and reported to the callbacks, so cached texts are not counted as tokens.
+    """
+
+    def _embed_texts(self, texts: List[str]) -> List[List[float]]:
+        embedding_cache = EmbeddingCache()
+        embeddings = embedding_cache.get_many(self.text_engine.value, texts)
+        missing = [index for index, embedding in enumerate(
+            embeddings) if embedding is None]
+
+        for start in range(0, len(missing), self._embed_batch_size):
+            batch = missing[start:start + self._embed_batch_size]
+            batch_texts = [texts[index] for index in batch]
+            with self.callback_manager.event(CBEventType.EMBEDDING) as event:
+                batch_embeddings = self._get_text_embeddings(batch_texts)
+                event.on_end(
+                    payload={
+                        EventPayload.CHUNKS: batch_texts,
+                        EventPayload.EMBEDDINGS: batch_embeddings,
+                    },
+                )
+            embedding_cache.put_many(
+                self.text_engine.value, batch_texts, batch_embeddings)
+            for index, embedding in zip(batch, batch_embeddings):
+                embeddings[index] = embedding
+        return embeddings
+
+    def get_query_embedding(self, query: str) -> List[float]:
+        embedding_cache = EmbeddingCache()
+        embedding = embedding_cache.get_many(
+            self.query_engine.value, [query])[0]
+        if embedding is None:
+            embedding = super().get_query_embedding(query)
+            embedding_cache.put_many(
+                self.query_engine.value, [query], [embedding])
+        return embedding
+
+    def get_text_embedding(self, text: str) -> List[float]:
+        return self._embed_texts([text])[0]
+
+    def get_text_embedding_batch(self, texts: List[str], show_progress: bool = False) -> List[List[float]]:
+        return self._embed_texts(texts)
+
+    def get_queued_text_embeddings(
+        self, show_progress: bool = False
+    ) -> Tuple[List[str], List[List[float]]]:
+        # the model is shared by every request of the worker, take the queue before yielding on I/O
+        text_queue, self._text_queue = self._text_queue, []
+        return [text_id for text_id, _ in text_queue], self._embed_texts([text for _, text in text_queue])
@@ -0,0 +1,171 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from llama_index import VectorStoreIndex, ServiceContext
+from llama_index.llms import OpenAI
+from llama_index.vector_stores import ChromaVectorStore
+from llama_index.objects import SQLTableSchema
+from src.models import ContextItem
+from src.helper import get_service_context
+from src.helper.table_schema_index import load_table_schema_index, get_table_context
+from src.helper.sql_plan_cache import CachedSQLTableRetrieverQueryEngine
+from src.helper.custom_retriever import CustomBM25Retriever, HybridRetriever, load_bm25_index
+from src.database.sqlite import SQLiteConnection
+from src.database.sqlite.bm25 import BM25Store
+from src.config.config import (
+    CHAT_ENGINE_CACHE_SIZE, CHAT_ENGINE_CACHE_TTL, RETRIEVAL_MODE, HYBRID_RETRIEVAL, RETRIEVAL_TOP_K,
+    RETRIEVAL_CANDIDATE_K, RRF_K
+)
+
+
+class CacheEntry:
+    def __init__(self, version, value):
+        self.version = version
+        self.value = value
+        self.createdAt = time.monotonic()
+
+
+class ChatEngineCache:
+    """
+    Process-local LRU + TTL cache of the per-plug objects needed to answer a chat
+    (retriever, SQL query engine, tools, ...).
+
+    An entry is only reused while the plug's version matches: the version covers the
+    plug's context items (through Plug.contextVersion), prompt, model, user key and retrieval mode.
+    """
+
+    def __init__(self, max_size=128, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def get_version(plug):
+        fingerprint = "|".join([
+            str(plug.contextVersion or 0),
+            plug.model or "",
+            plug.userKey or "",
+            plug.prompt or "",
+            get_retrieval_mode(plug),
+        ])
+        return hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()
+
+    def _is_expired(self, entry):
+        return self.ttl > 0 and time.monotonic() - entry.createdAt > self.ttl
+
+    def get_or_create(self, plug, factory, namespace="default"):
+        key = (str(plug.id), namespace)
+        version = self.get_version(plug)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.version == version and not self._is_expired(entry):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.value
+            self.misses += 1
+
+        # build outside the lock so a slow plug doesn't block every other chat
+        value = factory()
+
+        with self._lock:
+            self._entries[key] = CacheEntry(version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def invalidate(self, plug_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == str(plug_id)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxSize": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRate": round(self.hits / lookups, 4) if lookups else 0,
+            }
+
+
+class PlugChatComponents:
+    def __init__(self, retriever, query_engine, context_strs):
+        self.retriever = retriever
+        self.query_engine = query_engine
+        self.context_strs = context_strs
+        self.tools = []
+
+
+def get_retrieval_mode(plug):
+    return "hybrid" if HYBRID_RETRIEVAL in (plug.features or []) else RETRIEVAL_MODE
+
+
+def build_chat_components(plug, chroma_client, sql_model="gpt-4"):
+    # the shared callback manager attributes tokens to whichever request uses the components
+    service_context = ServiceContext.from_service_context(
+        get_service_context(), llm=OpenAI(model=sql_model))
+
+    # create index
+    chroma_collection = chroma_client.get_collection(name=str(plug.id))
+    vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+    index = VectorStoreIndex.from_vector_store(
+        vector_store=vector_store, service_context=service_context)
+    if get_retrieval_mode(plug) == "hybrid":
+        # the BM25 index is loaded once per cached entry, re-uploads bump the plug's version
+        bm25_retriever = CustomBM25Retriever(
+            plug.id, load_bm25_index(BM25Store(), chroma_collection, plug.id), chroma_collection,
+            similarity_top_k=RETRIEVAL_CANDIDATE_K)
+        retriever = HybridRetriever(
+            [index.as_retriever(similarity_top_k=RETRIEVAL_CANDIDATE_K), bm25_retriever],
+            similarity_top_k=RETRIEVAL_TOP_K, rrf_k=RRF_K)
+    else:
+        retriever = index.as_retriever(similarity_top_k=1)
+
+    # load the plug's embedded table schemas
+    table_schema_objs = []
+    table_names = []
+    context_strs = []
+
+    structured_context_items = ContextItem.objects(
+        plugId=plug.id, isFile=True, structured=True)
+
+    for item in structured_context_items:
+        table_name = f"{str(plug.id)}/{SQLiteConnection.format_table_name(item.source)}"
+        table_names.append(table_name)
+        if item.progress != 100:
+            continue
+        table_schema_objs.append(SQLTableSchema(
+            table_name=table_name, context_str=get_table_context(item.contextString, item.columnStats)))
+        context_strs.append(item.contextString)
+
+    # the plug's own SQLite file, a fresh SQLDatabase so re-imported tables are reflected again
+    connection = SQLiteConnection.get_database(plug.id)
+    obj_index = load_table_schema_index(
+        chroma_client, connection, plug.id, table_schema_objs, table_names, service_context=service_context)
+    # generated queries are reused until the plug's tables change (contextVersion)
+    query_engine = CachedSQLTableRetrieverQueryEngine(
+        connection, obj_index.as_retriever(similarity_top_k=1), service_context=service_context,
+        plug_id=plug.id, schema_version=plug.contextVersion or 0
+    )
+
+    return PlugChatComponents(retriever, query_engine, context_strs)
+
+
+chat_engine_cache = ChatEngineCache(
+    max_size=CHAT_ENGINE_CACHE_SIZE, ttl=CHAT_ENGINE_CACHE_TTL)
@@ -0,0 +1,225 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict
+import pytz
+from bson import ObjectId
+from itsdangerous import URLSafeSerializer, BadSignature
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from src.models import Guest, History, Message
+from src.config.config import (
+    SECRET_KEY, CONVERSATION_SESSION_CACHE_SIZE, MESSAGE_WRITER_FLUSH_INTERVAL, MESSAGE_WRITER_BATCH_SIZE
+)
+
+DUPLICATE_KEY_ERROR = 11000
+HISTORY_FIELDS = ["client", "createdAt", "updatedAt"]
+
+
+def to_naive_utc(at):
+    # datetimes read from mongo are naive UTC
+    return at.astimezone(pytz.UTC).replace(tzinfo=None) if at.tzinfo is not None else at
+
+
+class ConversationSession:
+    def __init__(self, history_id, client_id, created_at, updated_at):
+        self.historyId = history_id
+        self.clientId = client_id
+        self.createdAt = to_naive_utc(created_at)
+        # last message this worker knows of
+        self.updatedAt = to_naive_utc(updated_at)
+
+
+class ConversationSessions:
+    """
+    Histories of the widget's conversations by session token.
+
+    The token, returned when the history is created, is the signed history and client ids: a chat
+    finds its history without looking its guest up by ip and scanning for the guest's latest
+    history. Sessions (creation and last message time of the history) are cached per worker.
+    """
+
+    def __init__(self, secret, max_size=10000):
+        self.max_size = max_size
+        self._serializer = URLSafeSerializer(secret, salt="conversation-session")
+        # history id -> ConversationSession
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, history, client_id=None):
+        session = ConversationSession(history.id, client_id or history.client,
+                                      history.createdAt, history.updatedAt)
+        with self._lock:
+            self._sessions[history.id] = session
+            self._sessions.move_to_end(history.id)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+        return session
+
+    def create_token(self, history, client_id=None):
+        """Session token of a history, its session is cached."""
+        session = self._store(history, client_id)
+        return self._serializer.dumps([str(history.id), str(session.clientId)])
+
+    def get(self, token, client_id):
+        """Session of the token, None when it isn't a token of the client's or its history is gone."""
+        try:
+            history_id, token_client_id = self._serializer.loads(token)
+        except (BadSignature, ValueError, TypeError):
+            return None
+        if token_client_id != str(client_id) or not ObjectId.is_valid(history_id):
+            return None
+        history_id = ObjectId(history_id)
+
+        with self._lock:
+            session = self._sessions.get(history_id)
+            if session is not None:
+                self._sessions.move_to_end(history_id)
+                self.hits += 1
+                return session
+            self.misses += 1
+
+        history = History.objects(id=history_id).only(*HISTORY_FIELDS).first()
+        return self._store(history, ObjectId(client_id)) if history else None
+
+    def find(self, client_id, ip):
+        """Session of the latest history of the client's guest at ip, for widgets without a token."""
+        guest = Guest.objects(client=ObjectId(client_id), ip=ip).only("id").first()
+        if not guest:
+            return None
+        history = History.objects(guest=guest.id).order_by(
+            '-id').only(*HISTORY_FIELDS).first()
+        return self._store(history, ObjectId(client_id)) if history else None
+
+    def touch(self, session, at):
+        """Move the session's last message to at, the seconds the conversation grew by."""
+        at = to_naive_utc(at)
+        with self._lock:
+            duration = max((at - session.updatedAt).total_seconds(), 0)
+            session.updatedAt = max(at, session.updatedAt)
+        return duration
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._sessions),
+                "maxSize": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 4) if lookups else 0,
+            }
+
+
+class MessageWriter:
+    """
+    Per-worker buffer of the widget's messages.
+
+    Messages are inserted in batches every flush_interval seconds (or once batch_size are pending),
+    their histories' updatedAt is moved forward with atomic $max updates. Ids are assigned when the
+    messages are recorded, so a conversation's messages keep their order.
+    """
+
+    def __init__(self, flush_interval=2, batch_size=200):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._messages = []
+        self._updated_at = {}
+        self._flusher = None
+
+    def record(self, history_id, client_id, messages, at):
+        """Add messages, (role, content) pairs, to the history."""
+        documents = []
+        for role, content in messages:
+            message = Message(id=ObjectId(), content=content, role=role,
+                              history=history_id, client=client_id, createdAt=at)
+            message.validate()
+            documents.append(message)
+
+        with self._lock:
+            self._messages += documents
+            self._updated_at[history_id] = max(
+                at, self._updated_at.get(history_id, at))
+            should_flush = len(self._messages) >= self.batch_size
+
+        self._ensure_flusher()
+        if should_flush:
+            self.flush_quietly()
+
+    def has_pending(self, history_id):
+        with self._lock:
+            return history_id in self._updated_at
+
+    def _ensure_flusher(self):
+        # started lazily so each forked worker runs its own flusher
+        if self._flusher is None or not self._flusher.is_alive():
+            with self._lock:
+                if self._flusher is None or not self._flusher.is_alive():
+                    self._flusher = threading.Thread(
+                        target=self._run, daemon=True)
+                    self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush_quietly()
+
+    def flush_quietly(self):
+        # failed messages/updates are kept and retried on the next flush
+        try:
+            self.flush()
+        except Exception as e:
+            print("Message flush failed", str(e))
+
+    def flush(self):
+        with self._lock:
+            messages, self._messages = self._messages, []
+            updated_at, self._updated_at = self._updated_at, {}
+
+        if messages:
+            try:
+                self._insert_messages(messages)
+            except Exception:
+                with self._lock:
+                    self._messages = messages + self._messages
+                    self._restore_updated_at(updated_at)
+                raise
+
+        if updated_at:
+            try:
+                History._get_collection().bulk_write(
+                    [UpdateOne({"_id": history_id}, {"$max": {"updatedAt": at}})
+                     for history_id, at in updated_at.items()], ordered=False)
+            except Exception:
+                with self._lock:
+                    self._restore_updated_at(updated_at)
+                raise
+
+    def _restore_updated_at(self, updated_at):
+        for history_id, at in updated_at.items():
+            self._updated_at[history_id] = max(
+                at, self._updated_at.get(history_id, at))
+
+    @staticmethod
+    def _insert_messages(messages):
+        try:
+            Message._get_collection().insert_many(
+                [message.to_mongo() for message in messages], ordered=False)
+        except BulkWriteError as e:
+            # messages kept from a failed flush may already be stored, their ids are fixed
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+
+
+conversation_sessions = ConversationSessions(
+    SECRET_KEY, max_size=CONVERSATION_SESSION_CACHE_SIZE)
+
+message_writer = MessageWriter(
+    flush_interval=MESSAGE_WRITER_FLUSH_INTERVAL, batch_size=MESSAGE_WRITER_BATCH_SIZE)
+
+# don't lose the last interval's messages on graceful worker shutdown
+atexit.register(message_writer.flush_quietly)
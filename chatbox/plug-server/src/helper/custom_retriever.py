@@ -1,80 +1,136 @@
+import heapq
 import logging
-from typing import Callable, List, Optional, cast
+from typing import List
+
+import numpy as np
 
 from llama_index.constants import DEFAULT_SIMILARITY_TOP_K
 from llama_index.indices.base_retriever import BaseRetriever
 from llama_index.indices.query.schema import QueryBundle
-from llama_index.indices.vector_store.base import VectorStoreIndex
-from llama_index.schema import BaseNode, NodeWithScore
-from llama_index.storage.docstore.types import BaseDocumentStore
-from llama_index.utils import globals_helper
+from llama_index.schema import NodeWithScore, TextNode
+from llama_index.vector_stores.utils import metadata_dict_to_node
+
+from src.database.sqlite.bm25 import tokenize
 
 logger = logging.getLogger(__name__)
 
 
+class BM25Index:
+    """
+    In-memory BM25 (Okapi) scorer over one plug's persisted postings, see BM25Store.
+
+    Postings are stored term-contiguous in flat NumPy arrays (offsets per term), each with its
+    precomputed BM25 weight, so a query only gathers and sums the postings of its terms.
+    """
+
+    def __init__(self, doc_ids, doc_lengths, postings, k1=1.5, b=0.75):
+        self.doc_ids = doc_ids
+        self.k1 = k1
+        self.b = b
+        n_docs = len(doc_ids)
+
+        lengths = np.asarray(doc_lengths, dtype=np.float32)
+        avg_doc_length = lengths.mean() if n_docs else 0.0
+        length_norm = k1 * (1 - b + b * lengths / avg_doc_length) if avg_doc_length \
+            else np.full(n_docs, k1, dtype=np.float32)
+
+        self.term_ids = {}
+        offsets = [0]
+        posting_chunks = []
+        for term, term_postings in postings.items():
+            self.term_ids[term] = len(self.term_ids)
+            posting_chunks.append(np.asarray(term_postings, dtype=np.int64))
+            offsets.append(offsets[-1] + len(term_postings))
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+        if posting_chunks:
+            all_postings = np.concatenate(posting_chunks)
+            self.posting_docs = all_postings[:, 0].astype(np.int32)
+            tfs = all_postings[:, 1].astype(np.float32)
+        else:
+            self.posting_docs = np.empty(0, dtype=np.int32)
+            tfs = np.empty(0, dtype=np.float32)
+
+        doc_freqs = np.diff(self.offsets)
+        idf = np.log((n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5) + 1)
+        self.posting_weights = (np.repeat(idf, doc_freqs) * tfs * (k1 + 1) /
+                                (tfs + length_norm[self.posting_docs])).astype(np.float32)
+
+    @classmethod
+    def from_store(cls, bm25_store, plug_id):
+        return cls(*bm25_store.load(plug_id))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def top_k(self, query, k):
+        # cost grows with the postings of the query terms, not with the corpus
+        term_ids = [self.term_ids[term]
+                    for term in set(tokenize(query)) if term in self.term_ids]
+        if not term_ids or k <= 0:
+            return []
+
+        if len(term_ids) == 1:
+            start, end = self.offsets[term_ids[0]], self.offsets[term_ids[0] + 1]
+            docs = self.posting_docs[start:end]
+            scores = self.posting_weights[start:end]
+        else:
+            docs = np.concatenate([self.posting_docs[self.offsets[term_id]:self.offsets[term_id + 1]]
+                                   for term_id in term_ids])
+            weights = np.concatenate([self.posting_weights[self.offsets[term_id]:self.offsets[term_id + 1]]
+                                      for term_id in term_ids])
+            docs, inverse = np.unique(docs, return_inverse=True)
+            scores = np.bincount(inverse, weights=weights)
+
+        k = min(k, len(docs))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.doc_ids[docs[i]], float(scores[i])) for i in top]
+
+
+def load_bm25_index(bm25_store, chroma_collection, plug_id):
+    """
+    Load the plug's BM25 index written by the web server at ingestion. Plugs whose documents
+    were embedded before the index existed are indexed once from their Chroma collection.
+    """
+    if bm25_store.count(plug_id) == 0 and chroma_collection.count() > 0:
+        result = chroma_collection.get(include=["documents", "metadatas"])
+        bm25_store.add_documents(plug_id, [
+            TextNode(id_=node_id, text=text or "", metadata=metadata or {})
+            for node_id, text, metadata in zip(result["ids"], result["documents"], result["metadatas"])
+        ])
+    return BM25Index.from_store(bm25_store, plug_id)
+
+
 class CustomBM25Retriever(BaseRetriever):
+    """
+    Keyword retriever over a plug's BM25 index. Only the top_k document ids are scored into
+    results, their text is read back from the plug's Chroma collection.
+    """
+
     def __init__(
         self,
         plug_id,
-        nodes: List[BaseNode],
-        tokenizer: Optional[Callable[[str], List[str]]],
+        bm25_index: BM25Index,
+        chroma_collection,
         similarity_top_k: int = DEFAULT_SIMILARITY_TOP_K,
     ) -> None:
-        try:
-            from rank_bm25 import BM25Okapi
-        except ImportError:
-            raise ImportError(
-                "Please install rank_bm25: pip install rank-bm25")
         self.plug_id = plug_id
-        self._nodes = nodes
-        self._tokenizer = tokenizer or (lambda x: x.split(" "))
+        self._bm25_index = bm25_index
+        self._chroma_collection = chroma_collection
         self._similarity_top_k = similarity_top_k
-        self._corpus = [self._tokenizer(node.get_content())
-                        for node in self._nodes]
-
-        self.bm25 = BM25Okapi(self._corpus)
-
-    @classmethod
-    def from_defaults(
-        cls,
-        plug_id,
-        index: Optional[VectorStoreIndex] = None,
-        nodes: Optional[List[BaseNode]] = None,
-        docstore: Optional[BaseDocumentStore] = None,
-        tokenizer: Optional[Callable[[str], List[str]]] = None,
-        similarity_top_k: int = DEFAULT_SIMILARITY_TOP_K,
-    ) -> "CustomBM25Retriever":
-        # ensure only one of index, nodes, or docstore is passed
-        if sum(bool(val) for val in [index, nodes, docstore]) != 1:
-            raise ValueError(
-                "Please pass exactly one of index, nodes, or docstore.")
-
-        if index is not None:
-            docstore = index.docstore
-
-        if docstore is not None:
-            nodes = cast(List[BaseNode], list(docstore.docs.values()))
-
-        assert (
-            nodes is not None
-        ), "Please pass exactly one of index, nodes, or docstore."
-
-        tokenizer = tokenizer or globals_helper.tokenizer
-        return cls(
-            plug_id=plug_id,
-            nodes=nodes,
-            tokenizer=tokenizer,
-            similarity_top_k=similarity_top_k,
-        )
-
-    def _get_scored_nodes(self, query: str) -> List[NodeWithScore]:
-        tokenized_query = self._tokenizer(query)
-        doc_scores = self.bm25.get_scores(tokenized_query)
-
-        nodes: List[NodeWithScore] = []
-        for i, node in enumerate(self._nodes):
-            nodes.append(NodeWithScore(node=node, score=doc_scores[i]))
 
+    def _get_nodes(self, doc_ids):
+        result = self._chroma_collection.get(
+            ids=doc_ids, include=["documents", "metadatas"])
+        nodes = {}
+        for node_id, text, metadata in zip(result["ids"], result["documents"], result["metadatas"]):
+            try:
+                node = metadata_dict_to_node(metadata)
+                node.set_content(text)
+            except Exception:
+                node = TextNode(id_=node_id, text=text, metadata=metadata or {})
+            nodes[node_id] = node
         return nodes
 
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
@@ -82,9 +138,38 @@ class CustomBM25Retriever(BaseRetriever):
             logger.warning(
                 "BM25Retriever does not support embeddings, skipping...")
 
-        scored_nodes = self._get_scored_nodes(query_bundle.query_str)
+        scored_ids = self._bm25_index.top_k(
+            query_bundle.query_str, self._similarity_top_k)
+        if not scored_ids:
+            return []
+
+        # ids removed from Chroma since the index was loaded are skipped
+        nodes = self._get_nodes([doc_id for doc_id, _ in scored_ids])
+        return [NodeWithScore(node=nodes[doc_id], score=score)
+                for doc_id, score in scored_ids if doc_id in nodes]
+
 
-        # Sort and get top_k nodes, score range => 0..1, closer to 1 means more relevant
-        nodes = sorted(
-            scored_nodes, key=lambda x: x.score or 0.0, reverse=True)
-        return [node for node in nodes[: self._similarity_top_k] if node.metadata.get('plug_id') == self.plug_id]
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses vector and keyword (BM25) hits with reciprocal rank fusion:
+    score = sum(1 / (rrf_k + rank)) over the retrievers that returned the node.
+    """
+
+    def __init__(self, retrievers, similarity_top_k=DEFAULT_SIMILARITY_TOP_K, rrf_k=60):
+        self._retrievers = retrievers
+        self._similarity_top_k = similarity_top_k
+        self._rrf_k = rrf_k
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        fused_scores = {}
+        nodes = {}
+        for retriever in self._retrievers:
+            for rank, node_with_score in enumerate(retriever.retrieve(query_bundle), start=1):
+                node_id = node_with_score.node.node_id
+                nodes.setdefault(node_id, node_with_score.node)
+                fused_scores[node_id] = fused_scores.get(
+                    node_id, 0.0) + 1.0 / (self._rrf_k + rank)
+
+        best = heapq.nlargest(self._similarity_top_k,
+                              fused_scores.items(), key=lambda item: item[1])
+        return [NodeWithScore(node=nodes[node_id], score=score) for node_id, score in best]
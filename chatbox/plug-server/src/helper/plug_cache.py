@@ -0,0 +1,167 @@
+import threading
+import time
+from collections import OrderedDict
+from pymongo.errors import OperationFailure
+from src.models import Plug
+from src.config.config import PLUG_CACHE_SIZE, PLUG_CACHE_TTL, PLUG_CACHE_NEGATIVE_TTL, PLUG_CACHE_WATCH
+
+# what the widget API reads of a plug, mapsPoint and the rest aren't loaded
+PLUG_FIELDS = ["active", "model", "prompt", "features", "userKey", "client", "contextVersion"]
+# updates of these (top level) fields evict the plug, client.token and token are updated by every chat
+WATCHED_FIELDS = ["active", "model", "prompt", "features", "userKey", "contextVersion"]
+WATCHED_PATHS = ["client", "client.key", "client._id"]
+# "$changeStream stage is only supported on replica sets"
+CHANGE_STREAM_UNSUPPORTED = 40573
+
+
+class PlugCache:
+    """
+    Process-local LRU cache of the plugs of the public widget API by client key, projected on
+    PLUG_FIELDS. Unknown keys are cached too (as None) for negative_ttl seconds.
+
+    Plugs are mostly changed by web-server: with watch on, a change stream of the plug collection
+    evicts them as they change, otherwise (or without a replica set) they're reloaded after ttl.
+    The cached plugs are shared by the requests, they must not be modified or saved.
+    """
+
+    def __init__(self, max_size=4096, ttl=30, negative_ttl=5, watch=True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.watch = watch
+        # client key -> (plug or None, loaded at)
+        self._entries = OrderedDict()
+        # plug id -> client key, the change stream only has the plug's id
+        self._keys = {}
+        self._lock = threading.Lock()
+        # bumped by every eviction, a plug loaded meanwhile may be stale and isn't cached
+        self._generation = 0
+        self._watcher = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def load(client_key):
+        return Plug.objects(client__key=client_key).only(*PLUG_FIELDS).first()
+
+    def get(self, client_key):
+        """The plug of the client key, None when there's none."""
+        if self.watch:
+            self._ensure_watcher()
+        with self._lock:
+            entry = self._entries.get(client_key)
+            if entry is not None:
+                plug, loaded_at = entry
+                ttl = self.ttl if plug is not None else self.negative_ttl
+                if time.monotonic() - loaded_at <= ttl:
+                    self._entries.move_to_end(client_key)
+                    self.hits += 1
+                    return plug
+            self.misses += 1
+            generation = self._generation
+
+        plug = self.load(client_key)
+
+        with self._lock:
+            if generation == self._generation:
+                self._entries[client_key] = (plug, time.monotonic())
+                self._entries.move_to_end(client_key)
+                if plug is not None:
+                    self._keys[str(plug.id)] = client_key
+                while len(self._entries) > self.max_size:
+                    _, (evicted, _) = self._entries.popitem(last=False)
+                    if evicted is not None:
+                        self._keys.pop(str(evicted.id), None)
+                    self.evictions += 1
+        return plug
+
+    def evict(self, client_key=None, plug_id=None):
+        with self._lock:
+            self._generation += 1
+            if plug_id is not None:
+                client_key_of_plug = self._keys.pop(str(plug_id), None)
+                if client_key_of_plug is not None:
+                    self._entries.pop(client_key_of_plug, None)
+            if client_key is not None:
+                entry = self._entries.pop(client_key, None)
+                if entry is not None and entry[0] is not None:
+                    self._keys.pop(str(entry[0].id), None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._keys.clear()
+
+    def _ensure_watcher(self):
+        # started lazily so each forked worker watches on its own
+        if self._watcher is None or not self._watcher.is_alive():
+            with self._lock:
+                if self.watch and (self._watcher is None or not self._watcher.is_alive()):
+                    self._watcher = threading.Thread(target=self._watch, daemon=True)
+                    self._watcher.start()
+
+    @staticmethod
+    def get_change_pipeline():
+        updated_field = {"$arrayElemAt": [{"$split": ["$$this.k", "."]}, 0]}
+        return [{"$match": {"$or": [
+            {"operationType": {"$in": ["insert", "replace", "delete", "invalidate"]}},
+            {"operationType": "update", "$expr": {"$gt": [{"$size": {"$filter": {
+                "input": {"$objectToArray": "$updateDescription.updatedFields"},
+                "cond": {"$or": [{"$in": ["$$this.k", WATCHED_PATHS]},
+                                 {"$in": [updated_field, WATCHED_FIELDS]}]}
+            }}}, 0]}},
+            {"operationType": "update", "updateDescription.removedFields": {"$in": PLUG_FIELDS}},
+        ]}}]
+
+    def _watch(self):
+        while self.watch:
+            try:
+                with Plug._get_collection().watch(self.get_change_pipeline()) as stream:
+                    # changes may have been missed while the stream was down
+                    self.clear()
+                    for change in stream:
+                        self._on_change(change)
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_UNSUPPORTED:
+                    print("Plug cache change stream unavailable, plugs expire after", self.ttl, "seconds")
+                    self.watch = False
+                    return
+                print("Plug cache change stream failed", str(e))
+                time.sleep(5)
+            except Exception as e:
+                print("Plug cache change stream failed", str(e))
+                time.sleep(5)
+
+    def _on_change(self, change):
+        if change["operationType"] == "invalidate":
+            self.clear()
+            return
+        self.evict(plug_id=change["documentKey"]["_id"])
+        # a new plug or client key may be cached as unknown
+        document = change.get("fullDocument") or {}
+        updated_fields = change.get("updateDescription", {}).get("updatedFields", {})
+        client = document.get("client") or updated_fields.get("client") or {}
+        client_key = client.get("key") or updated_fields.get("client.key")
+        if client_key:
+            self.evict(client_key=client_key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxSize": self.max_size,
+                "ttl": self.ttl,
+                "negativeTtl": self.negative_ttl,
+                "watching": self.watch and self._watcher is not None and self._watcher.is_alive(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRate": round(self.hits / lookups, 4) if lookups else 0,
+            }
+
+
+plug_cache = PlugCache(max_size=PLUG_CACHE_SIZE, ttl=PLUG_CACHE_TTL,
+                       negative_ttl=PLUG_CACHE_NEGATIVE_TTL, watch=bool(PLUG_CACHE_WATCH))
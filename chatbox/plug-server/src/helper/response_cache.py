@@ -0,0 +1,182 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from src.helper import get_service_context
+from src.helper.chat_engine_cache import ChatEngineCache
+from src.config.config import (
+    RESPONSE_CACHE_SIMILARITY, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_PLUGS, RESPONSE_CACHE_TTL
+)
+
+# answers that only used these tools are cached, others may have side effects (e.g. order_tool)
+CACHEABLE_TOOLS = {"context_information"}
+
+
+class CachedResponse:
+    def __init__(self, question, answer, embedding):
+        self.question = question
+        self.answer = answer
+        self.embedding = embedding
+        self.createdAt = time.monotonic()
+        self.hits = 0
+
+
+class PlugResponses:
+    def __init__(self, version):
+        self.version = version
+        self.entries = OrderedDict()
+        # normalized embeddings of entries, in order, rebuilt after entries change
+        self.matrix = None
+
+
+class ResponseCache:
+    """
+    Process-local semantic cache of client chat answers per plug.
+
+    A question is answered from the cache when a previous question of the same plug embeds within
+    `similarity` (cosine) of it. Entries are kept per plug version (ChatEngineCache.get_version: the
+    plug's context items through Plug.contextVersion, prompt, model and user key), so any context
+    item change of the plug invalidates its answers. Least recently used answers are evicted past
+    max_size per plug, and answers expire after ttl seconds.
+    """
+
+    def __init__(self, similarity=0.95, max_size=256, max_plugs=256, ttl=86400):
+        self.similarity = similarity
+        self.max_size = max_size
+        self.max_plugs = max_plugs
+        self.ttl = ttl
+        self._plugs = OrderedDict()
+        self._stats = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize_question(question):
+        return re.sub(r"\s+", " ", question).strip().lower()
+
+    @staticmethod
+    def embed(question):
+        embedding = np.asarray(
+            get_service_context().embed_model.get_query_embedding(question), dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    @staticmethod
+    def is_cacheable(sources):
+        return all(source.tool_name in CACHEABLE_TOOLS for source in sources)
+
+    def _is_expired(self, entry):
+        return self.ttl > 0 and time.monotonic() - entry.createdAt > self.ttl
+
+    def _get_stats(self, plug_id):
+        # called with the lock held
+        stats = self._stats.pop(plug_id, None) or {
+            "hits": 0, "misses": 0, "stores": 0, "invalidations": 0}
+        self._stats[plug_id] = stats
+        while len(self._stats) > self.max_plugs:
+            self._stats.popitem(last=False)
+        return stats
+
+    def _get_plug_responses(self, plug_id, version, create=False):
+        # called with the lock held, answers of a former plug version are dropped
+        plug_responses = self._plugs.get(plug_id)
+        if plug_responses is not None and plug_responses.version != version:
+            del self._plugs[plug_id]
+            self._get_stats(plug_id)["invalidations"] += 1
+            plug_responses = None
+        if plug_responses is None and create:
+            plug_responses = self._plugs[plug_id] = PlugResponses(version)
+            while len(self._plugs) > self.max_plugs:
+                self._plugs.popitem(last=False)
+        if plug_responses is not None:
+            self._plugs.move_to_end(plug_id)
+        return plug_responses
+
+    def _find(self, plug_responses, embedding):
+        # called with the lock held
+        for key in [key for key, entry in plug_responses.entries.items() if self._is_expired(entry)]:
+            del plug_responses.entries[key]
+            plug_responses.matrix = None
+        if not plug_responses.entries:
+            return None
+        if plug_responses.matrix is None:
+            plug_responses.matrix = np.stack(
+                [entry.embedding for entry in plug_responses.entries.values()])
+        similarities = plug_responses.matrix @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity:
+            return None
+        return list(plug_responses.entries.values())[best]
+
+    def lookup(self, plug, embedding):
+        """Cached answer of a near-duplicate question, None on a miss."""
+        plug_id = str(plug.id)
+        with self._lock:
+            stats = self._get_stats(plug_id)
+            plug_responses = self._get_plug_responses(
+                plug_id, ChatEngineCache.get_version(plug))
+            entry = self._find(plug_responses, embedding) if plug_responses else None
+            if entry is None:
+                stats["misses"] += 1
+                return None
+            # most recently used last, the matrix order doesn't matter for lookups
+            plug_responses.entries.move_to_end(
+                self.normalize_question(entry.question))
+            plug_responses.matrix = None
+            entry.hits += 1
+            stats["hits"] += 1
+            return entry.answer
+
+    def store(self, plug, question, embedding, answer):
+        if not answer.strip():
+            return
+        plug_id = str(plug.id)
+        with self._lock:
+            plug_responses = self._get_plug_responses(
+                plug_id, ChatEngineCache.get_version(plug), create=True)
+            plug_responses.entries[self.normalize_question(question)] = CachedResponse(
+                question, answer, embedding)
+            while len(plug_responses.entries) > self.max_size:
+                plug_responses.entries.popitem(last=False)
+            plug_responses.matrix = None
+            self._get_stats(plug_id)["stores"] += 1
+
+    def invalidate(self, plug_id):
+        with self._lock:
+            if self._plugs.pop(str(plug_id), None) is not None:
+                self._get_stats(str(plug_id))["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            plugs = {}
+            for plug_id, stats in self._stats.items():
+                lookups = stats["hits"] + stats["misses"]
+                plug_responses = self._plugs.get(plug_id)
+                plugs[plug_id] = {
+                    **stats,
+                    "size": len(plug_responses.entries) if plug_responses else 0,
+                    "hitRate": round(stats["hits"] / lookups, 4) if lookups else 0,
+                }
+            hits = sum(stats["hits"] for stats in self._stats.values())
+            lookups = hits + sum(stats["misses"] for stats in self._stats.values())
+            return {
+                "size": sum(len(plug_responses.entries) for plug_responses in self._plugs.values()),
+                "maxSize": self.max_size,
+                "ttl": self.ttl,
+                "similarity": self.similarity,
+                "hits": hits,
+                "misses": lookups - hits,
+                "hitRate": round(hits / lookups, 4) if lookups else 0,
+                "plugs": plugs,
+            }
+
+
+def stream_cached_answer(answer):
+    # word by word, like the streamed completion
+    for token in re.findall(r"\s*\S+\s*", answer):
+        yield token
+
+
+response_cache = ResponseCache(
+    similarity=RESPONSE_CACHE_SIMILARITY, max_size=RESPONSE_CACHE_SIZE,
+    max_plugs=RESPONSE_CACHE_PLUGS, ttl=RESPONSE_CACHE_TTL)
@@ -0,0 +1,340 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import text
+from llama_index.indices.struct_store import SQLTableRetrieverQueryEngine
+from llama_index.response.schema import Response
+from src.config.config import SQL_PLAN_CACHE_SIZE, SQL_PLAN_CACHE_PLUGS, SQL_PLAN_CACHE_TTL
+
+# identifiers ("..." or `...`) are skipped, group 1 is a string literal, group 2 a number
+SQL_TOKEN_PATTERN = re.compile(
+    r'"(?:[^"]|"")*"|`[^`]*`|(\'(?:[^\']|\'\')*\')|(?<![\w.])(\d+(?:\.\d+)?)(?![\w.])')
+# templates need this many fixed words, so a question made of a literal only can't match anything
+MIN_TEMPLATE_WORDS = 2
+# longest value a text slot binds
+TEXT_SLOT_MAX_LENGTH = 64
+QUOTES = "\"'"
+
+
+def normalize_question(question):
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ")
+
+
+def find_unique(question, value, number=False):
+    """Span of value in the question when it occurs exactly once as whole words, else None."""
+    # 12 isn't a match in 12.5
+    boundary = r"[\w.]" if number else r"\w"
+    matches = list(re.finditer(
+        f"(?<!{boundary}){re.escape(value)}(?!{boundary})", question))
+    if len(matches) != 1:
+        return None
+    return matches[0].span()
+
+
+def get_slot_pattern(question, start, end, kind):
+    """
+    Capture group of a slot. Text slots take a quoted value or as many words as the value they
+    were made from, so "price of iphone" doesn't bind "the most expensive item" as a name.
+    """
+    if kind == "number":
+        return r"(\d+(?:\.\d+)?)"
+    before = question[start - 1] if start > 0 else ""
+    if before and before in QUOTES and question[end:end + 1] == before:
+        # the quotes are fixed text around the slot
+        return "([^" + re.escape(QUOTES) + "]+)"
+    word = r"[^\s" + re.escape(QUOTES) + r"]+"
+    words = len(question[start:end].split())
+    return "(" + word + (r"\s+" + word) * (words - 1) + ")"
+
+
+def to_number(value):
+    return float(value) if "." in value else int(value)
+
+
+def render_sql(sql, params):
+    """The SQL with its parameters written as literals, for the response synthesis prompt."""
+    def render(match):
+        value = params[match.group(1)]
+        if isinstance(value, str):
+            return "'" + value.replace("'", "''") + "'"
+        return str(value)
+    return re.sub(r":(p\d+)\b", render, sql)
+
+
+class SQLPlan:
+    """
+    Text-to-SQL result turned into a parameterised plan: the literals of the SQL that come from the
+    question are bound parameters, and the question is a template whose matching parts (slots)
+    give their new values.
+    """
+
+    def __init__(self, template, pattern, sql, params, slot_count):
+        self.template = template
+        self.pattern = pattern
+        self.sql = sql
+        # parameter name -> (slot, kind, format of the value, e.g. "%{0}%" in a LIKE)
+        self.params = params
+        self.slot_count = slot_count
+        self.createdAt = time.monotonic()
+        self.hits = 0
+
+    @classmethod
+    def from_query(cls, question, sql):
+        """Plan of a generated query, None when the question is too generic to be a template."""
+        question = normalize_question(question)
+        slots = []
+        params = {}
+        sql_parts = []
+        position = 0
+
+        def add_slot(span, kind):
+            for index, (slot_span, slot_kind) in enumerate(slots):
+                if slot_span == span and slot_kind == kind:
+                    return index
+                if span[0] < slot_span[1] and slot_span[0] < span[1]:
+                    return None
+            slots.append((span, kind))
+            return len(slots) - 1
+
+        for match in SQL_TOKEN_PATTERN.finditer(sql):
+            string_literal, number = match.groups()
+            if string_literal is not None:
+                value = string_literal[1:-1].replace("''", "'")
+                core = value.strip("%_")
+                span = find_unique(question, core) if core else None
+                slot = add_slot(span, "text") if span else None
+                if slot is None:
+                    continue
+                prefix, suffix = value.split(core, 1)
+                value_format = prefix.replace("{", "{{").replace("}", "}}") + \
+                    "{}" + suffix.replace("{", "{{").replace("}", "}}")
+            elif number is not None:
+                span = find_unique(question, number, number=True)
+                slot = add_slot(span, "number") if span else None
+                if slot is None:
+                    continue
+                value_format = None
+            else:
+                continue
+            name = f"p{len(params)}"
+            params[name] = (slot, "text" if string_literal is not None else "number", value_format)
+            sql_parts.append(sql[position:match.start()])
+            sql_parts.append(f":{name}")
+            position = match.end()
+        sql_parts.append(sql[position:])
+
+        # the question with its slots as capture groups, fixed words are matched case-insensitively
+        pattern_parts = []
+        template_parts = []
+        fixed_words = 0
+        position = 0
+        ordered_slots = sorted(enumerate(slots), key=lambda slot: slot[1][0])
+        group_slots = []
+        for slot, ((start, end), kind) in ordered_slots:
+            fixed = question[position:start]
+            fixed_words += len(fixed.split())
+            pattern_parts.append(r"\s+".join(re.escape(word) for word in fixed.split(" ")))
+            pattern_parts.append(get_slot_pattern(question, start, end, kind))
+            template_parts.append(fixed + "{" + str(slot) + "}")
+            group_slots.append(slot)
+            position = end
+        fixed = question[position:]
+        fixed_words += len(fixed.split())
+        pattern_parts.append(r"\s+".join(re.escape(word) for word in fixed.split(" ")))
+        template_parts.append(fixed)
+
+        if fixed_words < MIN_TEMPLATE_WORDS:
+            return None
+        pattern = re.compile("".join(pattern_parts), re.IGNORECASE)
+        # capture groups are numbered in question order, slots in SQL order
+        params = {name: (group_slots.index(slot), kind, value_format)
+                  for name, (slot, kind, value_format) in params.items()}
+        return cls("".join(template_parts).lower(), pattern, "".join(sql_parts), params, len(slots))
+
+    def bind(self, question):
+        """Parameters of the plan for the question, None when it doesn't match the template."""
+        match = self.pattern.fullmatch(normalize_question(question))
+        if match is None:
+            return None
+        values = match.groups()
+        params = {}
+        for name, (group, kind, value_format) in self.params.items():
+            value = values[group].strip()
+            if not value or len(value) > TEXT_SLOT_MAX_LENGTH:
+                return None
+            params[name] = to_number(value) if kind == "number" else value_format.format(value)
+        return params
+
+
+class PlugPlans:
+    def __init__(self, version):
+        self.version = version
+        self.plans = OrderedDict()
+
+
+class SQLPlanCache:
+    """
+    Process-local cache of text-to-SQL plans per plug, keyed by the plug's table-schema version
+    (Plug.contextVersion, bumped when a table is re-imported or removed) and the question template.
+    A hit runs the stored SQL with the question's literals bound, without the SQL-generation call.
+    """
+
+    def __init__(self, max_size=64, max_plugs=256, ttl=3600):
+        self.max_size = max_size
+        self.max_plugs = max_plugs
+        self.ttl = ttl
+        self._plugs = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.uncacheable = 0
+        self.invalidations = 0
+
+    def _is_expired(self, plan):
+        return self.ttl > 0 and time.monotonic() - plan.createdAt > self.ttl
+
+    def _get_plug_plans(self, plug_id, version):
+        # called with the lock held, plans of a former schema version are dropped
+        plug_plans = self._plugs.get(plug_id)
+        if plug_plans is not None and plug_plans.version < version:
+            del self._plugs[plug_id]
+            self.invalidations += 1
+            plug_plans = None
+        return plug_plans
+
+    def lookup(self, plug_id, version, question):
+        """Plan matching the question and its bound parameters, (None, None) on a miss."""
+        plug_id = str(plug_id)
+        with self._lock:
+            plug_plans = self._get_plug_plans(plug_id, version)
+            if plug_plans is not None and plug_plans.version != version:
+                # components built before the last re-import
+                plug_plans = None
+            # exact questions (no slots) before templates
+            candidates = sorted(plug_plans.plans.values(),
+                                key=lambda plan: plan.slot_count) if plug_plans else []
+            for plan in candidates:
+                if self._is_expired(plan):
+                    del plug_plans.plans[plan.template]
+                    continue
+                params = plan.bind(question)
+                if params is not None:
+                    plug_plans.plans.move_to_end(plan.template)
+                    self._plugs.move_to_end(plug_id)
+                    plan.hits += 1
+                    self.hits += 1
+                    return plan, params
+            self.misses += 1
+        return None, None
+
+    def store(self, plug_id, version, question, sql):
+        plan = SQLPlan.from_query(question, sql)
+        with self._lock:
+            if plan is None:
+                self.uncacheable += 1
+                return None
+            plug_id = str(plug_id)
+            plug_plans = self._get_plug_plans(plug_id, version)
+            if plug_plans is None:
+                plug_plans = self._plugs[plug_id] = PlugPlans(version)
+            elif plug_plans.version != version:
+                return None
+            plug_plans.plans[plan.template] = plan
+            plug_plans.plans.move_to_end(plan.template)
+            self._plugs.move_to_end(plug_id)
+            self.stores += 1
+            while len(plug_plans.plans) > self.max_size:
+                plug_plans.plans.popitem(last=False)
+            while len(self._plugs) > self.max_plugs:
+                self._plugs.popitem(last=False)
+        return plan
+
+    def discard(self, plug_id, plan):
+        with self._lock:
+            plug_plans = self._plugs.get(str(plug_id))
+            if plug_plans is not None:
+                plug_plans.plans.pop(plan.template, None)
+
+    def invalidate(self, plug_id):
+        with self._lock:
+            if self._plugs.pop(str(plug_id), None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "plugs": len(self._plugs),
+                "plans": sum(len(plug_plans.plans) for plug_plans in self._plugs.values()),
+                "maxSize": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "uncacheable": self.uncacheable,
+                "invalidations": self.invalidations,
+                "hitRate": round(self.hits / lookups, 4) if lookups else 0,
+            }
+
+
+class CachedSQLTableRetrieverQueryEngine(SQLTableRetrieverQueryEngine):
+    """SQLTableRetrieverQueryEngine whose generated queries are reused through an SQLPlanCache."""
+
+    def __init__(self, *args, plan_cache=None, plug_id=None, schema_version=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._plan_cache = plan_cache or sql_plan_cache
+        self._plug_id = plug_id
+        self._schema_version = schema_version
+
+    def _run_sql(self, sql, params):
+        # same result format as SQLDatabase.run_sql, with bound parameters
+        with self._sql_database.engine.connect() as connection:
+            cursor = connection.execute(text(sql), params)
+            if cursor.returns_rows:
+                result = cursor.fetchall()
+                return str(result), {"result": result}
+        return "", {}
+
+    def _generate(self, query_bundle):
+        response = super()._query(query_bundle)
+        # only queries that ran are stored
+        self._plan_cache.store(self._plug_id, self._schema_version,
+                               query_bundle.query_str, response.metadata["sql_query"])
+        return response
+
+    def _query(self, query_bundle):
+        plan, params = self._plan_cache.lookup(
+            self._plug_id, self._schema_version, query_bundle.query_str)
+        if plan is None:
+            return self._generate(query_bundle)
+
+        try:
+            raw_response_str, metadata = self._run_sql(plan.sql, params)
+        except Exception as e:
+            print("Cached SQL plan failed", str(e))
+            self._plan_cache.discard(self._plug_id, plan)
+            return super()._query(query_bundle)
+        if not metadata.get("result"):
+            # a value the plan doesn't fit (or no such rows): the SQL is generated for the question,
+            # its plan replaces this one when they share the template
+            return self._generate(query_bundle)
+        sql_query_str = render_sql(plan.sql, params)
+        metadata["sql_query"] = sql_query_str
+        metadata["sql_plan"] = plan.template
+
+        if self._synthesize_response:
+            response_str = self._service_context.llm_predictor.predict(
+                self._response_synthesis_prompt,
+                query_str=query_bundle.query_str,
+                sql_query=sql_query_str,
+                sql_response_str=raw_response_str,
+            )
+        else:
+            response_str = raw_response_str
+        return Response(response=response_str, metadata=metadata)
+
+
+sql_plan_cache = SQLPlanCache(
+    max_size=SQL_PLAN_CACHE_SIZE, max_plugs=SQL_PLAN_CACHE_PLUGS, ttl=SQL_PLAN_CACHE_TTL)
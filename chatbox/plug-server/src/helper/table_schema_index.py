@@ -0,0 +1,67 @@
+from llama_index import VectorStoreIndex
+from llama_index.vector_stores import ChromaVectorStore
+from llama_index.objects import SQLTableNodeMapping, ObjectIndex
+from src.database.chromadb import ChromaClient
+
+
+def describe_column_stats(stats):
+    """Column statistics of an imported table (ContextItem.columnStats) for the text-to-SQL prompt."""
+    descriptions = []
+    for column_stats in stats:
+        details = [column_stats["type"]]
+        if column_stats["unique"]:
+            details.append("unique")
+        else:
+            details.append(f'{column_stats["distinct"]} distinct values')
+        if column_stats["indexed"]:
+            details.append("indexed")
+        if column_stats.get("values"):
+            details.append("values: " + ", ".join(
+                repr(value) for value in column_stats["values"]))
+        elif column_stats["min"] is not None:
+            details.append(
+                f'from {column_stats["min"]!r} to {column_stats["max"]!r}')
+        if column_stats["nulls"]:
+            details.append(f'{column_stats["nulls"]} empty')
+        descriptions.append(f'{column_stats["name"]} ({", ".join(details)})')
+    return "Columns: " + "; ".join(descriptions)
+
+
+def get_table_context(context_str, column_stats):
+    """Context of a table in its schema node, the column statistics help writing the query."""
+    if not column_stats:
+        return context_str
+    return f"{context_str}\n{describe_column_stats(column_stats)}"
+
+
+def load_table_schema_index(chroma_client, connection, plug_id, table_schema_objs, table_names,
+                            service_context=None):
+    """
+    Load the plug's table-schema index from Chroma, embedded by the web server at upload time.
+
+    Tables uploaded before the index existed are embedded here once and stored, ids of tables
+    that no longer belong to the plug (table_names) are dropped.
+    """
+    table_node_mapping = SQLTableNodeMapping(connection)
+    tables_collection = chroma_client.get_or_create_collection(
+        name=ChromaClient.get_table_schema_collection_name(plug_id))
+
+    stored_ids = set(tables_collection.get(include=[])["ids"])
+    stale_ids = [table_id for table_id in stored_ids if table_id not in table_names]
+    if stale_ids:
+        tables_collection.delete(ids=stale_ids)
+
+    vector_store = ChromaVectorStore(chroma_collection=tables_collection)
+    index = VectorStoreIndex.from_vector_store(
+        vector_store=vector_store, service_context=service_context)
+
+    missing_nodes = []
+    for table_schema_obj in table_schema_objs:
+        if table_schema_obj.table_name not in stored_ids:
+            node = table_node_mapping.to_node(table_schema_obj)
+            node.id_ = table_schema_obj.table_name
+            missing_nodes.append(node)
+    if missing_nodes:
+        index.insert_nodes(missing_nodes)
+
+    return ObjectIndex(index, table_node_mapping)
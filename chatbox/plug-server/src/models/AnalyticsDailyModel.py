@@ -0,0 +1,33 @@
+from mongoengine import Document, ObjectIdField, IntField, FloatField, DateTimeField
+
+
+class AnalyticsDaily(Document):
+    """Counters of a client (plug widget) for one UTC day, see src/helper/analytics.py."""
+    clientId = ObjectIdField(required=True)
+    # UTC midnight
+    day = DateTimeField(required=True)
+    # guests first seen that day
+    guests = IntField(default=0)
+    # histories created that day and their summed duration (seconds, last message - creation)
+    conversations = IntField(default=0)
+    duration = FloatField(default=0)
+    messages = IntField(default=0)
+    tokens = IntField(default=0)
+    meta = {
+        "collection": "analyticsDaily",
+        # created by the index migration (src/database/mongodb/indexes.py)
+        'auto_create_index': False,
+        'indexes': [{'fields': ['clientId', 'day'], 'unique': True}]
+    }
+
+    def to_json(self):
+        return {
+            "clientId": str(self.clientId),
+            "day": self.day.timestamp(),
+            "guests": self.guests,
+            "conversations": self.conversations,
+            "duration": self.duration,
+            "averageDuration": self.duration / self.conversations if self.conversations else 0,
+            "messages": self.messages,
+            "tokens": self.tokens,
+        }
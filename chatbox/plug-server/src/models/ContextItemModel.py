@@ -1,4 +1,4 @@
-from mongoengine import Document, StringField, ObjectIdField, IntField, signals, BooleanField, ListField, DateTimeField, BinaryField
+from mongoengine import Document, StringField, ObjectIdField, IntField, signals, BooleanField, ListField, DateTimeField, BinaryField, DictField
 from bson import ObjectId
 import os
 import sys
@@ -10,10 +10,10 @@ root_dir = os.path.abspath(os.path.join(current_dir, '../'))
 sys.path.append(root_dir)
 from database.sqlite import SQLiteConnection
 from database.chromadb import ChromaClient
+from database.sqlite.bm25 import BM25Store
 
 
 chroma_client = ChromaClient()
-sqlite_connection = SQLiteConnection()
 
 class ContextChunk(Document):
     id = ObjectIdField(primary_key=True, required=True, default=ObjectId)
@@ -42,7 +42,21 @@ class ContextItem(Document):
     urls = ListField()
     mapPointUrl = StringField(default=None)
     children = ListField(ObjectIdField())
-    meta = {"collection": "contextItem.files"}
+    # sha256 of the uploaded file, identical re-uploads are skipped
+    contentHash = StringField(default=None)
+    # profile of the imported table's columns (distinct/null counts, min/max, indexed), structured only
+    columnStats = ListField(DictField())
+    meta = {
+        "collection": "contextItem.files",
+        # created by the index migration (src/database/mongodb/indexes.py)
+        'auto_create_index': False,
+        'indexes': [
+            # a plug's (structured) files and their upload status
+            ('plugId', 'isFile', 'structured', 'progress'),
+            # an upload's existing item by file name
+            ('source', 'plugId', 'isFile', 'isParent')
+        ]
+    }
 
     def to_json(self):
         return {
@@ -67,15 +81,40 @@ class ContextItem(Document):
             "children": [str(child) for child in self.children]
         }
 
+    @staticmethod
+    def bump_plug_context_version(plug_id):
+        # Updated through the raw collection, PlugModel imports this module
+        ContextItem._get_db()["plug"].update_one(
+            {"_id": ObjectId(plug_id)}, {"$inc": {"contextVersion": 1}})
+
+    @classmethod
+    def post_save_hook(self, sender, document, **kwargs):
+        # the plug's answers only change once an item is added or done ingesting, not on
+        # progress/map/summary updates
+        if not kwargs.get('created') and not (
+                'progress' in document._get_changed_fields() and document.progress == 100):
+            return
+        try:
+            ContextItem.bump_plug_context_version(document.plugId)
+        except:
+            return
+
     @classmethod
     def post_delete_hook(self, sender, document, **kwargs):
         if kwargs.get('deleted', True):
             try:
+                ContextItem.bump_plug_context_version(document.plugId)
                 if document.structured:
                     table_name = SQLiteConnection.format_table_name(
                         document.source)
-                    SQLiteConnection.delete_tables_by_name(
-                        sqlite_connection, f'{document.plugId}/{table_name}')
+                    sqlite_pool = SQLiteConnection.get_pool(document.plugId, create=False)
+                    if sqlite_pool is not None:
+                        SQLiteConnection.delete_tables_by_name(
+                            sqlite_pool, f'{document.plugId}/{table_name}')
+                    tables_collection = chroma_client.get_collection(
+                        name=ChromaClient.get_table_schema_collection_name(document.plugId))
+                    tables_collection.delete(
+                        ids=[f'{document.plugId}/{table_name}'])
                 else:
                     if document.children and document.isParent:
                         ContextItem.objects(id__in=document.children).delete()
@@ -83,11 +122,15 @@ class ContextItem(Document):
                         name=str(document.plugId))
                     chroma_collection.delete(
                         where={"context_id": str(document.id)})
+                    BM25Store().delete_contexts(
+                        document.plugId, [document.id])
                     print(MapItemModel.MapItem.objects(contextBaseId=document.id))
                     MapItemModel.MapItem.objects(contextBaseId=document.id).delete()
             except:
                 return
 
 
+signals.post_save.connect(
+    ContextItem.post_save_hook, sender=ContextItem)
 signals.post_delete.connect(
     ContextItem.post_delete_hook, sender=ContextItem)
\ No newline at end of file
@@ -11,12 +11,15 @@ from HistoryModel import History
 class Guest(Document):
     id = ObjectIdField(primary_key=True, required=True, default=ObjectId)
     createdAt = DateTimeField(
-        required=True, default=datetime.datetime.now(pytz.UTC))
+        required=True, default=lambda: datetime.datetime.now(pytz.UTC))
     ip = StringField(required=True)
     client = ObjectIdField(required=True)
     meta = {
         "collection": "guest",
-        'indexes': ['client']
+        # created by the index migration (src/database/mongodb/indexes.py)
+        'auto_create_index': False,
+        # a client's guest by ip, a client's guests newest first
+        'indexes': [('client', 'ip'), ('client', '-id')]
     }
 
     def to_json(self):
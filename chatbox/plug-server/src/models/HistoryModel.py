@@ -11,13 +11,18 @@ from MessageModel import Message
 class History(Document):
     id = ObjectIdField(primary_key=True, required=True, default=ObjectId)
     createdAt = DateTimeField(
-        required=True, default=datetime.datetime.now(pytz.UTC))
+        required=True, default=lambda: datetime.datetime.now(pytz.UTC))
     updatedAt = DateTimeField(
-        required=True, default=datetime.datetime.now(pytz.UTC))
+        required=True, default=lambda: datetime.datetime.now(pytz.UTC))
     guest = ObjectIdField(required=True)
+    # client of the guest, so a client's histories are listed without going through its guests
+    client = ObjectIdField()
     meta = {
         "collection": "history",
-        'indexes': ['guest']
+        # created by the index migration (src/database/mongodb/indexes.py)
+        'auto_create_index': False,
+        # a guest's latest history first, a client's histories newest first
+        'indexes': [('guest', '-id'), ('client', '-id')]
     }
 
     def to_json(self):
@@ -26,6 +31,7 @@ class History(Document):
             "createdAt": self.createdAt.timestamp(),
             "updatedAt": self.updatedAt.timestamp(),
             "guest": str(self.guest),
+            "client": str(self.client) if self.client else None,
         }
 
     @classmethod
@@ -0,0 +1,52 @@
+import datetime
+import pytz
+from mongoengine import Document, StringField, ObjectIdField, IntField, DateTimeField, DictField
+
+INGESTION_KINDS = ["file", "website", "api", "dom"]
+INGESTION_STATUSES = ["queued", "running", "succeeded", "failed"]
+
+
+class IngestionJob(Document):
+    contextItemId = ObjectIdField(required=True)
+    plugId = ObjectIdField(required=True)
+    userId = ObjectIdField(required=True)
+    kind = StringField(required=True, choices=INGESTION_KINDS)
+    status = StringField(required=True, default="queued",
+                         choices=INGESTION_STATUSES)
+    # kind specific input, e.g. file suffix, crawl url or the api/dom documents
+    payload = DictField(default=dict)
+    attempts = IntField(default=0)
+    error = StringField(default=None)
+    # checkpoints, a retried job resumes after the last completed step
+    apifyRunId = StringField(default=None)
+    documentCount = IntField(default=0)
+    # chunks whose content hash was already stored for the plug, not embedded again
+    reusedDocuments = IntField(default=0)
+    embeddedBatches = IntField(default=0)
+    progress = IntField(default=0)
+    createdAt = DateTimeField(
+        required=True, default=lambda: datetime.datetime.now(pytz.UTC))
+    updatedAt = DateTimeField(
+        required=True, default=lambda: datetime.datetime.now(pytz.UTC))
+    meta = {
+        "collection": "ingestionJob",
+        'indexes': ['contextItemId', ('userId', 'status')]
+    }
+
+    def to_json(self):
+        return {
+            "id": str(self.pk),
+            "contextItemId": str(self.contextItemId),
+            "plugId": str(self.plugId),
+            "userId": str(self.userId),
+            "kind": self.kind,
+            "status": self.status,
+            "attempts": self.attempts,
+            "error": self.error,
+            "documentCount": self.documentCount,
+            "reusedDocuments": self.reusedDocuments,
+            "embeddedBatches": self.embeddedBatches,
+            "progress": self.progress,
+            "createdAt": self.createdAt.timestamp(),
+            "updatedAt": self.updatedAt.timestamp(),
+        }
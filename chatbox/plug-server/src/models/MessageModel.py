@@ -14,10 +14,15 @@ class Message(Document):
     content = StringField(required=True)
     role = StringField(required=True, choices=ROLES, message="Invalid role")
     history = ObjectIdField(required=True)
-    createdAt = DateTimeField(required=True, default=datetime.datetime.now(pytz.UTC))
+    # client of the history, the text index is scoped by it
+    client = ObjectIdField()
+    createdAt = DateTimeField(required=True, default=lambda: datetime.datetime.now(pytz.UTC))
     meta = {
         "collection": "message",
-        'indexes': ['history', 'content']
+        # created by the index migration (src/database/mongodb/indexes.py)
+        'auto_create_index': False,
+        # a history's messages in order, a client's messages by words (no language, no stemming)
+        'indexes': [('history', 'id'), {'fields': ['client', '$content'], 'default_language': 'none'}]
     }
     
     def to_json(self):
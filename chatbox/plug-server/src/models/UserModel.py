@@ -52,7 +52,13 @@ class User(Document):
     userKeys = EmbeddedDocumentListField(UserKey, default=[UserKey(active=True, isDefault=True)])
     stripeCustomerId = StringField(default=None)
     subExpiredAt = DateTimeField()
-    meta = {"collection": "user"}
+    meta = {
+        "collection": "user",
+        # created by the index migration (src/database/mongodb/indexes.py)
+        'auto_create_index': False,
+        # users without a stripe customer aren't indexed
+        'indexes': [{'fields': ['stripeCustomerId'], 'sparse': True}]
+    }
 
     def to_json(self):
         return {
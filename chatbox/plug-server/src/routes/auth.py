@@ -1,5 +1,5 @@
 from flask import Blueprint, request, current_app, Response
-from src.models import User, Plug
+from src.models import User
 from src.constants.http_status_codes import (
     HTTP_200_OK, HTTP_404_NOT_FOUND, HTTP_500_INTERNAL_SERVER_ERROR, HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED
 )
@@ -10,6 +10,7 @@ from flask_jwt_extended import jwt_required, create_access_token, create_refresh
 from jwt import decode
 import validators
 from src.config.config import URL_PATH
+from src.helper.plug_cache import plug_cache
 from datetime import timedelta, datetime
 
 auth = Blueprint("auth", __name__, url_prefix=f"{URL_PATH}/plug/api/v1/auth")
@@ -28,7 +29,7 @@ def login():
 
         if not client_key:
             return {"code": 400, "message": "Invalid client key"}, HTTP_200_OK
-        plug = Plug.objects(client__key=client_key).first()
+        plug = plug_cache.get(client_key)
         if not plug:
             return {"code": 404, "message": "Plug not found"}, HTTP_404_NOT_FOUND
         if len(password) == 0 or password is None or len(email) == 0 or email is None:
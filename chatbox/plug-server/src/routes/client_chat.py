@@ -4,26 +4,23 @@ import os
 import datetime
 from flask import Blueprint, request, current_app, Response
 from mongoengine import ValidationError
-from src.models import Message, Plug, Guest, History, ContextItem, User
-from src.database.sqlite import SQLiteConnection
-from llama_index.indices.struct_store import SQLTableRetrieverQueryEngine
+from src.models import Message, Guest, History, ContextItem, User
 from src.constants.http_status_codes import (
     HTTP_200_OK, HTTP_404_NOT_FOUND, HTTP_500_INTERNAL_SERVER_ERROR, HTTP_403_FORBIDDEN, HTTP_400_BAD_REQUEST
 )
 from src.helper import get_token_counter, get_qa_prompt, get_root_url
-from llama_index import VectorStoreIndex, ServiceContext
+from src.helper.chat_engine_cache import chat_engine_cache, build_chat_components
+from src.helper.plug_cache import plug_cache
+from src.helper.conversation import conversation_sessions, message_writer
+from src.helper.token_usage import token_usage_ledger
+from src.helper.analytics import analytics_rollup
+from src.helper.response_cache import response_cache, stream_cached_answer
 from llama_index.tools import ToolMetadata, RetrieverTool, QueryEngineTool
-from llama_index.vector_stores import ChromaVectorStore
 from llama_index.agent import OpenAIAgent
 from llama_index.llms import ChatMessage, OpenAI
 from llama_index.chat_engine.simple import SimpleChatEngine
 from bson import ObjectId
-from src.config.config import URL_PATH
-from llama_index.objects import (
-    SQLTableNodeMapping,
-    ObjectIndex,
-    SQLTableSchema,
-)
+from src.config.config import URL_PATH, RESPONSE_CACHE_ENABLED
 from src.tools.order_tool import OrderTool
 
 client_chat = Blueprint("client_chat", __name__,
@@ -33,6 +30,33 @@ flask_env = os.environ.get("FLASK_ENV")
 MODELS = {"GPT4": "gpt-4", "GPT3.5": "gpt-4"}
 
 
+def get_chat_components(plug):
+    def build():
+        chat_components = build_chat_components(
+            plug, current_app.config['CHROMA_CLIENT'], sql_model="gpt-4")
+
+        # create tools for agent
+        chat_components.tools = [
+            RetrieverTool(
+                retriever=chat_components.retriever,
+                metadata=ToolMetadata(
+                    name="context_information",
+                    description="Useful for retrieving context information in general, always use if unsure"
+                    "Must use a detailed question as input to the tool.",
+                )
+            ),
+            OrderTool(
+                metadata=ToolMetadata(
+                    name="order_tool",
+                    description="Use this tool to help user order products, adding products to user's cart order.",
+                )
+            ),
+        ]
+        return chat_components
+
+    return chat_engine_cache.get_or_create(plug, build, namespace="client_chat")
+
+
 @client_chat.post("/follow_up")
 def create_follow_ups():
     try:
@@ -44,7 +68,7 @@ def create_follow_ups():
         if not data:
             return {"code": 400, "message": "Invalid message"}, HTTP_200_OK
 
-        plug = Plug.objects(client__key=client_key).first()
+        plug = plug_cache.get(client_key)
         if not plug:
             return {"code": 404, "message": "Plug not found"}, HTTP_404_NOT_FOUND
 
@@ -77,12 +101,8 @@ def create_follow_ups():
             """,
         ))
 
-        plug.token += (token_counter.total_llm_token_count +
-                       token_counter.total_embedding_token_count)
-
-        client.token += (token_counter.total_llm_token_count +
-                         token_counter.total_embedding_token_count)
-        plug.save()
+        token_usage_ledger.record(plug.id, token_counter, model="gpt-4",
+                                  client_id=client.id, source="client_chat_follow_up")
 
         return {
             "code": 200,
@@ -99,6 +119,8 @@ def create_follow_ups():
 def chat_complete_no_history():
     try:
         client_key = request.headers.get('clientKey')
+        # returned by /history, widgets without one are found by their ip
+        session_token = request.headers.get('sessionToken')
         body = request.json
         data = body.get("message", None)
         history = body.get("history", None)
@@ -113,7 +135,7 @@ def chat_complete_no_history():
         if not body:
             return {"code": 400, "message": "Invalid message"}, HTTP_200_OK
 
-        plug = Plug.objects(client__key=client_key).first()
+        plug = plug_cache.get(client_key)
         if not plug:
             return {"code": 404, "message": "Plug not found"}, HTTP_404_NOT_FOUND
 
@@ -130,68 +152,6 @@ def chat_complete_no_history():
         # setup token counter
         token_counter = get_token_counter(plug)
 
-        # create index
-        chroma_client = current_app.config['CHROMA_CLIENT']
-        chroma_collection = chroma_client.get_collection(name=str(plug.id))
-        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-        index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
-
-        # get custom prompt template for agent
-        vector_retriever = index.as_retriever(similarity_top_k=1)
-        connection = current_app.config['SQLITE_CONNECTION']
-        table_node_mapping = SQLTableNodeMapping(connection)
-        table_schema_objs = []
-        context_strs = []
-
-        structured_context_items = ContextItem.objects(
-            plugId=plug.id, isFile=True, structured=True, progress=100)
-
-        for item in structured_context_items:
-            table_schema_objs.append(SQLTableSchema(
-                table_name=f"{str(plug.id)}/{SQLiteConnection.format_table_name(item.source)}", context_str=item.contextString))
-            context_strs.append(item.contextString)
-
-        obj_index = ObjectIndex.from_objects(
-            table_schema_objs,
-            table_node_mapping,
-            VectorStoreIndex,
-        )
-
-        llm = OpenAI(model="gpt-4")
-        service_context = ServiceContext.from_defaults(llm=llm)
-        query_engine = SQLTableRetrieverQueryEngine(
-            connection, obj_index.as_retriever(similarity_top_k=1), service_context=service_context
-        )
-
-        # create tools for agent
-        tools = [
-            RetrieverTool(
-                retriever=vector_retriever,
-                metadata=ToolMetadata(
-                    name="context_information",
-                    description="Useful for retrieving context information in general, always use if unsure"
-                    "Must use a detailed question as input to the tool.",
-                )
-            ),
-            OrderTool(
-                metadata=ToolMetadata(
-                    name="order_tool",
-                    description="Use this tool to help user order products, adding products to user's cart order.",
-                )
-            ),
-        ]
-
-        # create agent
-        llm = OpenAI(model=plug.model, temperature=0.3,
-                     api_key=plug.userKey if plug.userKey else None)
-        context_agent = OpenAIAgent.from_tools(
-            tools=tools,
-            max_function_calls=len(tools),
-            llm=llm,
-            verbose=True,
-            system_prompt=plug.prompt,
-        )
-
         chat_history = []
 
         if history:
@@ -202,9 +162,36 @@ def chat_complete_no_history():
                     content=message.get('content')
                 ))
 
-        # chat with agent
-        response = context_agent.stream_chat(data, chat_history=chat_history)
-        response_gen = response.response_gen
+        # answers depend on the conversation, only its first question is looked up
+        use_response_cache = RESPONSE_CACHE_ENABLED and not chat_history
+        cached_answer = None
+        if use_response_cache:
+            query_embedding = response_cache.embed(data)
+            cached_answer = response_cache.lookup(plug, query_embedding)
+
+        if cached_answer is not None:
+            response_gen = stream_cached_answer(cached_answer)
+            sources = []
+        else:
+            # get cached index, query engine and tools
+            chat_components = get_chat_components(plug)
+
+            # create agent
+            llm = OpenAI(model=plug.model, temperature=0.3,
+                         api_key=plug.userKey if plug.userKey else None)
+            context_agent = OpenAIAgent.from_tools(
+                tools=chat_components.tools,
+                max_function_calls=len(chat_components.tools),
+                llm=llm,
+                verbose=True,
+                system_prompt=plug.prompt,
+            )
+
+            # chat with agent
+            response = context_agent.stream_chat(
+                data, chat_history=chat_history)
+            response_gen = response.response_gen
+            sources = response.sources
 
         has_feature = current_app.config['SAVE_CONVERSATION'] in plug.features
 
@@ -214,30 +201,28 @@ def chat_complete_no_history():
                 yield token
                 response_text += token
 
-            tokens = token_counter.total_llm_token_count + \
-                token_counter.total_embedding_token_count
+            # update mongo db, plug/client tokens and plug.updatedAt are flushed in batches
+            token_usage_ledger.record(plug.id, token_counter, model=plug.model,
+                                      client_id=client.id, source="client_chat")
 
-            # update mongo db
-            plug.updatedAt = datetime.datetime.now(pytz.UTC)
-            plug.token += tokens
-            client.token += tokens
-            plug.save()
+            if use_response_cache and cached_answer is None and response_cache.is_cacheable(sources):
+                response_cache.store(plug, data, query_embedding, response_text)
 
             if has_feature:
-                guest = Guest.objects(client=ObjectId(
-                    client.id), ip=client_ip).first()
-                print(guest)
-                if guest:
-                    history = History.objects(guest=ObjectId(
-                        guest.id)).order_by('-id').first()
-
-                    history.updatedAt = datetime.datetime.now(pytz.UTC)
-
-                    Message.objects.insert([Message(content=data, role="user", history=history.id, createdAt=datetime.datetime.now(pytz.UTC)),
-                                            Message(content=response_text, role='assistant', history=history.id, createdAt=datetime.datetime.now(pytz.UTC))])
-
-
-                    history.save()
+                session = conversation_sessions.get(
+                    session_token, client.id) if session_token else None
+                if session is None:
+                    session = conversation_sessions.find(client.id, client_ip)
+                if session:
+                    now = datetime.datetime.now(pytz.UTC)
+                    # inserted in batches, the history's updatedAt with them
+                    message_writer.record(session.historyId, session.clientId,
+                                          [("user", data), ("assistant", response_text)], now)
+
+                    # the conversation lasts until its last message, counted on the day it started
+                    duration = conversation_sessions.touch(session, now)
+                    analytics_rollup.record(client.id, now, messages=2)
+                    analytics_rollup.record(client.id, session.createdAt, duration=duration)
 
         response = Response(generate_response(), content_type='text/plain')
         response.headers['X-Accel-Buffering'] = 'no'
@@ -261,7 +246,7 @@ def create_history():
         if not client_key:
             return {"code": 400, "message": "Invalid client key"}, HTTP_200_OK
 
-        plug = Plug.objects(client__key=client_key).first()
+        plug = plug_cache.get(client_key)
         if not plug:
             return {"code": 404, "message": "Plug not found"}, HTTP_404_NOT_FOUND
 
@@ -283,18 +268,26 @@ def create_history():
                 history = History.objects(
                     guest=guest.id).order_by('-id').first()
                 if history:
-                    messages = Message.objects(history=history.id)
+                    messages = message_writer.has_pending(history.id) or Message.objects(
+                        history=history.id).only('id').first()
                     if not messages:
-                        return {"code": 400, "message": "Empty history already exists"}, HTTP_400_BAD_REQUEST
-                History(guest=guest.id).save()
+                        return {
+                            "code": 400,
+                            "message": "Empty history already exists",
+                            "data": {"sessionToken": conversation_sessions.create_token(history, client.id)}
+                        }, HTTP_400_BAD_REQUEST
+                history = History(guest=guest.id, client=guest.client).save()
             else:
                 guest = Guest(client=ObjectId(client.id), ip=client_ip).save()
-                History(guest=guest.id).save()
+                analytics_rollup.record(guest.client, guest.createdAt, guests=1)
+                history = History(guest=guest.id, client=guest.client).save()
+            analytics_rollup.record(history.client, history.createdAt, conversations=1)
         else:
             return {"code": 400, "message": "This plug doesn't have that feature"}, HTTP_400_BAD_REQUEST
         return {
             "code": 200,
             "message": "Created history successfully.",
+            "data": {"sessionToken": conversation_sessions.create_token(history, client.id)}
         }, HTTP_200_OK
     except ValidationError as e:
         return {"code": 400, "message": "Validation error", "error": str(e)}, HTTP_200_OK
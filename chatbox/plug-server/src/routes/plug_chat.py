@@ -5,34 +5,89 @@ from src.constants.http_status_codes import (
     HTTP_200_OK, HTTP_404_NOT_FOUND, HTTP_500_INTERNAL_SERVER_ERROR, HTTP_400_BAD_REQUEST
 )
 import datetime
-from src.helper import get_token_counter, get_qa_prompt
-from src.database.sqlite import SQLiteConnection
-from llama_index import VectorStoreIndex, ServiceContext
+from src.helper import get_token_counter, get_qa_prompt, role_restrict
+from src.helper.chat_engine_cache import chat_engine_cache, build_chat_components
+from src.helper.sql_plan_cache import sql_plan_cache
+from src.helper.response_cache import response_cache
+from src.helper.plug_cache import plug_cache
+from src.helper.conversation import conversation_sessions
+from src.helper.token_usage import token_usage_ledger
 from llama_index.tools import ToolMetadata, RetrieverTool, QueryEngineTool
-from llama_index.indices.struct_store import SQLTableRetrieverQueryEngine
-from llama_index.vector_stores import ChromaVectorStore
 from llama_index.agent import OpenAIAgent
 from llama_index.llms import ChatMessage, OpenAI
 from llama_index.chat_engine.simple import SimpleChatEngine
-from llama_index.objects import (
-    SQLTableNodeMapping,
-    ObjectIndex,
-    SQLTableSchema,
-)
 import json
+import logging
 import pytz
 import os
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from src.config.config import URL_PATH
+from src.config.config import URL_PATH, ADMIN
 from src.tools.order_tool import OrderTool
 
 plug_chat = Blueprint("plug_chat", __name__,
                       url_prefix=f"{URL_PATH}/plug/api/v1/plug_chat")
 flask_env = os.environ.get("FLASK_ENV")
+logger = logging.getLogger(__name__)
 
 MODELS = {"GPT4": "gpt-4", "GPT3.5": "gpt-4"}
 
 
+def get_chat_components(plug):
+    def build():
+        chat_components = build_chat_components(
+            plug, current_app.config['CHROMA_CLIENT'], sql_model="gpt-4o")
+
+        # create tools for agent
+        chat_components.tools = [
+            RetrieverTool(
+                retriever=chat_components.retriever,
+                metadata=ToolMetadata(
+                    name="context_information",
+                    description="Useful for retrieving product informations in the store, always use if unsure"
+                    "Must use a detailed question as input to the tool.",
+                )
+            ),
+            OrderTool(
+                metadata=ToolMetadata(
+                    name="context_information",
+                    description="Use this tool to help user order, adding products to user's cart order.",
+                )
+            ),
+        ]
+        return chat_components
+
+    return chat_engine_cache.get_or_create(plug, build, namespace="plug_chat")
+
+
+def get_iframe_chat_components(plug):
+    def build():
+        chat_components = build_chat_components(
+            plug, current_app.config['CHROMA_CLIENT'], sql_model="gpt-4")
+
+        # create tools for agent
+        chat_components.tools = [
+            RetrieverTool(
+                retriever=chat_components.retriever,
+                metadata=ToolMetadata(
+                    name="context_information",
+                    description="Useful for retrieving context information in general"
+                                "Must use a detailed question as input to the tool.",
+                )
+            ),
+            QueryEngineTool(
+                query_engine=chat_components.query_engine,
+                metadata=ToolMetadata(
+                    name="context_information_tabular",
+                    description=f"Useful for retrieving specific context about these entities: {chat_components.context_strs}"
+                                "Must use a detailed question as input to the tool.",
+                )
+            ),
+        ]
+        return chat_components
+
+    return chat_engine_cache.get_or_create(plug, build, namespace="plug_chat_iframe")
+
+
 @plug_chat.post("/follow_up")
 @jwt_required()
 def create_follow_ups():
@@ -72,9 +127,8 @@ def create_follow_ups():
             """,
         ))
 
-        plug.token += (token_counter.total_llm_token_count +
-                       token_counter.total_embedding_token_count)
-        plug.save()
+        token_usage_ledger.record(
+            plug.id, token_counter, model=plug.model, source="plug_chat_follow_up")
 
         return {
             "code": 200,
@@ -112,57 +166,9 @@ def chat_complete():
         # setup token counter
         token_counter = get_token_counter(plug)
 
-        # create index
-        chroma_client = current_app.config['CHROMA_CLIENT']
-
-        chroma_collection = chroma_client.get_collection(name=str(plug.id))
-        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-        index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
-
-        # get custom prompt template for agent
-        vector_retriever = index.as_retriever(similarity_top_k=1)
-        connection = current_app.config['SQLITE_CONNECTION']
-        table_node_mapping = SQLTableNodeMapping(connection)
-        table_schema_objs = []
-        context_strs = []
-
-        structured_context_items = ContextItem.objects(
-            plugId=plug_id, isFile=True, structured=True, progress=100)
-
-        for item in structured_context_items:
-            table_schema_objs.append(SQLTableSchema(
-                table_name=f"{str(plug_id)}/{SQLiteConnection.format_table_name(item.source)}", context_str=item.contextString))
-            context_strs.append(item.contextString)
-
-        obj_index = ObjectIndex.from_objects(
-            table_schema_objs,
-            table_node_mapping,
-            VectorStoreIndex,
-        )
-
-        llm = OpenAI(model="gpt-4o")
-        service_context = ServiceContext.from_defaults(llm=llm)
-        query_engine = SQLTableRetrieverQueryEngine(
-            connection, obj_index.as_retriever(similarity_top_k=1), service_context=service_context
-        )
+        # get cached index, query engine and tools
+        chat_components = get_chat_components(plug)
 
-        # create tools for agent
-        tools = [
-            RetrieverTool(
-                retriever=vector_retriever,
-                metadata=ToolMetadata(
-                    name="context_information",
-                    description="Useful for retrieving product informations in the store, always use if unsure"
-                    "Must use a detailed question as input to the tool.",
-                )
-            ),
-            OrderTool(
-                metadata=ToolMetadata(
-                    name="context_information",
-                    description="Use this tool to help user order, adding products to user's cart order.",
-                )
-            ),
-        ]
         # create agent
         llm = OpenAI(model=plug.model, temperature=0.3,
                      api_key=plug.userKey if plug.userKey else None)
@@ -170,8 +176,8 @@ def chat_complete():
         #              api_key=plug.userKey if plug.userKey else None)
 
         context_agent = OpenAIAgent.from_tools(
-            tools=tools,
-            max_function_calls=len(tools),
+            tools=chat_components.tools,
+            max_function_calls=len(chat_components.tools),
             llm=llm,
             # verbose=True if flask_env == "development" else False,
             verbose=True,
@@ -196,12 +202,9 @@ def chat_complete():
             for token in response_gen:
                 yield token
 
-            # update mongo db
-            plug.updatedAt = datetime.datetime.now(pytz.UTC)
-            plug.token += (token_counter.total_llm_token_count +
-                           token_counter.total_embedding_token_count)
-
-            plug.save()
+            # update mongo db, plug.token and plug.updatedAt are flushed in batches
+            token_usage_ledger.record(
+                plug.id, token_counter, model=plug.model, source="plug_chat")
 
         response = Response(generate_response(), content_type='text/plain')
         response.headers['X-Accel-Buffering'] = 'no'
@@ -237,66 +240,14 @@ def chat_complete_iframe():
             # setup token counter
             token_counter = get_token_counter(plug)
 
-            # create index
-            chroma_client = current_app.config['CHROMA_CLIENT']
-            chroma_collection = chroma_client.get_collection(name=str(plug.id))
-            vector_store = ChromaVectorStore(
-                chroma_collection=chroma_collection)
-            index = VectorStoreIndex.from_vector_store(
-                vector_store=vector_store)
-
-            # get custom prompt template for agent
-            vector_retriever = index.as_retriever(similarity_top_k=1)
-            connection = current_app.config['SQLITE_CONNECTION']
-            table_node_mapping = SQLTableNodeMapping(connection)
-            table_schema_objs = []
-            context_strs = []
-
-            structured_context_items = ContextItem.objects(
-                plugId=plug_id, isFile=True, structured=True, progress=100)
-
-            for item in structured_context_items:
-                table_schema_objs.append(SQLTableSchema(
-                    table_name=f"{plug_id}/{SQLiteConnection.format_table_name(item.source)}",
-                    context_str=item.contextString))
-                context_strs.append(item.contextString)
-
-            obj_index = ObjectIndex.from_objects(
-                table_schema_objs,
-                table_node_mapping,
-                VectorStoreIndex,
-            )
-
-            llm = OpenAI(model="gpt-4")
-            service_context = ServiceContext.from_defaults(llm=llm)
-            query_engine = SQLTableRetrieverQueryEngine(
-                connection, obj_index.as_retriever(similarity_top_k=1), service_context=service_context
-            )
-
-            # create tools for agent
-            tools = [
-                RetrieverTool(
-                    retriever=vector_retriever,
-                    metadata=ToolMetadata(
-                        name="context_information",
-                        description="Useful for retrieving context information in general"
-                                    "Must use a detailed question as input to the tool.",
-                    )
-                ),
-                QueryEngineTool(
-                    query_engine=query_engine,
-                    metadata=ToolMetadata(
-                        name="context_information_tabular",
-                        description=f"Useful for retrieving specific context about these entities: {context_strs}"
-                                    "Must use a detailed question as input to the tool.",
-                    )
-                ),
-            ]
+            # get cached index, query engine and tools
+            chat_components = get_iframe_chat_components(plug)
+    
             # create agent
             llm = OpenAI(model=plug.model, temperature=0.3)
             context_agent = OpenAIAgent.from_tools(
-                tools=tools,
-                max_function_calls=len(tools),
+                tools=chat_components.tools,
+                max_function_calls=len(chat_components.tools),
                 llm=llm,
                 verbose=True if flask_env == "development" else False,
                 system_prompt=plug.prompt
@@ -306,7 +257,7 @@ def chat_complete_iframe():
 
             # chat with agent
             response = context_agent.chat(query)
-            print(str(response))
+            logger.debug("Iframe answer: %s", response)
             response_dict = json.loads(str(response))
             user_mess = Message(
                 role="user",
@@ -316,7 +267,6 @@ def chat_complete_iframe():
                 role=response_dict.get('role'),
                 content=response_dict.get('content')
             )
-            print(response_dict)
             res.append(user_mess)
             res.append(chat_message)
         return {
@@ -328,3 +278,19 @@ def chat_complete_iframe():
         return {"code": 400, "message": "Validation error", "error": str(e)}, HTTP_200_OK
     except Exception as e:
         return {"code": 500, "message": "Failed to complete chat", "error": str(e)}, HTTP_500_INTERNAL_SERVER_ERROR
+
+
+@plug_chat.get("/cache/stats")
+@role_restrict(ADMIN)
+def get_cache_stats():
+    return {
+        "code": 200,
+        "message": "Cache stats retrieved successfully.",
+        "data": {
+            "chatEngine": chat_engine_cache.stats(),
+            "sqlPlan": sql_plan_cache.stats(),
+            "response": response_cache.stats(),
+            "plug": plug_cache.stats(),
+            "conversationSession": conversation_sessions.stats(),
+        },
+    }, HTTP_200_OK
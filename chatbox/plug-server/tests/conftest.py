@@ -0,0 +1,23 @@
+import os
+import sys
+import tempfile
+import types
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault("FLASK_ENV", "development")
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("CHROMA_URL_DOCKER", "your_chromadb_url")
+# never the server's own databases
+os.environ["SQLITE_DB_PATH"] = tempfile.mkdtemp(prefix="sqlite-")
+os.environ["CHROMA_DB_PATH"] = tempfile.mkdtemp(prefix="chroma-")
+
+# the models add their paths relative to the working directory, like the server is run
+os.chdir(SERVER_DIR)
+sys.path.insert(0, SERVER_DIR)
+
+# src/__init__.py builds the whole app (every route, chroma, nomic...), the modules under test
+# are imported without it
+src = types.ModuleType("src")
+src.__path__ = [os.path.join(SERVER_DIR, "src")]
+sys.modules.setdefault("src", src)
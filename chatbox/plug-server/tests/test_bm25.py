@@ -0,0 +1,147 @@
+import math
+
+import pytest
+from llama_index.indices.base_retriever import BaseRetriever
+from llama_index.indices.query.schema import QueryBundle
+from llama_index.schema import NodeWithScore, TextNode
+
+from src.database.sqlite.bm25 import BM25Store, tokenize
+from src.helper.custom_retriever import BM25Index, CustomBM25Retriever, HybridRetriever
+
+DOCUMENTS = {
+    "a": "The return policy allows returns within 30 days",
+    "b": "Shipping is free for orders over 50 dollars",
+    "c": "Returns of opened items are refunded as store credit, returns are free",
+}
+
+
+def make_node(doc_id, text, context_id="context"):
+    return TextNode(id_=doc_id, text=text, metadata={"context_id": context_id})
+
+
+@pytest.fixture
+def plug_id(request):
+    # the store is one file for every plug
+    return request.node.name
+
+
+@pytest.fixture
+def store(plug_id):
+    bm25_store = BM25Store()
+    bm25_store.add_documents(plug_id, [make_node(doc_id, text)
+                                       for doc_id, text in DOCUMENTS.items()])
+    return bm25_store
+
+
+class FakeCollection:
+    def __init__(self, texts):
+        self.texts = texts
+
+    def get(self, ids=None, include=None):
+        ids = [doc_id for doc_id in ids if doc_id in self.texts]
+        return {"ids": ids, "documents": [self.texts[doc_id] for doc_id in ids],
+                "metadatas": [{} for _ in ids]}
+
+
+class FixedRetriever(BaseRetriever):
+    def __init__(self, node_ids):
+        self.node_ids = node_ids
+
+    def _retrieve(self, query_bundle):
+        return [NodeWithScore(node=TextNode(id_=node_id, text=node_id), score=1.0)
+                for node_id in self.node_ids]
+
+
+def bm25_score(query, doc_id, k1=1.5, b=0.75):
+    documents = {key: tokenize(text) for key, text in DOCUMENTS.items()}
+    avg_length = sum(len(tokens) for tokens in documents.values()) / len(documents)
+    score = 0.0
+    for term in set(tokenize(query)):
+        doc_freq = sum(term in tokens for tokens in documents.values())
+        tf = documents[doc_id].count(term)
+        if not tf:
+            continue
+        idf = math.log((len(documents) - doc_freq + 0.5) / (doc_freq + 0.5) + 1)
+        score += idf * tf * (k1 + 1) / (
+            tf + k1 * (1 - b + b * len(documents[doc_id]) / avg_length))
+    return score
+
+
+def test_tokenize_drops_stop_words_and_case():
+    assert tokenize("The Return policy, of 30 days") == [
+        "return", "policy", "30", "days"]
+
+
+def test_store_loads_the_postings_of_one_plug(store, plug_id):
+    doc_ids, doc_lengths, postings = store.load(plug_id)
+
+    assert sorted(doc_ids) == ["a", "b", "c"]
+    assert doc_lengths[doc_ids.index("c")] == len(tokenize(DOCUMENTS["c"]))
+    assert sorted(postings["returns"]) == sorted(
+        [(doc_ids.index("a"), 1), (doc_ids.index("c"), 2)])
+    assert store.load(f"{plug_id}-other") == ([], [], {})
+
+
+def test_store_deletes_documents_and_contexts(store, plug_id):
+    store.add_documents(plug_id, [make_node("d", "free returns", "other")])
+    store.delete_documents(plug_id, ["a"])
+    assert store.count(plug_id) == 3
+
+    store.delete_contexts(plug_id, ["other"])
+    doc_ids, _, postings = store.load(plug_id)
+    assert sorted(doc_ids) == ["b", "c"]
+    assert postings["returns"] == [(doc_ids.index("c"), 2)]
+
+
+def test_readded_document_replaces_its_postings(store, plug_id):
+    store.add_documents(plug_id, [make_node("a", "gift cards")])
+
+    doc_ids, _, postings = store.load(plug_id)
+    assert "policy" not in postings
+    assert postings["gift"] == [(doc_ids.index("a"), 1)]
+
+
+def test_top_k_matches_okapi_bm25(store, plug_id):
+    index = BM25Index.from_store(store, plug_id)
+    query = "free returns policy"
+
+    results = index.top_k(query, 3)
+    assert [doc_id for doc_id, _ in results] == sorted(
+        DOCUMENTS, key=lambda doc_id: -bm25_score(query, doc_id))
+    for doc_id, score in results:
+        assert score == pytest.approx(bm25_score(query, doc_id), rel=1e-5)
+
+
+def test_top_k_only_returns_matching_documents(store, plug_id):
+    index = BM25Index.from_store(store, plug_id)
+
+    assert [doc_id for doc_id, _ in index.top_k("shipping", 3)] == ["b"]
+    assert index.top_k("warranty", 3) == []
+    assert len(index.top_k("free returns", 1)) == 1
+
+
+def test_empty_index():
+    index = BM25Index([], [], {})
+
+    assert len(index) == 0
+    assert index.top_k("returns", 3) == []
+
+
+def test_bm25_retriever_skips_documents_removed_from_chroma(store, plug_id):
+    texts = {doc_id: text for doc_id, text in DOCUMENTS.items() if doc_id != "c"}
+    retriever = CustomBM25Retriever(plug_id, BM25Index.from_store(store, plug_id),
+                                    FakeCollection(texts), similarity_top_k=3)
+
+    results = retriever.retrieve(QueryBundle("returns"))
+    assert [result.node.node_id for result in results] == ["a"]
+    assert results[0].node.get_content() == DOCUMENTS["a"]
+
+
+def test_hybrid_retriever_fuses_ranks():
+    retriever = HybridRetriever(
+        [FixedRetriever(["a", "b", "c"]), FixedRetriever(["c", "d"])],
+        similarity_top_k=2, rrf_k=60)
+
+    results = retriever.retrieve(QueryBundle("returns"))
+    assert [result.node.node_id for result in results] == ["c", "a"]
+    assert results[0].score == pytest.approx(1 / 63 + 1 / 61)
@@ -0,0 +1,104 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from src.helper.response_cache import ResponseCache, stream_cached_answer
+
+
+def make_plug(plug_id="plug", context_version=0):
+    return SimpleNamespace(id=plug_id, contextVersion=context_version, model="gpt-4",
+                           userKey=None, prompt="", features=[])
+
+
+def unit(*values):
+    embedding = np.asarray(values, dtype=np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+
+def test_near_duplicate_question_is_answered_from_the_cache():
+    cache = ResponseCache(similarity=0.95)
+    plug = make_plug()
+    cache.store(plug, "What are your opening hours?", unit(1, 0, 0), "9 to 5")
+
+    assert cache.lookup(plug, unit(1, 0.1, 0)) == "9 to 5"
+    assert cache.lookup(plug, unit(0, 1, 0)) is None
+    assert cache.stats()["plugs"]["plug"]["hits"] == 1
+    assert cache.stats()["plugs"]["plug"]["misses"] == 1
+
+
+def test_answers_are_kept_per_plug():
+    cache = ResponseCache()
+    cache.store(make_plug("a"), "hours?", unit(1, 0), "9 to 5")
+
+    assert cache.lookup(make_plug("b"), unit(1, 0)) is None
+
+
+def test_context_change_invalidates_the_answers():
+    cache = ResponseCache()
+    cache.store(make_plug(), "hours?", unit(1, 0), "9 to 5")
+
+    assert cache.lookup(make_plug(context_version=1), unit(1, 0)) is None
+    assert cache.lookup(make_plug(), unit(1, 0)) is None
+    assert cache.stats()["plugs"]["plug"]["invalidations"] == 1
+
+
+def test_invalidate_drops_the_plug():
+    cache = ResponseCache()
+    plug = make_plug()
+    cache.store(plug, "hours?", unit(1, 0), "9 to 5")
+    cache.invalidate(plug.id)
+
+    assert cache.lookup(plug, unit(1, 0)) is None
+
+
+def test_least_recently_used_answer_is_evicted():
+    cache = ResponseCache(max_size=2)
+    plug = make_plug()
+    cache.store(plug, "first", unit(1, 0, 0), "1")
+    cache.store(plug, "second", unit(0, 1, 0), "2")
+    assert cache.lookup(plug, unit(1, 0, 0)) == "1"
+    cache.store(plug, "third", unit(0, 0, 1), "3")
+
+    assert cache.lookup(plug, unit(0, 1, 0)) is None
+    assert cache.lookup(plug, unit(1, 0, 0)) == "1"
+    assert cache.lookup(plug, unit(0, 0, 1)) == "3"
+
+
+def test_same_question_replaces_its_answer():
+    cache = ResponseCache()
+    plug = make_plug()
+    cache.store(plug, "Hours?", unit(1, 0), "9 to 5")
+    cache.store(plug, "  hours? ", unit(1, 0), "8 to 4")
+
+    assert cache.lookup(plug, unit(1, 0)) == "8 to 4"
+    assert cache.stats()["size"] == 1
+
+
+def test_empty_answer_is_not_stored():
+    cache = ResponseCache()
+    cache.store(make_plug(), "hours?", unit(1, 0), "  ")
+
+    assert cache.stats()["size"] == 0
+
+
+def test_expired_answer_is_a_miss():
+    cache = ResponseCache(ttl=60)
+    plug = make_plug()
+    cache.store(plug, "hours?", unit(1, 0), "9 to 5")
+    entry = next(iter(cache._plugs["plug"].entries.values()))
+    entry.createdAt -= 61
+
+    assert cache.lookup(plug, unit(1, 0)) is None
+
+
+def test_cacheable_only_with_context_sources():
+    context = SimpleNamespace(tool_name="context_information")
+    order = SimpleNamespace(tool_name="order_tool")
+
+    assert ResponseCache.is_cacheable([context])
+    assert not ResponseCache.is_cacheable([context, order])
+
+
+def test_cached_answer_is_streamed_word_by_word():
+    assert list(stream_cached_answer("Open from 9 to 5.")) == [
+        "Open ", "from ", "9 ", "to ", "5."]
@@ -0,0 +1,101 @@
+from src.helper.sql_plan_cache import SQLPlan, SQLPlanCache, TEXT_SLOT_MAX_LENGTH, render_sql
+
+PRICE_QUESTION = "What is the price of iPhone 15?"
+PRICE_SQL = "SELECT price FROM products WHERE name = 'iPhone 15'"
+LIKE_QUESTION = 'Which products contain "phone"'
+LIKE_SQL = "SELECT name FROM products WHERE name LIKE '%phone%'"
+
+
+def test_text_literal_becomes_a_slot():
+    plan = SQLPlan.from_query(PRICE_QUESTION, PRICE_SQL)
+
+    assert plan.template == "what is the price of {0}"
+    assert plan.sql == "SELECT price FROM products WHERE name = :p0"
+    assert plan.bind("what is the price of  Galaxy S23 ?") == {"p0": "Galaxy S23"}
+
+
+def test_text_slot_binds_as_many_words_as_its_value():
+    plan = SQLPlan.from_query(PRICE_QUESTION, PRICE_SQL)
+
+    assert plan.bind("What is the price of the most expensive item") is None
+
+
+def test_number_literals_bind_in_sql_order():
+    plan = SQLPlan.from_query(
+        "How many orders over 100 dollars in 2023?",
+        "SELECT COUNT(*) FROM orders WHERE year = 2023 AND total > 100")
+
+    assert plan.sql == "SELECT COUNT(*) FROM orders WHERE year = :p0 AND total > :p1"
+    assert plan.bind("how many orders over 12.5 dollars in 2021") == {
+        "p0": 2021, "p1": 12.5}
+    assert plan.bind("how many orders over many dollars in 2021") is None
+
+
+def test_like_pattern_keeps_its_wildcards():
+    plan = SQLPlan.from_query(LIKE_QUESTION, LIKE_SQL)
+
+    params = plan.bind('which products contain "smart watch"')
+    assert params == {"p0": "%smart watch%"}
+    assert render_sql(plan.sql, params) == \
+        "SELECT name FROM products WHERE name LIKE '%smart watch%'"
+
+
+def test_text_slot_longer_than_the_limit_is_rejected():
+    plan = SQLPlan.from_query(LIKE_QUESTION, LIKE_SQL)
+
+    longest = "x" * TEXT_SLOT_MAX_LENGTH
+    assert plan.bind(f'which products contain "{longest}"') == {
+        "p0": f"%{longest}%"}
+    assert plan.bind(f'which products contain "{longest}x"') is None
+
+
+def test_literals_not_in_the_question_stay_in_the_sql():
+    plan = SQLPlan.from_query(
+        "List all products", "SELECT * FROM products LIMIT 10")
+
+    assert plan.sql == "SELECT * FROM products LIMIT 10"
+    assert plan.bind("list all products") == {}
+    assert plan.bind("list all orders") is None
+
+
+def test_question_made_of_a_literal_is_not_a_template():
+    assert SQLPlan.from_query(
+        "iPhone 15", "SELECT * FROM products WHERE name = 'iPhone 15'") is None
+
+
+def test_cache_lookup_binds_the_stored_plan():
+    cache = SQLPlanCache()
+    cache.store("plug", 1, PRICE_QUESTION, PRICE_SQL)
+
+    plan, params = cache.lookup("plug", 1, "what is the price of Pixel 8")
+    assert plan.sql == "SELECT price FROM products WHERE name = :p0"
+    assert params == {"p0": "Pixel 8"}
+    assert cache.lookup("other plug", 1, PRICE_QUESTION) == (None, None)
+    assert cache.stats()["hits"] == 1
+
+
+def test_new_schema_version_drops_the_plans():
+    cache = SQLPlanCache()
+    cache.store("plug", 1, PRICE_QUESTION, PRICE_SQL)
+
+    assert cache.lookup("plug", 2, PRICE_QUESTION) == (None, None)
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_former_schema_version_is_not_stored():
+    cache = SQLPlanCache()
+    cache.store("plug", 2, PRICE_QUESTION, PRICE_SQL)
+
+    # a component built before the re-import
+    assert cache.store("plug", 1, LIKE_QUESTION, LIKE_SQL) is None
+    assert cache.lookup("plug", 1, PRICE_QUESTION) == (None, None)
+    assert cache.lookup("plug", 2, PRICE_QUESTION)[0] is not None
+
+
+def test_plans_are_evicted_past_max_size():
+    cache = SQLPlanCache(max_size=1)
+    cache.store("plug", 1, PRICE_QUESTION, PRICE_SQL)
+    cache.store("plug", 1, LIKE_QUESTION, LIKE_SQL)
+
+    assert cache.lookup("plug", 1, PRICE_QUESTION) == (None, None)
+    assert cache.lookup("plug", 1, LIKE_QUESTION)[0] is not None
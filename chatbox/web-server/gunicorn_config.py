@@ -25,3 +25,14 @@ forwarded_allow_ips = "*"
 raw_env = ["FLASK_ENV=production"]
 
 threads = 2
+
+
+def post_fork(server, worker):
+    # with preload_app the Socket.IO client manager is created in the master, give each worker
+    # its own pub/sub host id so callbacks of emits are routed back to the right worker
+    import uuid
+    from src.routes.ws import socketio
+
+    manager = socketio.server.manager
+    if hasattr(manager, "host_id"):
+        manager.host_id = uuid.uuid4().hex
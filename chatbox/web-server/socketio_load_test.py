@@ -0,0 +1,132 @@
+"""
+Socket.IO fan-out load test.
+
+M dashboards connect round-robin to N web workers over websocket only (no sticky sessions) and
+join their own room, P emit-only publishers (like the ingestion workers) then emit events for
+every room. Each event must reach its dashboard whichever worker it is connected to, through
+the message queue.
+
+    # N local workers in this process over the in-process queue
+    python socketio_load_test.py --workers 4 --dashboards 200 --events 20
+    # deployed workers sharing a redis queue
+    python socketio_load_test.py --queue redis://localhost:6379/0 --url http://10.0.0.1:8001 --url http://10.0.0.2:8001
+"""
+import argparse
+import statistics
+import threading
+import time
+from collections import Counter
+
+import socketio as socketio_client
+from flask import Flask
+from flask_socketio import SocketIO, join_room
+
+from src.helper.socketio_manager import get_client_manager
+from src.routes.ws import path as socketio_path
+
+EVENT = "context_item_upload"
+
+
+def start_workers(count, port, queue):
+    urls = []
+    for index in range(count):
+        app = Flask(f"worker-{index}")
+        server = SocketIO(app, path=socketio_path, async_mode="gevent",
+                          client_manager=get_client_manager(queue))
+
+        @server.on("join")
+        def join(data):
+            join_room(data["user_id"])
+
+        threading.Thread(target=server.run, args=(app,), kwargs={"port": port + index},
+                         daemon=True).start()
+        urls.append(f"http://127.0.0.1:{port + index}")
+    time.sleep(1)
+    return urls
+
+
+def connect_dashboards(count, urls, received, lock):
+    dashboards = []
+    for index in range(count):
+        room = f"load-test-{index}"
+        client = socketio_client.Client(reconnection=False)
+
+        def on_event(data, room=room):
+            latency = time.time() - data["sentAt"]
+            with lock:
+                received.append((room, data["seq"], latency))
+
+        client.on(EVENT, on_event)
+        client.connect(urls[index % len(urls)], transports=["websocket"],
+                       socketio_path=socketio_path)
+        client.emit("join", {"user_id": room})
+        dashboards.append(client)
+    # joins are handled asynchronously by the workers
+    time.sleep(1)
+    return dashboards
+
+
+def publish(queue, rooms, events):
+    manager = get_client_manager(queue, write_only=True)
+    for seq in range(events):
+        for room in rooms:
+            manager.emit(EVENT, {"id": room, "seq": seq, "progress": seq, "sentAt": time.time()},
+                         namespace="/", room=room)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4,
+                        help="local workers to start, ignored with --url")
+    parser.add_argument("--url", action="append",
+                        help="url of a running web worker, repeatable")
+    parser.add_argument("--port", type=int, default=5100,
+                        help="first port of the local workers")
+    parser.add_argument("--queue", default="memory://",
+                        help="message queue shared by workers and publishers")
+    parser.add_argument("--dashboards", type=int, default=100)
+    parser.add_argument("--publishers", type=int, default=2)
+    parser.add_argument("--events", type=int, default=10,
+                        help="events per dashboard")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    urls = args.url or start_workers(args.workers, args.port, args.queue)
+
+    received = []
+    lock = threading.Lock()
+    dashboards = connect_dashboards(args.dashboards, urls, received, lock)
+    rooms = [f"load-test-{index}" for index in range(args.dashboards)]
+    expected = args.dashboards * args.events
+
+    started = time.time()
+    publishers = [threading.Thread(target=publish, args=(args.queue, rooms[index::args.publishers], args.events))
+                  for index in range(args.publishers)]
+    for publisher in publishers:
+        publisher.start()
+    for publisher in publishers:
+        publisher.join()
+    while len(received) < expected and time.time() - started < args.timeout:
+        time.sleep(0.1)
+    elapsed = time.time() - started
+
+    for dashboard in dashboards:
+        dashboard.disconnect()
+
+    with lock:
+        latencies = sorted(latency for _, _, latency in received)
+        per_room = Counter(room for room, _, _ in received)
+    duplicates = len(received) - len(set((room, seq) for room, seq, _ in received))
+
+    print(f"workers: {len(urls)}, dashboards: {args.dashboards}, publishers: {args.publishers}")
+    print(f"delivered {len(received)}/{expected} events in {elapsed:.2f}s "
+          f"({len(received) / elapsed:.0f} events/s), {duplicates} duplicates")
+    print(f"dashboards missing events: {sum(1 for room in rooms if per_room[room] < args.events)}")
+    if latencies:
+        print(f"latency p50 {statistics.median(latencies) * 1000:.1f}ms, "
+              f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms, "
+              f"max {latencies[-1] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
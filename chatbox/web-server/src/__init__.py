@@ -2,10 +2,11 @@ from gevent import monkey
 monkey.patch_all()
 from src.constants.http_status_codes import HTTP_401_UNAUTHORIZED
 from src.database.chromadb import ChromaClient
-from src.database.sqlite import SQLiteConnection
+from src.helper import init_token_counting, clear_token_counter
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
 import src.database.mongodb as mongo
+from src.database.mongodb.indexes import check_indexes
 from src.routes import (
     live_demo,
     auth,
@@ -19,7 +20,7 @@ from src.routes import (
     context_base,
     image,
     subscription,
-    socketio,
+    init_socketio,
     user,
     client,
     history,
@@ -44,12 +45,17 @@ def create_app(test_cofig=None):
     # Store the Chroma client in the Flask application context
     app.config['CHROMA_CLIENT'] = chroma_client
 
-    # Create SQLite connection
-    sqlite_connection = SQLiteConnection()
-    # Store the Chroma client in the Flask application context
-    app.config['SQLITE_CONNECTION'] = sqlite_connection
     nomic.login(app.config["NOMIC_API_KEY"])
     mongo.create_db_connection()
+    if app.config.get("MONGO_INDEX_CHECK"):
+        try:
+            check_indexes()
+        except Exception as e:
+            print("Index check failed", str(e))
+
+    # Pre-warm the shared tokenizer and embedding client
+    init_token_counting()
+    app.before_request(clear_token_counter)
 
     CORS(app, resources={
         r"/*": {"origins": ["*"]}}, supports_credentials=True)
@@ -91,6 +97,6 @@ def create_app(test_cofig=None):
     app.register_blueprint(message)
     app.register_blueprint(websocket)
 
-    socketio.init_app(app)
+    init_socketio(app)
 
     return app
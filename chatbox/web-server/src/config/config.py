@@ -83,6 +83,91 @@ COMPANY_CRAWL_WEBSITE = os.environ.get("COMPANY_CRAWL_WEBSITE")
 NOMIC_API_KEY = os.environ.get("NOMIC_API_KEY")
 ROUTE_PARAMETER_ALLOWED = os.environ.get("ROUTE_PARAMETER_ALLOWED")
 
+# TOKEN USAGE LEDGER
+TOKEN_USAGE_FLUSH_INTERVAL = int(os.environ.get(
+    "TOKEN_USAGE_FLUSH_INTERVAL", 5))  # seconds
+TOKEN_USAGE_BATCH_SIZE = int(os.environ.get("TOKEN_USAGE_BATCH_SIZE", 100))
+
+# ANALYTICS ROLLUPS
+# daily counters per client, buffered per worker and applied every interval
+ANALYTICS_FLUSH_INTERVAL = int(os.environ.get(
+    "ANALYTICS_FLUSH_INTERVAL", 5))  # seconds
+
+# INGESTION QUEUE (celery worker, see task.py)
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+INGESTION_WORKER_CONCURRENCY = int(
+    os.environ.get("INGESTION_WORKER_CONCURRENCY", 4))
+INGESTION_MAX_CONCURRENCY_PER_USER = int(
+    os.environ.get("INGESTION_MAX_CONCURRENCY_PER_USER", 2))
+INGESTION_MAX_RETRIES = int(os.environ.get("INGESTION_MAX_RETRIES", 5))
+INGESTION_RETRY_BACKOFF_MAX = int(os.environ.get(
+    "INGESTION_RETRY_BACKOFF_MAX", 600))  # seconds
+# running jobs renew their lease (and user slot) every INGESTION_HEARTBEAT_INTERVAL, the job of a
+# worker that stopped renewing it is taken over by its redelivery once it timed out
+INGESTION_LEASE_TIMEOUT = int(os.environ.get(
+    "INGESTION_LEASE_TIMEOUT", 300))  # seconds
+INGESTION_HEARTBEAT_INTERVAL = int(os.environ.get(
+    "INGESTION_HEARTBEAT_INTERVAL", 60))  # seconds
+# Redis redelivers unacked tasks after this, well above the longest job
+INGESTION_VISIBILITY_TIMEOUT = int(os.environ.get(
+    "INGESTION_VISIBILITY_TIMEOUT", 12 * 3600))  # seconds
+INGESTION_REQUEUE_DELAY = int(os.environ.get(
+    "INGESTION_REQUEUE_DELAY", 10))  # seconds, when the user has no free slot
+
+# SOCKET.IO
+# pub/sub between workers: redis://, memory:// (single process) or a kombu url, empty for none
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE", REDIS_URL)
+# polling needs sticky sessions at the load balancer, "websocket" alone does not
+SOCKETIO_TRANSPORTS = os.environ.get(
+    "SOCKETIO_TRANSPORTS", "polling,websocket").split(",")
+# seconds, progress updates of a context item within this window are emitted as one
+PROGRESS_EMIT_INTERVAL = float(os.environ.get("PROGRESS_EMIT_INTERVAL", 0.25))
+
+# PDF READER
+PDF_READER_PROCESSES = int(os.environ.get(
+    "PDF_READER_PROCESSES", os.cpu_count() or 1))
+PDF_READER_PAGES_PER_TASK = int(os.environ.get("PDF_READER_PAGES_PER_TASK", 8))
+
+# TABULAR IMPORT (csv, excel)
+TABULAR_IMPORT_CHUNK_SIZE = int(
+    os.environ.get("TABULAR_IMPORT_CHUNK_SIZE", 20000))  # rows
+# rows the column types are inferred from
+TABULAR_IMPORT_SAMPLE_ROWS = int(
+    os.environ.get("TABULAR_IMPORT_SAMPLE_ROWS", 1000))
+# secondary indexes created per imported table, besides the row index
+TABULAR_IMPORT_MAX_INDEXES = int(
+    os.environ.get("TABULAR_IMPORT_MAX_INDEXES", 5))
+# distinct values per row a column needs to be indexed (ID-like and unique columns always are)
+TABULAR_INDEX_MIN_SELECTIVITY = float(
+    os.environ.get("TABULAR_INDEX_MIN_SELECTIVITY", 0.01))
+# columns with at most this many distinct values have them listed for the text-to-SQL prompt
+TABULAR_PROFILE_MAX_VALUES = int(
+    os.environ.get("TABULAR_PROFILE_MAX_VALUES", 10))
+
+# MONGO
+# 1 to report missing indexes and the plans of the hot queries at startup
+MONGO_INDEX_CHECK = int(os.environ.get("MONGO_INDEX_CHECK", 1))
+
+# PAGINATION
+# seconds the totals of paginated lists (guests, histories, messages) are cached, approximate meanwhile
+PAGINATION_COUNT_TTL = int(os.environ.get("PAGINATION_COUNT_TTL", 60))
+PAGINATION_COUNT_CACHE_SIZE = int(
+    os.environ.get("PAGINATION_COUNT_CACHE_SIZE", 4096))
+
+# AUTH CONTEXT CACHE
+# seconds a user's identity and entitlements (user, subscription, plugs) are reused by a worker,
+# its own writes invalidate them sooner
+AUTH_CONTEXT_TTL = int(os.environ.get("AUTH_CONTEXT_TTL", 30))
+AUTH_CONTEXT_CACHE_SIZE = int(
+    os.environ.get("AUTH_CONTEXT_CACHE_SIZE", 1024))
+
+# MESSAGE SEARCH (text index of Message.content per client)
+# best matching messages ranked into conversations, totals are approximate past it
+MESSAGE_SEARCH_MAX_MATCHES = int(
+    os.environ.get("MESSAGE_SEARCH_MAX_MATCHES", 1000))
+MESSAGE_SEARCH_SNIPPET_LENGTH = int(
+    os.environ.get("MESSAGE_SEARCH_SNIPPET_LENGTH", 160))  # characters
+
 # URL PATH
 URL_PATH = ""
 DEFAULT_BILLING_CALL_BACK_URL = "http://127.0.0.1:8001/home"
@@ -44,4 +44,9 @@ class ChromaClient:
             if cls._instance is None:
                 cls._instance = chromadb.PersistentClient(
                     path=os.environ.get('CHROMA_DB_PATH'))
-            return cls._instance
\ No newline at end of file
+            return cls._instance
+
+    @staticmethod
+    def get_table_schema_collection_name(plug_id):
+        # embedded schemas of a plug's structured (SQLite) tables, one node per table
+        return f"{plug_id}_tables"
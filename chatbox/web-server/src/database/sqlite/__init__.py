@@ -1,55 +1,148 @@
-import sqlite3
 import os
 import re
+import sqlite3
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
+from .pool import SQLitePool
 
 
 load_dotenv()
 sqlite_path = os.environ.get('SQLITE_DB_PATH')
+# plug files kept open per worker, least recently used ones are closed
+SQLITE_OPEN_SHARDS = int(os.environ.get("SQLITE_OPEN_SHARDS", 64))
 
 
 class SQLiteConnection:
-    _instance = None
+    """
+    Structured tables, one SQLite file per plug in {sqlite_path}/structured. Table names are
+    unchanged ("{plug_id}/{table}"), so the table schemas embedded in Chroma stay valid.
 
-    def __new__(cls):
-        if cls._instance is None:
-            if not os.path.exists(sqlite_path):
-                os.makedirs(sqlite_path)
-            cls._instance = sqlite3.connect(
-                f'{sqlite_path}/structured.sqlite3')
-        return cls._instance
+    Pools of recently used plugs are kept open, tables of a plug that still lives in the former
+    single structured.sqlite3 are copied to its own file the first time the plug is opened.
+    A plug's file is only created by its first write (or that copy), plugs without tables have none.
+    """
+    _pools = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_shard_path(plug_id):
+        return f'{sqlite_path}/structured/{plug_id}.sqlite3'
 
     @staticmethod
-    def delete_tables_sw(connection, starts_with):
-        cursor = connection.cursor()
+    def get_legacy_path():
+        return f'{sqlite_path}/structured.sqlite3'
+
+    @classmethod
+    def get_pool(cls, plug_id, create=True):
+        """Pool of the plug's file, None when create is off and the plug has no tables (no file)."""
+        plug_id = str(plug_id)
+        with cls._lock:
+            pool = cls._pools.get(plug_id)
+            if pool is not None:
+                cls._pools.move_to_end(plug_id)
+                return pool if create or pool.exists() else None
+
+            os.makedirs(f'{sqlite_path}/structured', exist_ok=True)
+            cls.migrate_legacy_tables(plug_id)
+            if not create and not os.path.exists(cls.get_shard_path(plug_id)):
+                return None
+            pool = SQLitePool(cls.get_shard_path(plug_id))
+            cls._pools[plug_id] = pool
+            while len(cls._pools) > SQLITE_OPEN_SHARDS:
+                cls._pools.popitem(last=False)[1].close()
+            return pool
+
+    @classmethod
+    def delete_plug(cls, plug_id):
+        """Drop every table of the plug, by closing and unlinking its file."""
+        plug_id = str(plug_id)
+        with cls._lock:
+            pool = cls._pools.pop(plug_id, None)
+        if pool is not None:
+            pool.close()
+        path = cls.get_shard_path(plug_id)
+        for file_path in (path, f'{path}-wal', f'{path}-shm'):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def migrate_legacy_tables(cls, plug_id):
+        """Copy the plug's tables (and their indexes) from structured.sqlite3 to its own file, once."""
+        path = cls.get_shard_path(plug_id)
+        legacy_path = cls.get_legacy_path()
+        if os.path.exists(path) or not os.path.exists(legacy_path):
+            return
+        # plugs without tables get no file
+        legacy_connection = sqlite3.connect(f'file:{legacy_path}?mode=ro', uri=True)
         try:
-            cursor.execute("BEGIN TRANSACTION;")
-
-            # Find matching tables
-            cursor.execute(
-                "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE ?;", (f'{starts_with}%',))
-            matching_tables = cursor.fetchall()
-            print(matching_tables)
-            # Delete matching tables
-            for table in matching_tables:
-                cursor.execute(f'DROP TABLE IF EXISTS "{table[0]}";')
-
-            # Commit the transaction
-            cursor.execute("COMMIT;")
-        except Exception as e:
-            cursor.execute("ROLLBACK;")
+            has_tables = legacy_connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name LIKE ? LIMIT 1;",
+                (f'{plug_id}/%',)).fetchone() is not None
+        finally:
+            legacy_connection.close()
+        if not has_tables:
+            return
+
+        # written aside and moved in place, a crashed migration is redone on the next open
+        migration_path = f'{path}.{os.getpid()}.migrating'
+        connection = sqlite3.connect(migration_path)
+        try:
+            connection.execute("ATTACH DATABASE ? AS legacy;", (legacy_path,))
+            tables = connection.execute(
+                "SELECT name, sql FROM legacy.sqlite_master WHERE type='table' AND name LIKE ?;",
+                (f'{plug_id}/%',)).fetchall()
+            indexes = connection.execute(
+                "SELECT sql FROM legacy.sqlite_master WHERE type='index' AND sql IS NOT NULL "
+                "AND tbl_name LIKE ?;", (f'{plug_id}/%',)).fetchall()
+            with connection:
+                for name, sql in tables:
+                    sanitized_name = name.replace('"', '""')
+                    connection.execute(sql)
+                    connection.execute(
+                        f'INSERT INTO main."{sanitized_name}" SELECT * FROM legacy."{sanitized_name}";')
+                for (sql,) in indexes:
+                    connection.execute(sql)
+            connection.execute("DETACH DATABASE legacy;")
+        except Exception:
+            connection.close()
+            os.remove(migration_path)
+            raise
+        connection.close()
+        if not os.path.exists(path):
+            os.replace(migration_path, path)
+        else:
+            os.remove(migration_path)
+
+    @classmethod
+    def migrate_legacy_store(cls):
+        """Move every plug out of structured.sqlite3, which is renamed once it has been copied."""
+        legacy_path = cls.get_legacy_path()
+        if not os.path.exists(legacy_path):
+            return []
+        connection = sqlite3.connect(legacy_path)
+        try:
+            plug_ids = sorted({name.split('/', 1)[0] for (name,) in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE '%/%';")})
+        finally:
+            connection.close()
+
+        os.makedirs(f'{sqlite_path}/structured', exist_ok=True)
+        for plug_id in plug_ids:
+            cls.migrate_legacy_tables(plug_id)
+        os.replace(legacy_path, f'{legacy_path}.migrated')
+        return plug_ids
 
     @staticmethod
-    def delete_tables_by_name(connection, name):
-        cursor = connection.cursor()
+    def delete_tables_by_name(pool, name):
         sanitized_name = name.replace('"', '""')
         try:
-            cursor.execute("BEGIN TRANSACTION;")
-            cursor.execute(f'DROP TABLE IF EXISTS "{sanitized_name}";')
-
-            cursor.execute("COMMIT;")
+            pool.write(lambda connection: connection.execute(
+                f'DROP TABLE IF EXISTS "{sanitized_name}";'))
         except Exception as e:
-            cursor.execute("ROLLBACK;")
+            print("Delete table failed", str(e))
 
     @staticmethod
     def format_table_name(name):
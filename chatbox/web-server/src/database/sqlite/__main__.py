@@ -0,0 +1,13 @@
+import argparse
+from src.database.sqlite import SQLiteConnection
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Move every plug's tables out of structured.sqlite3 into its own file.")
+    parser.parse_args()
+
+    plug_ids = SQLiteConnection.migrate_legacy_store()
+    if plug_ids:
+        print(f"Migrated {len(plug_ids)} plugs, {SQLiteConnection.get_legacy_path()} renamed to *.migrated")
+    else:
+        print("Nothing to migrate")
@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+
+load_dotenv()
+sqlite_path = os.environ.get('SQLITE_DB_PATH')
+# embeddings kept in process memory, ~6KB each for ada-002
+EMBEDDING_CACHE_MEMORY_SIZE = int(
+    os.environ.get("EMBEDDING_CACHE_MEMORY_SIZE", 5000))
+# hit rates are logged every this many looked up texts
+EMBEDDING_CACHE_LOG_INTERVAL = int(
+    os.environ.get("EMBEDDING_CACHE_LOG_INTERVAL", 1000))
+# sqlite's default limit of host parameters is 999
+QUERY_BATCH_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+def get_text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Embeddings keyed by (model, sha256 of the text), shared by every plug and by the workers of
+    both servers through one SQLite file, with an in-process LRU in front of it.
+
+    Embeddings are stored as float32, the precision Chroma keeps them in anyway.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            if not os.path.exists(sqlite_path):
+                os.makedirs(sqlite_path)
+            cls._instance = super().__new__(cls)
+            cls._instance.path = f'{sqlite_path}/embedding_cache.sqlite3'
+            cls._instance.memory = OrderedDict()
+            cls._instance.lock = threading.Lock()
+            cls._instance.stats = {"memory_hits": 0,
+                                   "disk_hits": 0, "misses": 0}
+            cls._instance.create_tables()
+        return cls._instance
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def create_tables(self):
+        connection = self.connect()
+        try:
+            # readers don't block the writer of another worker
+            connection.execute("PRAGMA journal_mode=WAL;")
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS embedding_cache ("
+                    "model TEXT NOT NULL, text_hash TEXT NOT NULL, embedding BLOB NOT NULL, "
+                    "created_at REAL NOT NULL, PRIMARY KEY (model, text_hash)) WITHOUT ROWID;")
+        finally:
+            connection.close()
+
+    def _remember(self, key, embedding):
+        with self.lock:
+            self.memory[key] = embedding
+            self.memory.move_to_end(key)
+            while len(self.memory) > EMBEDDING_CACHE_MEMORY_SIZE:
+                self.memory.popitem(last=False)
+
+    def _count(self, memory_hits, disk_hits, misses):
+        with self.lock:
+            lookups_before = sum(self.stats.values())
+            self.stats["memory_hits"] += memory_hits
+            self.stats["disk_hits"] += disk_hits
+            self.stats["misses"] += misses
+            lookups = sum(self.stats.values())
+        if lookups // EMBEDDING_CACHE_LOG_INTERVAL > lookups_before // EMBEDDING_CACHE_LOG_INTERVAL:
+            logger.info("Embedding cache: %s", self.get_stats())
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = sum(stats.values())
+        stats["lookups"] = lookups
+        stats["hit_rate"] = round(
+            (stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+    def get_many(self, model, texts):
+        """Return the cached embedding of each text, None for the ones not cached."""
+        keys = [(model, get_text_hash(text)) for text in texts]
+        embeddings = [None] * len(keys)
+        missing = {}
+        with self.lock:
+            for index, key in enumerate(keys):
+                embedding = self.memory.get(key)
+                if embedding is not None:
+                    self.memory.move_to_end(key)
+                    embeddings[index] = embedding
+                else:
+                    missing.setdefault(key[1], []).append(index)
+        memory_hits = len(keys) - sum(len(indexes)
+                                      for indexes in missing.values())
+
+        disk_hits = 0
+        if missing:
+            text_hashes = list(missing)
+            connection = self.connect()
+            try:
+                for start in range(0, len(text_hashes), QUERY_BATCH_SIZE):
+                    batch = text_hashes[start:start + QUERY_BATCH_SIZE]
+                    rows = connection.execute(
+                        "SELECT text_hash, embedding FROM embedding_cache WHERE model = ? "
+                        f"AND text_hash IN ({', '.join('?' * len(batch))});", [model, *batch])
+                    for text_hash, blob in rows:
+                        embedding = array("f", blob).tolist()
+                        self._remember((model, text_hash), embedding)
+                        for index in missing[text_hash]:
+                            embeddings[index] = embedding
+                        disk_hits += len(missing[text_hash])
+            finally:
+                connection.close()
+
+        self._count(memory_hits, disk_hits, len(keys) - memory_hits - disk_hits)
+        return embeddings
+
+    def put_many(self, model, texts, embeddings):
+        rows = {}
+        for text, embedding in zip(texts, embeddings):
+            text_hash = get_text_hash(text)
+            self._remember((model, text_hash), embedding)
+            rows[text_hash] = array("f", embedding).tobytes()
+        if not rows:
+            return
+
+        now = time.time()
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO embedding_cache (model, text_hash, embedding, created_at) "
+                    "VALUES (?, ?, ?, ?);",
+                    [(model, text_hash, blob, now) for text_hash, blob in rows.items()])
+        finally:
+            connection.close()
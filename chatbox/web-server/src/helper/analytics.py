@@ -0,0 +1,183 @@
+import atexit
+import threading
+import time
+from collections import defaultdict
+import pytz
+from bson import ObjectId
+from pymongo import UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+from src.models import AnalyticsDaily, Guest, History, Message, TokenUsage
+from src.config.config import ANALYTICS_FLUSH_INTERVAL
+
+COUNTERS = ["guests", "conversations", "duration", "messages", "tokens"]
+# bulk writes of the rebuild are sent in batches of this many rows
+REBUILD_BATCH_SIZE = 1000
+
+
+def get_day(at):
+    """UTC midnight of a datetime, naive like the datetimes read from mongo."""
+    if at.tzinfo is not None:
+        at = at.astimezone(pytz.UTC).replace(tzinfo=None)
+    return at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def day_of(field):
+    # aggregation expression of the UTC day of a date field
+    return {"$dateFromParts": {"year": {"$year": field}, "month": {"$month": field},
+                               "day": {"$dayOfMonth": field}}}
+
+
+class AnalyticsRollup:
+    """
+    Per-worker buffer of the daily analytics counters of the clients (AnalyticsDaily).
+
+    Writes of guests, histories, messages and token usage record their deltas here, they're summed
+    per client and day and applied with upserted $inc updates every flush_interval seconds.
+    """
+
+    def __init__(self, flush_interval=5):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._counters = defaultdict(lambda: defaultdict(int))
+        self._flusher = None
+
+    def record(self, client_id, at, **counters):
+        """Add counters (e.g. messages=2) to the client's row of the day of at."""
+        if not client_id:
+            return
+        key = (ObjectId(client_id), get_day(at))
+        with self._lock:
+            row = self._counters[key]
+            for name, value in counters.items():
+                if value:
+                    row[name] += value
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        # started lazily so each forked worker runs its own flusher
+        if self._flusher is None or not self._flusher.is_alive():
+            with self._lock:
+                if self._flusher is None or not self._flusher.is_alive():
+                    self._flusher = threading.Thread(
+                        target=self._run, daemon=True)
+                    self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush_quietly()
+
+    def flush_quietly(self):
+        # failed increments are kept and retried on the next flush
+        try:
+            self.flush()
+        except Exception as e:
+            print("Analytics flush failed", str(e))
+
+    def _restore(self, rows):
+        with self._lock:
+            for key, counters in rows:
+                for name, value in counters.items():
+                    self._counters[key][name] += value
+
+    def flush(self):
+        with self._lock:
+            counters, self._counters = self._counters, defaultdict(
+                lambda: defaultdict(int))
+        rows = [(key, dict(row)) for key, row in counters.items() if row]
+        if not rows:
+            return
+        operations = [UpdateOne({"clientId": client_id, "day": day}, {"$inc": row}, upsert=True)
+                      for (client_id, day), row in rows]
+        try:
+            AnalyticsDaily._get_collection().bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # e.g. two workers upserting the same new row, only the failed ones are retried
+            self._restore([rows[error["index"]]
+                          for error in e.details.get("writeErrors", [])])
+            raise
+        except Exception:
+            self._restore(rows)
+            raise
+
+
+def aggregate_counters(rows, model, match, pipeline):
+    """Add the counters of an aggregation grouped by {client, day} to rows."""
+    for result in model.objects(**match).aggregate(pipeline, allowDiskUse=True):
+        client_id, day = result["_id"].get("client"), result["_id"].get("day")
+        if client_id is None or day is None:
+            continue
+        row = rows[(client_id, day)]
+        for name in COUNTERS:
+            row[name] += result.get(name, 0)
+
+
+def rebuild_analytics(since=None):
+    """
+    Recompute the daily counters from the guests, histories, messages and token usage created
+    from the day of since (every day when None) and replace the rows of these days.
+
+    Deltas buffered by the workers while it runs may be counted twice or not at all, it's meant
+    for the first backfill and a nightly pass over the last days (deletes, lost buffers).
+    """
+    # ids grow with the creation time, the range is read on the _id index (createdAt isn't indexed)
+    match = {"id__gte": ObjectId.from_datetime(get_day(since)),
+             "createdAt__gte": get_day(since)} if since else {}
+    rows = defaultdict(lambda: defaultdict(int))
+
+    aggregate_counters(rows, Guest, match, [
+        {"$group": {"_id": {"client": "$client", "day": day_of("$createdAt")},
+                    "guests": {"$sum": 1}}}
+    ])
+    aggregate_counters(rows, History, match, [
+        {"$group": {"_id": {"client": "$client", "day": day_of("$createdAt")},
+                    "conversations": {"$sum": 1},
+                    "duration": {"$sum": {"$divide": [{"$subtract": ["$updatedAt", "$createdAt"]}, 1000]}}}}
+    ])
+    # messages have no client, their histories of each day are joined once
+    aggregate_counters(rows, Message, match, [
+        {"$group": {"_id": {"history": "$history", "day": day_of("$createdAt")},
+                    "messages": {"$sum": 1}}},
+        {"$lookup": {"from": History._get_collection_name(), "localField": "_id.history",
+                     "foreignField": "_id", "as": "history_doc"}},
+        {"$group": {"_id": {"client": {"$arrayElemAt": ["$history_doc.client", 0]}, "day": "$_id.day"},
+                    "messages": {"$sum": "$messages"}}}
+    ])
+    aggregate_counters(rows, TokenUsage, {**match, "clientId__ne": None}, [
+        {"$group": {"_id": {"client": "$clientId", "day": day_of("$createdAt")},
+                    "tokens": {"$sum": "$totalTokens"}}}
+    ])
+
+    collection = AnalyticsDaily._get_collection()
+    operations = []
+    for (client_id, day), row in rows.items():
+        operations.append(ReplaceOne(
+            {"clientId": client_id, "day": day},
+            {"clientId": client_id, "day": day, **{name: row[name] for name in COUNTERS}},
+            upsert=True))
+        if len(operations) >= REBUILD_BATCH_SIZE:
+            collection.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+
+    # rows of these days nothing counts anymore (deleted guests...)
+    stale = AnalyticsDaily.objects(
+        **({"day__gte": get_day(since)} if since else {})).scalar('id', 'clientId', 'day')
+    stale_ids = [row_id for row_id, client_id, day in stale if (client_id, day) not in rows]
+    for start in range(0, len(stale_ids), REBUILD_BATCH_SIZE):
+        collection.delete_many(
+            {"_id": {"$in": stale_ids[start:start + REBUILD_BATCH_SIZE]}})
+    return len(rows)
+
+
+def get_daily_analytics(client_id, start, end):
+    """The client's rows of the days from start to end (excluded), by day."""
+    return {row.day: row for row in AnalyticsDaily.objects(
+        clientId=ObjectId(client_id), day__gte=get_day(start), day__lt=get_day(end))}
+
+
+analytics_rollup = AnalyticsRollup(flush_interval=ANALYTICS_FLUSH_INTERVAL)
+
+# don't lose the last interval's counters on graceful worker shutdown
+atexit.register(analytics_rollup.flush_quietly)
@@ -135,3 +135,13 @@ class FileReader(BaseReader):
             documents.append(doc)
 
         return documents
+
+    def lazy_load_data(self, input_file, file_suffix, metadata, context_item=None, room=None):
+        """Load data as an iterator of documents, streamed when the file reader supports it."""
+        if file_suffix in self.supported_suffix and file_suffix not in self.file_extractor:
+            self.file_extractor[file_suffix] = DEFAULT_FILE_READER_CLS[file_suffix]()
+        reader = self.file_extractor.get(file_suffix)
+        if reader is not None and hasattr(reader, "lazy_load_data"):
+            return reader.lazy_load_data(
+                input_file, extra_info=metadata, context_item=context_item, room=room)
+        return iter(self.load_data(input_file, file_suffix, metadata, context_item=context_item, room=room))
@@ -0,0 +1,76 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from bson.objectid import ObjectId
+from src.config.config import PAGINATION_COUNT_TTL, PAGINATION_COUNT_CACHE_SIZE
+
+
+class CountCache:
+    """
+    Process-local cache of list totals, e.g. ("message", history_id) -> 120. Totals are approximate
+    for up to ttl seconds, deletes invalidate theirs, inserts (from plug-server) only show after it.
+    """
+
+    def __init__(self, max_size=4096, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, count):
+        """Cached total of key, count() is called (outside the lock) on a miss or once expired."""
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+                self._counts.move_to_end(key)
+                return entry[0]
+        total = count()
+        with self._lock:
+            self._counts[key] = (total, time.monotonic())
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.max_size:
+                self._counts.popitem(last=False)
+        return total
+
+    def invalidate(self, key):
+        with self._lock:
+            self._counts.pop(key, None)
+
+
+def keyset_stages(match, page, page_size, cursor=None, descending=True):
+    """
+    $match/$sort/$skip/$limit of a page ordered by _id. With a cursor (the last id of the previous
+    page) the page starts after it on the index, without one pages are skipped to (page - 1).
+    """
+    if cursor:
+        match = {**match, "_id": {"$lt" if descending else "$gt": ObjectId(cursor)}}
+    stages = [
+        {"$match": match},
+        {"$sort": {"_id": -1 if descending else 1}}
+    ]
+    if not cursor and page > 1:
+        stages.append({"$skip": (page - 1) * page_size})
+    stages.append({"$limit": page_size})
+    return stages
+
+
+def get_next_cursor(items, page_size, key="id"):
+    """Cursor of the page after items, None on the last page."""
+    if len(items) < page_size:
+        return None
+    return str(items[-1][key])
+
+
+def get_page_info(total_items, page, page_size, next_cursor):
+    return {
+        "totalItems": total_items,
+        "totalPages": math.ceil(total_items / page_size),
+        "page": page,
+        "pageSize": page_size,
+        "nextCursor": next_cursor
+    }
+
+
+count_cache = CountCache(
+    max_size=PAGINATION_COUNT_CACHE_SIZE, ttl=PAGINATION_COUNT_TTL)
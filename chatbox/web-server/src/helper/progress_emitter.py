@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+
+# progress values after which no more updates of the item follow (finished, failed)
+FINAL_PROGRESS = (100, -1)
+
+
+class ProgressEmitter:
+    """
+    Per-worker buffer of Socket.IO progress events.
+
+    Updates of the same context item (room, event, id) within flush_interval are coalesced into
+    the latest one, which is emitted with the whole item, as the dashboard expects. Each flush
+    emits one event per pending item, in publish order: every flush_interval seconds, and right
+    away for final updates. Context items are serialized once per flush, so callers may pass the
+    ContextItem itself instead of its to_json().
+    """
+
+    def __init__(self, emit, flush_interval=0.25):
+        self.emit = emit
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # one flush at a time, so an item's updates are emitted in order
+        self._flush_lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._flusher = None
+
+    def publish(self, event, room, context_item=None, **fields):
+        item_id = get_item_id(context_item)
+        # events without an item are never coalesced
+        key = (room, event, item_id if item_id is not None else object())
+        final = fields.get("progress") in FINAL_PROGRESS
+
+        with self._lock:
+            pending_fields = self._pending.pop(key, (None, {}))[1]
+            self._pending[key] = (context_item, {**pending_fields, **fields})
+
+        if final:
+            self.flush_quietly()
+        else:
+            self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        # started lazily so each forked worker runs its own flusher
+        if self._flusher is None or not self._flusher.is_alive():
+            with self._lock:
+                if self._flusher is None or not self._flusher.is_alive():
+                    self._flusher = threading.Thread(
+                        target=self._run, daemon=True)
+                    self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush_quietly()
+
+    def flush_quietly(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print("Progress emit failed", str(e))
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+
+        for (room, event, _), (context_item, fields) in pending.items():
+            self.emit(event, {**serialize_item(context_item), **fields}, to=room)
+
+
+def get_item_id(context_item):
+    if context_item is None:
+        return None
+    if isinstance(context_item, dict):
+        return context_item.get("id")
+    return str(context_item.pk)
+
+
+def serialize_item(context_item):
+    if context_item is None:
+        return {}
+    if isinstance(context_item, dict):
+        return context_item
+    return context_item.to_json()
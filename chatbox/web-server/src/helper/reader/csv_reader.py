@@ -6,10 +6,12 @@ Contains parsers for tabular data files.
 from typing import Any, Dict, List, Optional
 from llama_index.readers.base import BaseReader
 from llama_index.schema import Document
+from src.config.config import TABULAR_IMPORT_CHUNK_SIZE
+from src.helper.tabular_import import clean_chunk, clean_column_names
 from src.routes.ws import progressUpdate
 
+import csv
 import pandas as pd
-import io
 
 
 class CSVReader(BaseReader):
@@ -19,13 +21,38 @@ class CSVReader(BaseReader):
         concat_rows (bool): whether to concatenate all rows into one document.
             If set to False, a Document will be created for each row.
             True by default.
+        chunk_size (int): rows parsed at a time by iter_chunks.
 
     """
 
-    def __init__(self, *args: Any, concat_rows: bool = True, **kwargs: Any) -> None:
+    def __init__(self, *args: Any, concat_rows: bool = True,
+                 chunk_size: int = TABULAR_IMPORT_CHUNK_SIZE, **kwargs: Any) -> None:
         """Init params."""
         super().__init__(*args, **kwargs)
         self._concat_rows = concat_rows
+        self._chunk_size = chunk_size
+
+    def iter_chunks(self, file, size=None):
+        """Parse the file chunk by chunk.
+
+        Cells are parsed as strings by the C parser, their types are inferred when the
+        table is imported (see import_table_chunks).
+
+        Returns:
+            Iterator[Tuple[DataFrame, float]]: cleaned chunks and the fraction of the file read.
+
+        """
+        size = size or getattr(file, "length", None)
+        reader = pd.read_csv(file, engine='c', dtype=str, chunksize=self._chunk_size,
+                             quoting=csv.QUOTE_MINIMAL, encoding='utf-8-sig')
+        with reader:
+            columns = None
+            for chunk in reader:
+                if columns is None:
+                    columns = clean_column_names(chunk.columns)
+                chunk.columns = columns
+                fraction = min(file.tell() / size, 1) if size else 0
+                yield clean_chunk(chunk), fraction
 
     def load_data(
         self, file, extra_info: Optional[Dict] = None, context_item=None, room=None
@@ -33,48 +60,16 @@ class CSVReader(BaseReader):
         """Parse file.
 
         Returns:
-            Union[str, List[str]]: a string or a List of strings.
+            Tuple[DataFrame, List[str]]: the whole table and its column names.
 
         """
-        try:
-            import csv
-        except ImportError:
-            raise ImportError("csv module is required to read CSV files.")
-        file_data = file.read()
-        decoded_data = file_data.decode('utf-8')
-
-        # map to table
-        fp = io.StringIO(decoded_data)
-        df = pd.read_csv(fp, engine='python',
-                         quoting=csv.QUOTE_MINIMAL, encoding='utf-8')
+        chunks = [chunk for chunk, _ in self.iter_chunks(file)]
+        df = pd.concat(chunks, ignore_index=True)
 
         if context_item:
-            progressUpdate(context_item=context_item.to_json(), progress=30,
+            progressUpdate(context_item=context_item, progress=30,
                            is_file=True, message='', room=room)
 
-        df.columns = df.columns.str.strip()
-
-        # drop column index if exist
-        if 'index' in df.columns:
-            df.drop('index', axis=1, inplace=True)
-
-        # drop null rows
-        df.dropna(axis=0, how='all', inplace=True)
-
-        # Replace double quotes
-        df.replace('"', '', regex=True, inplace=True)
-
-        # Replace single quotes
-        df.replace("'", '', regex=True, inplace=True)
-
-        # Remove double quotes from header
-        df.columns = df.columns.str.replace('"', '')
-
-        # Remove single quotes from header
-        df.columns = df.columns.str.replace("'", '')
-
-        df = df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
-
         column_names = df.columns.tolist()
 
         return df, column_names
@@ -3,54 +3,97 @@
 Contains parsers for docx, pdf files.
 
 """
-from typing import Dict, List, Optional
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional
 from llama_index.readers.base import BaseReader
 from llama_index.schema import Document
 from src.routes.ws import progressUpdate
+from src.config.config import PDF_READER_PROCESSES, PDF_READER_PAGES_PER_TASK
 
-import io
-import gevent
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PDF_READER_PROCESSES)
+    return _executor
+
+
+def extract_pages(path, start, end):
+    """Extract (text, label) of pages [start, end), runs in a pool process."""
+    import pypdf
+
+    pdf = pypdf.PdfReader(path)
+    return [(pdf.pages[page].extract_text(), pdf.page_labels[page])
+            for page in range(start, end)]
 
 
 class PDFReader(BaseReader):
     """PDF parser."""
 
-    def load_data(
+    def lazy_load_data(
         self, file, extra_info: Optional[Dict] = None, context_item=None, room=None
-    ) -> List[Document]:
-        """Parse file."""
+    ) -> Iterator[Document]:
+        """Parse file, yielding one document per page in page order as soon as it is extracted.
+
+        Pages are extracted in a process pool, pypdf is CPU bound and would otherwise block the
+        gevent loop.
+        """
         try:
             import pypdf
         except ImportError:
             raise ImportError(
                 "pypdf is required to read PDF files: `pip install pypdf`"
             )
-        # with open(file, "rb") as fp:
-            # Create a PDF object
 
-        fp = io.BufferedReader(file)
-        pdf = pypdf.PdfReader(fp)
+        # pool processes read the upload from disk instead of receiving it per task
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as fp:
+            shutil.copyfileobj(file, fp)
+            path = fp.name
 
-        # Get the number of pages in the PDF document
-        num_pages = len(pdf.pages)
+        futures = []
+        try:
+            num_pages = len(pypdf.PdfReader(path).pages)
+            page_ranges = [(start, min(start + PDF_READER_PAGES_PER_TASK, num_pages))
+                           for start in range(0, num_pages, PDF_READER_PAGES_PER_TASK)]
 
-        # Iterate over every page
-        docs = []
+            try:
+                executor = get_executor()
+                futures = [executor.submit(extract_pages, path, start, end)
+                           for start, end in page_ranges]
+                results = (future.result() for future in futures)
+            except (AssertionError, OSError, RuntimeError):
+                # no child processes here (e.g. a daemonic prefork worker), extract in process
+                results = (extract_pages(path, start, end)
+                           for start, end in page_ranges)
 
-        fifty_percent = int(round(0.5 * num_pages))
+            page = 0
+            for pages in results:
+                for page_text, page_label in pages:
+                    metadata = {"page_label": page_label,
+                                "file_name": file.filename}
+                    if extra_info is not None:
+                        metadata.update(extra_info)
 
-        for page in range(num_pages):
-            # Extract the text from the page
-            page_text = pdf.pages[page].extract_text()
-            page_label = pdf.page_labels[page]
-            if num_pages >= 2:
-                if page == fifty_percent:
-                    progressUpdate(context_item=context_item.to_json(),
-                                   progress=30, is_file=True, message='', room=room)
+                    page += 1
+                    if context_item:
+                        progressUpdate(context_item=context_item,
+                                       progress=int(90 * page / num_pages), is_file=True,
+                                       message=f'Read page {page} of {num_pages}', room=room)
 
-            metadata = {"page_label": page_label, "file_name": file.filename}
-            if extra_info is not None:
-                metadata.update(extra_info)
+                    yield Document(text=page_text, metadata=metadata)
+        finally:
+            # the consumer may stop early (failed embedding), drop the pages not started yet
+            for future in futures:
+                future.cancel()
+            os.remove(path)
 
-            docs.append(Document(text=page_text, metadata=metadata))
-        return docs
+    def load_data(
+        self, file, extra_info: Optional[Dict] = None, context_item=None, room=None
+    ) -> List[Document]:
+        """Parse file."""
+        return list(self.lazy_load_data(file, extra_info=extra_info, context_item=context_item, room=room))
@@ -6,23 +6,29 @@ Pandas parser for .xlsx files.
 from typing import Any, Dict, List, Optional, Union
 from llama_index.readers.base import BaseReader
 from llama_index.readers.schema.base import Document
+from src.config.config import TABULAR_IMPORT_CHUNK_SIZE
+from src.helper.tabular_import import clean_chunk, clean_column_names
 from src.routes.ws import progressUpdate
 
-import pandas as pd
 import io
+import itertools
+import zipfile
+import openpyxl
+import pandas as pd
 
 
 class PandasExcelReader(BaseReader):
-    r"""Pandas-based CSV parser.
+    r"""Pandas-based Excel parser.
 
-    Parses CSVs using the separator detection from Pandas `read_csv`function.
-    If special parameters are required, use the `pandas_config` dict.
+    Parses the first sheet of .xlsx/.xls files, see iter_chunks.
 
     Args:
 
         pandas_config (dict): Options for the `pandas.read_excel` function call.
             Refer to https://pandas.pydata.org/docs/reference/api/pandas.read_excel.html
             for more information. Set to empty dict by default, this means defaults will be used.
+            Only used for .xls files.
+        chunk_size (int): rows parsed at a time by iter_chunks.
 
     """
 
@@ -32,6 +38,7 @@ class PandasExcelReader(BaseReader):
         pandas_config: Optional[dict] = None,
         concat_rows: bool = True,
         row_joiner: str = "\n",
+        chunk_size: int = TABULAR_IMPORT_CHUNK_SIZE,
         **kwargs: Any
     ) -> None:
         """Init params."""
@@ -39,6 +46,55 @@ class PandasExcelReader(BaseReader):
         self._pandas_config = pandas_config or {}
         self._concat_rows = concat_rows
         self._row_joiner = row_joiner if row_joiner else "\n"
+        self._chunk_size = chunk_size
+
+    def iter_chunks(self, file, size=None):
+        """Parse the first sheet chunk by chunk.
+
+        .xlsx sheets are streamed row by row (openpyxl read-only mode), .xls sheets can only be
+        read whole and are chunked afterwards.
+
+        Returns:
+            Iterator[Tuple[DataFrame, float]]: cleaned chunks and the fraction of the sheet read.
+
+        """
+        if not zipfile.is_zipfile(file):
+            file.seek(0)
+            # integer and boolean columns with blank cells stay integers and booleans (nullable)
+            df = pd.read_excel(file, **self._pandas_config).convert_dtypes(convert_string=False)
+            df.columns = clean_column_names(df.columns)
+            total = max(len(df), 1)
+            for start in range(0, len(df), self._chunk_size):
+                chunk = df.iloc[start:start + self._chunk_size]
+                yield clean_chunk(chunk), min(start + self._chunk_size, total) / total
+            if df.empty:
+                yield clean_chunk(df), 1
+            return
+
+        file.seek(0)
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        try:
+            sheet = workbook.worksheets[0]
+            # from the sheet's dimension, missing in files of some writers
+            total = sheet.max_row
+            rows = sheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            columns = clean_column_names(header)
+            read = 1
+            while True:
+                # cells right of the header are dropped, like pandas does
+                batch = [row[:len(columns)]
+                         for row in itertools.islice(rows, self._chunk_size)]
+                read += len(batch)
+                chunk = pd.DataFrame(batch, columns=columns).convert_dtypes(
+                    convert_string=False)
+                yield clean_chunk(chunk), min(read / total, 1) if total else 0
+                if len(batch) < self._chunk_size:
+                    return
+        finally:
+            workbook.close()
 
     def load_data(
         self,
@@ -48,51 +104,23 @@ class PandasExcelReader(BaseReader):
         extra_info: Optional[Dict] = None,
         context_item=None,
         room=None
-    ) -> List[Document]:
-        """Parse file and extract values from a specific column.
+    ):
+        """Parse the first sheet of the file.
 
         Args:
-            file (Path): The path to the Excel file to read.
-            include_sheetname (bool): Whether to include the sheet name in the output.
-            sheet_name (Union[str, int, None]): The specific sheet to read from, default is None which reads all sheets.
+            file (Path): The Excel file to read.
             extra_info (Dict): Additional information to be added to the Document object.
 
         Returns:
-            List[Document]: A list of`Document objects containing the values from the specified column in the Excel file.
+            Tuple[DataFrame, List[str]]: the whole table and its column names.
         """
+        fp = io.BytesIO(file.read())
+        chunks = [chunk for chunk, _ in self.iter_chunks(fp)]
+        df = pd.concat(chunks, ignore_index=True)
 
-        # map to table
-        fp = io.BufferedReader(file)
-
-        df = pd.read_excel(fp)
-
-        progressUpdate(context_item=context_item.to_json(),
+        progressUpdate(context_item=context_item,
                        progress=30, is_file=True, message='', room=room)
 
-        # Strip column names
-        df.columns = df.columns.str.strip()
-
-        # Drop 'index' column if it exists
-        if 'index' in df.columns:
-            df.drop('index', axis=1, inplace=True)
-
-        # Drop null rows
-        df.dropna(axis=0, how='all', inplace=True)
-
-        # Replace double quotes
-        df.replace('"', '', regex=True, inplace=True)
-
-        # Replace single quotes
-        df.replace("'", '', regex=True, inplace=True)
-
-        # Remove double quotes from header
-        df.columns = df.columns.str.replace('"', '')
-
-        # Remove single quotes from header
-        df.columns = df.columns.str.replace("'", '')
-
-        df = df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
-
         column_names = df.columns.tolist()
 
         return df, column_names
@@ -0,0 +1,52 @@
+import queue
+import threading
+import socketio
+
+# Flask-SocketIO's default, workers on either side of a deploy keep sharing events
+DEFAULT_CHANNEL = "flask-socketio"
+
+
+class InProcessManager(socketio.PubSubManager):
+    """
+    Pub/sub client manager whose backend is a dict of in-memory queues, for several Socket.IO
+    servers (workers) in one process, e.g. tests and the fan-out load test. Every listening
+    manager of a channel receives every published message, like Redis pub/sub.
+    """
+    name = "memory"
+    _subscribers = {}
+    _subscribers_lock = threading.Lock()
+
+    def __init__(self, url="memory://", channel=DEFAULT_CHANNEL, write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self._queue = queue.Queue()
+
+    def _publish(self, data):
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers.get(self.channel, []))
+        for subscriber in subscribers:
+            subscriber.put(data)
+
+    def _listen(self):
+        with self._subscribers_lock:
+            self._subscribers.setdefault(self.channel, []).append(self._queue)
+        try:
+            while True:
+                yield self._queue.get()
+        finally:
+            with self._subscribers_lock:
+                self._subscribers[self.channel].remove(self._queue)
+
+
+def get_client_manager(url, write_only=False, channel=DEFAULT_CHANNEL):
+    """
+    Client manager of the Socket.IO server for a message queue url: redis:// (or rediss://),
+    memory:// (in process) or any other kombu url. None without a url, events then only reach
+    the clients connected to the emitting worker.
+    """
+    if not url:
+        return None
+    if url.startswith("memory://"):
+        return InProcessManager(url, channel=channel, write_only=write_only)
+    if url.startswith(("redis://", "rediss://")):
+        return socketio.RedisManager(url, channel=channel, write_only=write_only)
+    return socketio.KombuManager(url, channel=channel, write_only=write_only)
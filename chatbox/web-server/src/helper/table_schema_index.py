@@ -0,0 +1,76 @@
+from llama_index import VectorStoreIndex
+from llama_index.schema import TextNode
+from llama_index.storage.storage_context import StorageContext
+from llama_index.vector_stores import ChromaVectorStore
+from src.database.chromadb import ChromaClient
+
+
+def describe_column_stats(stats):
+    """Column statistics of an imported table (ContextItem.columnStats) for the text-to-SQL prompt."""
+    descriptions = []
+    for column_stats in stats:
+        details = [column_stats["type"]]
+        if column_stats["unique"]:
+            details.append("unique")
+        else:
+            details.append(f'{column_stats["distinct"]} distinct values')
+        if column_stats["indexed"]:
+            details.append("indexed")
+        if column_stats.get("values"):
+            details.append("values: " + ", ".join(
+                repr(value) for value in column_stats["values"]))
+        elif column_stats["min"] is not None:
+            details.append(
+                f'from {column_stats["min"]!r} to {column_stats["max"]!r}')
+        if column_stats["nulls"]:
+            details.append(f'{column_stats["nulls"]} empty')
+        descriptions.append(f'{column_stats["name"]} ({", ".join(details)})')
+    return "Columns: " + "; ".join(descriptions)
+
+
+def get_table_context(context_str, column_stats):
+    """Context of a table in its schema node, the column statistics help writing the query."""
+    if not column_stats:
+        return context_str
+    return f"{context_str}\n{describe_column_stats(column_stats)}"
+
+
+def get_single_table_info(connection, table_name):
+    # same format as llama_index SQLDatabase.get_single_table_info, which the plug server uses
+    sanitized_name = table_name.replace('"', '""')
+    cursor = connection.cursor()
+    cursor.execute(f'PRAGMA table_info("{sanitized_name}");')
+    columns = ", ".join(
+        [f"{column[1]} ({column[2]})" for column in cursor.fetchall()])
+    return f"Table '{table_name}' has columns: {columns}, and foreign keys: ."
+
+
+def to_table_schema_node(connection, table_name, context_str):
+    # mirrors llama_index SQLTableNodeMapping.to_node, the node id is the table name
+    table_text = (
+        f"Schema of table {table_name}:\n"
+        f"{get_single_table_info(connection, table_name)}\n"
+    )
+    if context_str is not None:
+        table_text += f"Context of table {table_name}:\n"
+        table_text += context_str
+
+    return TextNode(
+        id_=table_name,
+        text=table_text,
+        metadata={"name": table_name, "context": context_str},
+        excluded_embed_metadata_keys=["name", "context"],
+        excluded_llm_metadata_keys=["name", "context"],
+    )
+
+
+def upsert_table_schema(chroma_client, connection, plug_id, table_name, context_str):
+    tables_collection = chroma_client.get_or_create_collection(
+        name=ChromaClient.get_table_schema_collection_name(plug_id))
+    # replaced tables are re-embedded, other tables of the plug are left untouched
+    tables_collection.delete(ids=[table_name])
+
+    vector_store = ChromaVectorStore(chroma_collection=tables_collection)
+    storage_context = StorageContext.from_defaults(vector_store=vector_store)
+    VectorStoreIndex([to_table_schema_node(connection, table_name, context_str)],
+                     storage_context=storage_context)
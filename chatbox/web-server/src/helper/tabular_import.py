@@ -0,0 +1,263 @@
+import datetime
+import itertools
+import re
+import numpy as np
+import pandas as pd
+from src.config.config import (
+    TABULAR_IMPORT_SAMPLE_ROWS, TABULAR_IMPORT_MAX_INDEXES, TABULAR_INDEX_MIN_SELECTIVITY,
+    TABULAR_PROFILE_MAX_VALUES
+)
+
+# pandas' to_sql index column, kept so tables imported before keep the same schema
+INDEX_COLUMN = "index"
+# integers with a leading zero (zip codes, SKUs...) would lose it as numbers
+LEADING_ZERO_PATTERN = r"[+-]?0\d"
+INTEGER_PATTERN = r"[+-]?\d{1,18}"
+# product_id, ProductID, order no, SKU...
+ID_LIKE_PATTERN = re.compile(
+    r"(?i:(^|[\s_\-.])(id|sku|code|key|number|num|no))$|"
+    r"[a-z0-9](Id|ID|Sku|SKU|Code|Key|Number|Num|No)$")
+# longer min/max values are cut in the statistics
+MAX_STAT_VALUE_LENGTH = 50
+# timestamps are stored as text, like to_sql does
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+# values sqlite3 binds as they are (bool is an int)
+SQLITE_TYPES = (int, float, str, bytes)
+
+
+def clean_column_names(names):
+    """Strip whitespace and quotes from the header, empty and duplicated names are renamed."""
+    columns = []
+    for position, name in enumerate(names):
+        name = "" if name is None else str(name)
+        name = name.replace('"', '').replace("'", '').strip()
+        if not name:
+            name = f"Unnamed: {position}"
+        unique_name, suffix = name, 1
+        while unique_name in columns:
+            unique_name = f"{name}.{suffix}"
+            suffix += 1
+        columns.append(unique_name)
+    return columns
+
+
+def clean_chunk(df):
+    """Drop empty rows and the index column, remove quotes and strip the string cells, column by column."""
+    df = df.drop(columns=[INDEX_COLUMN], errors='ignore').dropna(
+        axis=0, how='all')
+    for column in df.columns:
+        values = df[column]
+        if values.dtype != object:
+            continue
+        # only the string cells, object columns of excel sheets also hold numbers, booleans, times...
+        mask = values.map(lambda value: isinstance(value, str))
+        if not mask.any():
+            continue
+        df.loc[mask, column] = values[mask].str.replace('"', '', regex=False).str.replace(
+            "'", '', regex=False).str.strip()
+    return df
+
+
+def infer_column_type(values):
+    """SQLite type of a column from a sample of its values, values are converted by the column affinity."""
+    values = values.dropna()
+    if values.empty:
+        return "TEXT"
+    if pd.api.types.is_bool_dtype(values) or pd.api.types.is_integer_dtype(values):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(values):
+        return "REAL"
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return "TIMESTAMP"
+    # boolean cells of an excel column with blanks
+    if values.map(lambda value: isinstance(value, bool)).all():
+        return "INTEGER"
+
+    strings = values.astype(str)
+    if strings.str.match(LEADING_ZERO_PATTERN).any():
+        return "TEXT"
+    if strings.str.fullmatch(INTEGER_PATTERN).all():
+        return "INTEGER"
+    if pd.to_numeric(strings, errors='coerce').notna().all():
+        return "REAL"
+    return "TEXT"
+
+
+def infer_column_types(sample):
+    return {column: infer_column_type(sample[column]) for column in sample.columns}
+
+
+def to_sqlite_value(value):
+    if value is None or isinstance(value, SQLITE_TYPES):
+        return value
+    if pd.isna(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    # pandas timestamps too
+    if isinstance(value, datetime.datetime):
+        return value.strftime(TIMESTAMP_FORMAT)
+    # times, dates... of excel cells
+    return str(value)
+
+
+def to_rows(df, start):
+    """Rows of the chunk as tuples for executemany, prefixed by the running index."""
+    df = df.copy()
+    for column in df.columns:
+        # pandas timestamps aren't sqlite3 types
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = df[column].dt.strftime(TIMESTAMP_FORMAT)
+        elif df[column].dtype == object:
+            df[column] = df[column].map(to_sqlite_value)
+    df = df.astype(object).where(df.notna(), None)
+    df.insert(0, INDEX_COLUMN, range(start, start + len(df)))
+    return df.itertuples(index=False, name=None)
+
+
+def quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def is_id_like(name):
+    return bool(ID_LIKE_PATTERN.search(name))
+
+
+def to_stat_value(value):
+    if isinstance(value, str) and len(value) > MAX_STAT_VALUE_LENGTH:
+        return value[:MAX_STAT_VALUE_LENGTH] + "..."
+    return value
+
+
+def profile_columns(connection, table_name, columns, column_types, rows):
+    """Distinct, null, min and max counts of every column, with the values of low-cardinality ones."""
+    table = quote_identifier(table_name)
+    aggregates = ", ".join(
+        f"COUNT(DISTINCT {quote_identifier(column)}), COUNT({quote_identifier(column)}), "
+        f"MIN({quote_identifier(column)}), MAX({quote_identifier(column)})" for column in columns)
+    values = connection.execute(
+        f"SELECT {aggregates} FROM {table};").fetchone() if columns else ()
+
+    stats = []
+    for position, column in enumerate(columns):
+        distinct, non_null, minimum, maximum = values[position * 4:position * 4 + 4]
+        column_stats = {
+            "name": column,
+            "type": column_types[column],
+            "distinct": distinct,
+            "nulls": rows - non_null,
+            "min": to_stat_value(minimum),
+            "max": to_stat_value(maximum),
+            "unique": non_null > 1 and distinct == non_null,
+            "idLike": is_id_like(column),
+            "indexed": False
+        }
+        if 0 < distinct <= TABULAR_PROFILE_MAX_VALUES:
+            column_stats["values"] = [to_stat_value(value) for (value,) in connection.execute(
+                f"SELECT DISTINCT {quote_identifier(column)} FROM {table} "
+                f"WHERE {quote_identifier(column)} IS NOT NULL ORDER BY 1;")]
+        stats.append(column_stats)
+    return stats
+
+
+def select_index_columns(stats, rows):
+    """
+    Columns worth an index: ID-like and unique columns first, then the most selective ones
+    (at least TABULAR_INDEX_MIN_SELECTIVITY distinct values per row), TABULAR_IMPORT_MAX_INDEXES at most.
+    Float columns are only indexed when ID-like, they're filtered by ranges rarely worth a seek.
+    """
+    candidates = []
+    for column_stats in stats:
+        non_null = rows - column_stats["nulls"]
+        if column_stats["distinct"] < 2 or not non_null:
+            continue
+        selectivity = column_stats["distinct"] / non_null
+        if column_stats["idLike"]:
+            priority = 0
+        elif column_stats["type"] == "REAL":
+            continue
+        elif column_stats["unique"]:
+            priority = 1
+        elif selectivity >= TABULAR_INDEX_MIN_SELECTIVITY:
+            priority = 2
+        else:
+            continue
+        candidates.append((priority, -selectivity, column_stats["name"]))
+    return [name for _, _, name in sorted(candidates)[:TABULAR_IMPORT_MAX_INDEXES]]
+
+
+def create_column_indexes(connection, table_name, stats, rows):
+    """Index the selected columns and analyze the table, so the planner picks them for seeks."""
+    table = quote_identifier(table_name)
+    index_columns = select_index_columns(stats, rows)
+    for column in index_columns:
+        connection.execute(
+            f"CREATE INDEX {quote_identifier(f'ix_{table_name}_{column}')} "
+            f"ON {table} ({quote_identifier(column)});")
+    for column_stats in stats:
+        column_stats["indexed"] = column_stats["name"] in index_columns
+    connection.execute(f"ANALYZE {table};")
+    return stats
+
+
+def import_table_chunks(sqlite_pool, table_name, chunks, on_progress=None):
+    """
+    Replace table_name with the rows of chunks, an iterator of (DataFrame, done fraction) with
+    cleaned column names. Column types are inferred from the first TABULAR_IMPORT_SAMPLE_ROWS rows,
+    rows are inserted with executemany in a single transaction on the writer, readers keep
+    seeing the former table until it commits. Columns are then profiled and the ones queries
+    likely filter on are indexed (see select_index_columns).
+
+    Returns the column names, types and statistics, the row count and the first rows (for the summary).
+    """
+    chunks = iter(chunks)
+    buffered = []
+    sample_size = 0
+    for chunk, fraction in chunks:
+        buffered.append((chunk, fraction))
+        sample_size += len(chunk)
+        if sample_size >= TABULAR_IMPORT_SAMPLE_ROWS:
+            break
+    if not buffered:
+        raise ValueError("The file has no header row")
+
+    columns = buffered[0][0].columns.tolist()
+    sample = pd.concat([chunk for chunk, _ in buffered]).head(
+        TABULAR_IMPORT_SAMPLE_ROWS)
+    column_types = infer_column_types(sample)
+
+    table = quote_identifier(table_name)
+    column_definitions = ", ".join(
+        [f"{quote_identifier(INDEX_COLUMN)} INTEGER"] +
+        [f"{quote_identifier(column)} {column_types[column]}" for column in columns])
+    insert = f"INSERT INTO {table} VALUES ({', '.join(['?'] * (len(columns) + 1))});"
+
+    def write(connection):
+        rows = 0
+        # DDL doesn't open a transaction on its own, the drop must not commit before the inserts
+        if not connection.in_transaction:
+            connection.execute("BEGIN;")
+        connection.execute(f"DROP TABLE IF EXISTS {table};")
+        connection.execute(f"CREATE TABLE {table} ({column_definitions});")
+        for chunk, fraction in itertools.chain(buffered, chunks):
+            if chunk.empty:
+                continue
+            connection.executemany(insert, to_rows(chunk, rows))
+            rows += len(chunk)
+            if on_progress:
+                on_progress(rows, fraction)
+        connection.execute(
+            f"CREATE INDEX {quote_identifier(f'ix_{table_name}_{INDEX_COLUMN}')} "
+            f"ON {table} ({quote_identifier(INDEX_COLUMN)});")
+        stats = profile_columns(
+            connection, table_name, columns, column_types, rows)
+        return rows, create_column_indexes(connection, table_name, stats, rows)
+
+    rows, column_stats = sqlite_pool.write(write)
+    return {
+        "columns": columns,
+        "columnTypes": column_types,
+        "columnStats": column_stats,
+        "rows": rows,
+        "head": sample.head(3)
+    }
@@ -0,0 +1,166 @@
+import atexit
+import datetime
+import threading
+import time
+import pytz
+from collections import defaultdict
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from src.models import TokenUsage, Plug
+from src.helper.analytics import analytics_rollup
+from src.config.config import TOKEN_USAGE_FLUSH_INTERVAL, TOKEN_USAGE_BATCH_SIZE
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class TokenUsageLedger:
+    """
+    Per-worker buffer of token usage.
+
+    Every request is recorded as a TokenUsage row; Plug.token and Client.token are
+    updated from the summed deltas with atomic $inc updates. Both are flushed in
+    batches every flush_interval seconds (or once batch_size rows are pending).
+    """
+
+    def __init__(self, flush_interval=5, batch_size=100):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._usages = []
+        self._plug_tokens = defaultdict(int)
+        self._client_tokens = defaultdict(int)
+        self._updated_at = {}
+        self._flusher = None
+
+    def record(self, plug_id, token_counter, model=None, client_id=None, source=None):
+        llm_tokens = token_counter.total_llm_token_count
+        embedding_tokens = token_counter.total_embedding_token_count
+        total_tokens = llm_tokens + embedding_tokens
+        now = datetime.datetime.now(pytz.UTC)
+        plug_id = ObjectId(plug_id)
+        client_id = ObjectId(client_id) if client_id else None
+
+        with self._lock:
+            self._usages.append(TokenUsage(
+                id=ObjectId(),
+                plugId=plug_id,
+                clientId=client_id,
+                model=model,
+                source=source,
+                llmTokens=llm_tokens,
+                embeddingTokens=embedding_tokens,
+                totalTokens=total_tokens,
+                createdAt=now,
+            ))
+            self._plug_tokens[plug_id] += total_tokens
+            if client_id:
+                self._client_tokens[(plug_id, client_id)] += total_tokens
+            self._updated_at[plug_id] = now
+            should_flush = len(self._usages) >= self.batch_size
+
+        analytics_rollup.record(client_id, now, tokens=total_tokens)
+
+        self._ensure_flusher()
+        if should_flush:
+            self.flush_quietly()
+        return total_tokens
+
+    def _ensure_flusher(self):
+        # started lazily so each forked worker runs its own flusher
+        if self._flusher is None or not self._flusher.is_alive():
+            with self._lock:
+                if self._flusher is None or not self._flusher.is_alive():
+                    self._flusher = threading.Thread(
+                        target=self._run, daemon=True)
+                    self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush_quietly()
+
+    def flush_quietly(self):
+        # failed rows and the increments known to have failed are retried on the next flush
+        try:
+            self.flush()
+        except Exception as e:
+            print("Token usage flush failed", str(e))
+
+    def flush(self):
+        with self._lock:
+            usages, self._usages = self._usages, []
+            plug_tokens, self._plug_tokens = self._plug_tokens, defaultdict(int)
+            client_tokens, self._client_tokens = self._client_tokens, defaultdict(int)
+            updated_at, self._updated_at = self._updated_at, {}
+
+        operations, deltas = self._get_increments(plug_tokens, client_tokens, updated_at)
+
+        if usages:
+            try:
+                self._insert_usages(usages)
+            except Exception:
+                with self._lock:
+                    self._usages = usages + self._usages
+                # the increments weren't sent yet
+                self._restore_increments(deltas)
+                raise
+
+        if operations:
+            try:
+                Plug._get_collection().bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                # the other increments are applied, only the failed ones are retried
+                self._restore_increments([deltas[error["index"]]
+                                          for error in e.details.get("writeErrors", [])])
+                raise
+            except Exception as e:
+                # which increments were applied is unknown, retrying them could count tokens twice:
+                # they're dropped, the TokenUsage rows still have them
+                print("Token usage increments dropped", len(operations), str(e))
+                raise
+
+    def _restore_increments(self, deltas):
+        with self._lock:
+            for key, tokens, updated_at in deltas:
+                if isinstance(key, tuple):
+                    self._client_tokens[key] += tokens
+                else:
+                    self._plug_tokens[key] += tokens
+                if updated_at is not None:
+                    self._updated_at[key] = max(
+                        updated_at, self._updated_at.get(key, updated_at))
+
+    @staticmethod
+    def _insert_usages(usages):
+        try:
+            TokenUsage._get_collection().insert_many(
+                [usage.to_mongo() for usage in usages], ordered=False)
+        except BulkWriteError as e:
+            # rows kept from a failed flush may already be stored, their ids are fixed
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+
+    @staticmethod
+    def _get_increments(plug_tokens, client_tokens, updated_at):
+        """$inc updates of the plugs and clients, with the (key, tokens, updatedAt) delta of each."""
+        operations, deltas = [], []
+        for plug_id, tokens in plug_tokens.items():
+            update = {"$inc": {"token": tokens}}
+            if plug_id in updated_at:
+                update["$max"] = {"updatedAt": updated_at[plug_id]}
+            operations.append(UpdateOne({"_id": plug_id}, update))
+            deltas.append((plug_id, tokens, updated_at.get(plug_id)))
+        for (plug_id, client_id), tokens in client_tokens.items():
+            operations.append(UpdateOne(
+                {"_id": plug_id, "client._id": client_id}, {"$inc": {"client.token": tokens}}))
+            deltas.append(((plug_id, client_id), tokens, None))
+        return operations, deltas
+
+
+token_usage_ledger = TokenUsageLedger(
+    flush_interval=TOKEN_USAGE_FLUSH_INTERVAL, batch_size=TOKEN_USAGE_BATCH_SIZE)
+
+# don't lose the last interval's usage on graceful worker shutdown (max_requests restarts)
+atexit.register(token_usage_ledger.flush_quietly)
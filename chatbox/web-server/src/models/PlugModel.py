@@ -10,6 +10,8 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 root_dir = os.path.abspath(os.path.join(current_dir, '../'))
 sys.path.append(root_dir)
 from database.chromadb import ChromaClient
+from database.sqlite import SQLiteConnection
+from database.sqlite.bm25 import BM25Store
 sys.path.append(os.path.abspath(os.path.join('src', 'models')))
 from GuestModel import Guest
 from ContextItemModel import ContextItem
@@ -23,7 +25,8 @@ MODEL_CHOICES = ["gpt-4", "llama2", "gpt-4"]
 
 FEATURE_DICT = {"crawl website": "crawlWebsite", "save conversation": "saveConversation",
                 "upload files": "uploadFiles", "api access": "apiAccess", "customize client": "customizeClient",
-                "custom WebAI Pilot plug": "custom2gaiplug", "llama 2 model": "llama2"}
+                "custom WebAI Pilot plug": "custom2gaiplug", "llama 2 model": "llama2",
+                "hybrid retrieval": "hybridRetrieval"}
 
 MODEL_DICT = {"gpt-4": "gpt4",
               "gpt-4": "gpt3", "llama2": "llama2"}
@@ -67,9 +70,13 @@ class Plug(Document):
     userId = ObjectIdField()
     isAutoCreateMap = BooleanField(default=False)
     mapsPoint = EmbeddedDocumentListField(MapPoint, default=[])
+    # bumped whenever one of the plug's context items changes, see ContextItem hooks
+    contextVersion = IntField(default=0)
     meta = {
         "collection": "plug",
-        'indexes': ['client.key']
+        # created by the index migration (src/database/mongodb/indexes.py)
+        'auto_create_index': False,
+        'indexes': ['client.key', 'userId', 'client.id']
     }
 
     def __init__(self, *args, **kwargs):
@@ -150,6 +157,13 @@ class Plug(Document):
                     plugId=ObjectId(document.id)).delete()
                 # Delete guest
                 Guest.objects(client=document.id).delete()
+                # Delete embedded table schemas
+                chroma_client.delete_collection(
+                    ChromaClient.get_table_schema_collection_name(document.id))
+                # Delete keyword (BM25) index
+                BM25Store().delete_plug(document.id)
+                # Delete structured tables, the plug's SQLite file
+                SQLiteConnection.delete_plug(document.id)
             except:
                 return
 
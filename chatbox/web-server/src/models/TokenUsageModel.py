@@ -0,0 +1,32 @@
+import datetime
+import pytz
+from mongoengine import Document, StringField, ObjectIdField, IntField, DateTimeField
+
+
+class TokenUsage(Document):
+    plugId = ObjectIdField(required=True)
+    clientId = ObjectIdField(default=None)
+    model = StringField()
+    source = StringField()
+    llmTokens = IntField(required=True, default=0)
+    embeddingTokens = IntField(required=True, default=0)
+    totalTokens = IntField(required=True, default=0)
+    createdAt = DateTimeField(
+        required=True, default=lambda: datetime.datetime.now(pytz.UTC))
+    meta = {
+        "collection": "tokenUsage",
+        'indexes': [('plugId', '-createdAt')]
+    }
+
+    def to_json(self):
+        return {
+            "id": str(self.pk),
+            "plugId": str(self.plugId),
+            "clientId": str(self.clientId) if self.clientId else None,
+            "model": self.model,
+            "source": self.source,
+            "llmTokens": self.llmTokens,
+            "embeddingTokens": self.embeddingTokens,
+            "totalTokens": self.totalTokens,
+            "createdAt": self.createdAt.timestamp(),
+        }
@@ -10,3 +10,6 @@ from src.models.PaymentInvoiceModel import PaymentInvoice
 from src.models.DockerModel import DockerImage, DockerUserConfig, DockerToken
 from src.models.UserModel import User, UserKey
 from src.models.MapItemModel import MapItem
+from src.models.TokenUsageModel import TokenUsage
+from src.models.IngestionJobModel import IngestionJob
+from src.models.AnalyticsDailyModel import AnalyticsDaily
@@ -11,7 +11,7 @@ from src.routes.admin.user import admin_user
 from src.routes.live_demo import live_demo
 from src.routes.image import image
 from src.routes.subscription import subscription
-from src.routes.ws import socketio
+from src.routes.ws import socketio, init_socketio
 from src.routes.user import user
 from src.routes.client import client
 from src.routes.history import history
@@ -19,19 +19,12 @@ from dotenv import load_dotenv
 from src.routes.ws import progressUpdate, statusUpdate
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from llama_index.readers.schema.base import Document
-from llama_index.storage.storage_context import StorageContext
-from llama_index.vector_stores import ChromaVectorStore
-from llama_index import VectorStoreIndex, SummaryIndex
-from llama_index.chat_engine.simple import SimpleChatEngine
-from llama_index.llms import OpenAI
-from src.helper.file_reader import FileReader
-from src.helper.crawl import ApifyActor
 from src.helper.trifatula import TrafilaturaWebReader
+from src.helper.auth_context import get_auth_context
 from src.helper import (
     get_file_extension,
-    get_token_counter,
+    get_file_hash,
     is_valid_base_url,
-    split_list,
     get_root_url
 )
 from bson.objectid import ObjectId
@@ -51,7 +44,7 @@ from src.models import (
     MapPoint,
     MapItem
 )
-from src.services import (handler_create_map_point, delete_map_point)
+from src.services import (handler_create_map_point, delete_map_point, enqueue_ingestion)
 from mongoengine import ValidationError, Q
 from flask import Blueprint, request, current_app
 from gridfs import GridFS
@@ -72,151 +65,7 @@ context_base = Blueprint("context_base", __name__,
 files_collection_name = "contextItem"
 mongo.create_db_connection()
 fs = GridFS(get_db(), collection=files_collection_name)
-
-
-def upload_documents(connection, id, plug, chroma_collection, formatted_file_name, documents, is_tabular,
-                     is_website=False, apify_token=None, crawl_url=None, room='', is_recording=False, is_dom=False):
-    try:
-        def tranform_dataset_item(item):
-            return Document(
-                text=item.get("text"),
-                extra_info={
-                    "url": item.get("url"),
-                    "context_id": str(id),
-                },
-            )
-
-        data = ContextItem.objects(id=ObjectId(id)).first()
-
-        if is_website and not is_recording:
-            time_out = 120
-            max_pages = 20
-
-            if flask_env == "production":
-                web_hook_url = f"{server_url}/web/api/v1/websocket/notify"
-            elif flask_env == "staging":
-                web_hook_url = f"{server_url}/stage/web/api/v1/websocket/notify"
-            else:
-                # web_hook_url = f"{server_url}/web/api/v1/websocket/notify"
-                web_hook_url= "https://webaipilot.neoprototype.ca//web/api/v1/websocket/notify"
-
-            reader = ApifyActor(apify_token)
-            run_id = reader.start_run(
-                actor_id="apify/website-content-crawler",
-                run_input={
-                    "startUrls": [{
-                        "url": crawl_url
-                    }],
-                    # "maxConcurrency": 20,
-                    # "clickElementsCssSelector": "[aria-expanded=\"true\"]",
-                    # "dynamicContentWaitSecs": 20,
-                    "initialConcurrency": 10,
-                    "htmlTransformer": "none",
-                    "maxCrawlDepth": 3,
-                    "maxCrawlPages": max_pages,
-                    "maxResults": max_pages,
-                },
-                memory_mbytes=4096,
-                wait_secs=time_out,
-                timeout_secs=time_out,
-                webhooks=[{"event_types": ['ACTOR.RUN.CREATED', 'ACTOR.RUN.SUCCEEDED', 'ACTOR.RUN.FAILED',
-                                           'ACTOR.RUN.TIMED_OUT', 'ACTOR.RUN.ABORTED', 'ACTOR.RUN.RESURRECTED',
-                                           'ACTOR.BUILD.CREATED', 'ACTOR.BUILD.SUCCEEDED', 'ACTOR.BUILD.FAILED',
-                                           'ACTOR.BUILD.TIMED_OUT', 'ACTOR.BUILD.TIMED_OUT'],
-                           "request_url": web_hook_url,
-                           "payload_template": '{"eventType": {{eventType}},"eventData": {{eventData}},"resource": {{resource}}, "room":' + f'"{room}",' + '"contextItem":' + f'{json.dumps(data.to_json())}' + "}"}])
-
-            documents = reader.finish_run(
-                run_id=run_id, wait_secs=time_out, dataset_mapping_function=tranform_dataset_item)
-
-            for document in documents:
-                url = document.metadata["url"]
-                new_context_item = ContextItem(
-                    source=url, plugId=ObjectId(plug.id), isFile=False, progress=100).save()
-                data.children.append(new_context_item.id)
-                data.urls.append(url)
-
-        if not is_tabular:
-            token_counter = get_token_counter(plug)
-
-            vector_store = ChromaVectorStore(
-                chroma_collection=chroma_collection)
-
-            storage_context = StorageContext.from_defaults(
-                vector_store=vector_store)
-
-            if is_dom:
-                progressUpdate(context_item=data.to_json(), progress=30,
-                               is_file=not is_website, message='', room=room)
-            else:
-                progressUpdate(context_item=data.to_json(), progress=70,
-                               is_file=not is_website, message='', room=room)
-
-            split_documents = split_list(documents, 1000)
-            for split_document in split_documents:
-                VectorStoreIndex(split_document, storage_context=storage_context,
-                                 show_progress=True if flask_env == "development" else False)
-
-            plug.token += (token_counter.total_llm_token_count +
-                           token_counter.total_embedding_token_count)
-
-            summary_index = SummaryIndex.from_documents(split_documents[0])
-            query_engine = summary_index.as_query_engine(
-                response_mode="tree_summarize")
-            summary_str = query_engine.query(
-                "Summarize these documents in under 300 words, must have 1 title and 1 subtitle, respond in markdown format")
-
-        else:
-            context_string = f'This table gives information regarding: {documents[1]} from the document: {formatted_file_name}'
-            documents[0].to_sql((f'{plug.id}/{formatted_file_name}'),
-                                connection, if_exists='replace')
-            data.contextString = context_string
-
-            progressUpdate(context_item=data.to_json(), progress=70,
-                           is_file=not is_website, message='', room=room)
-
-            llm = OpenAI(model="gpt-4", temperature=0.3)
-            chat_engine = SimpleChatEngine.from_defaults(llm=llm)
-            summary_str = str(chat_engine.chat(
-                f'Summarize this table in under 300 words, only the first 3 rows is given for reference but there are more rows: {documents[0].columns.tolist()}\n{documents[0].head(3)}, must have 1 title and 1 subtitle, respond in markdown format'))
-
-        # Update tokens,updatedAt, ...
-        plug.updatedAt = datetime.datetime.now(pytz.UTC)
-        plug.save()
-
-        # Update upload status to finished
-        data.summary = str(summary_str)
-        data.progress = 100
-        data.save()
-
-        time.sleep(1)
-
-        if not is_website:
-            progressUpdate(context_item=data.to_json(), progress=100, is_file=not is_website,
-                           message='File upload finished', room=room)
-            if plug.isAutoCreateMap:
-                # Create map
-                provider = "nomic"
-                map_point = handler_create_map_point(
-                    provider, plug.userId, plug, id, UPLOAD_FILES, fs=fs)
-                # if map_point[1] == 200:
-                #     data.isMapCreated = True
-                #     data.save()
-                #     statusUpdate(context_item=map_point[0]["data"], is_file=not is_website,
-                #                    message='Create map finished', room=room, event='context_item_upload')
-                # else:
-                #     data.mapPointStatus = None
-                #     statusUpdate(context_item=data.to_json(), is_file=not is_website,
-                #                message='Create map failed', room=room, event='context_item_upload')
-
-        else:
-            progressUpdate(context_item=data.to_json(), progress=100, is_file=not is_website,
-                           message='Website upload finished', room=room)
-
-    except Exception as e:
-        progressUpdate(context_item=data.to_json(), progress=-1, is_file=not is_website,
-                       message=f'Document upload failed. Error: {str(e)}', room=room)
-        ContextItem.objects(id=ObjectId(id)).delete()
+upload_fs = GridFS(get_db(), collection="ingestionUpload")
 
 
 @context_base.post("file/confirm")
@@ -306,7 +155,9 @@ def file_upload():
         supported_formats = ['.pdf', '.csv', '.xls', '.xlsx']
         tabular_formats = ['.xls', '.xlsx', '.csv']
         allow_map_formats = ['csv', 'xls', 'xlsx', 'json']
-        plug = Plug.objects(id=plug_id, userId=user_id).first()
+        context = get_auth_context(user_id)
+        user = context.user
+        plug = context.get_plug(plug_id)
 
         if not ObjectId.is_valid(plug_id) or not plug_id:
             return {"code": 400, "message": "Invalid plug id"}, HTTP_200_OK
@@ -325,37 +176,40 @@ def file_upload():
         if int(file_length) > int(current_app.config['MAX_CONTENT_LENGTH']):
             return {"code": 413, "message": "File too large"}, HTTP_413_REQUEST_ENTITY_TOO_LARGE
 
-        user = User.objects(id=user_id).first()
-        subscription = Subscription.objects(id=user.subscriptionId).first()
-        feature_limit = subscription.featuresLimit
-        upload_limit = [
-            feature.limit for feature in feature_limit if feature.name == "upload files"]
+        upload_limit = context.get_feature_limit("upload files")
         file_uploaded = ContextItem.objects(
             plugId=plug_id, isFile=True).count()
         file_suffix = get_file_extension(uploaded_file.filename)
-        if upload_limit and file_uploaded == int(upload_limit[0]):
+        if upload_limit is not None and file_uploaded >= upload_limit:
             return {"code": 400, "message": "You have reached the upload limit"}, HTTP_400_BAD_REQUEST
         if file_suffix not in supported_formats:
             return {"code": 400, "message": "Unsupported file type"}, HTTP_400_BAD_REQUEST
 
         is_tabular = file_suffix in tabular_formats
 
+        content_hash = get_file_hash(uploaded_file)
+
         # check exist & save to mongodb
         is_allow_create_map = True if file_type in allow_map_formats else False
         exists = False
-        if is_tabular:
-            context_item = ContextItem.objects(
-                plugId=plug_id, isFile=True, structured=True, source=uploaded_file.filename).first()
-            if context_item:
-                context_item.progress = 0
-                context_item.save()
-                exists = True
-                id = context_item.id
+        context_item = ContextItem.objects(
+            plugId=plug_id, isFile=True, structured=is_tabular, source=uploaded_file.filename).first()
+        if context_item:
+            if context_item.contentHash == content_hash and context_item.progress == 100:
+                return {
+                    "code": 200,
+                    "message": "File unchanged.",
+                    "data": context_item.to_json()
+                }, HTTP_200_OK
+            context_item.progress = 0
+            context_item.save()
+            exists = True
+            id = context_item.id
 
         if not exists:
             id = fs.put(uploaded_file, source=uploaded_file.filename, plugId=ObjectId(
                 plug.id), isFile=True, length=file_length, structured=is_tabular, progress=0, fileType=file_type,
-                isAllowCreateMap=is_allow_create_map)
+                isAllowCreateMap=is_allow_create_map, contentHash=content_hash)
             context_item = ContextItem.objects(id=ObjectId(id)).first()
 
         # format file name
@@ -365,34 +219,20 @@ def file_upload():
             progressUpdate(context_item=context_item.to_json(), progress=0, is_file=True,
                            message='File upload started', room=str(user.id))
 
-            # get plug's chroma collection
-            chroma_client = current_app.config['CHROMA_CLIENT']
-            chroma_collection = chroma_client.get_collection(
-                name=str(plug.id))
-
-            # Set up the ChromaVectorStore and load the data:
-            uploaded_file.seek(0)
-            reader = FileReader()
-            documents = reader.load_data(
-                input_file=uploaded_file,
-                file_suffix=file_suffix,
-                metadata={
-                    "file_name": uploaded_file.filename,
-                    "context_id": str(id),
-                    "plug_id": str(plug.id)
-                },
-                context_item=context_item,
-                room=str(plug.id)
-            )
-
-            progressUpdate(context_item=context_item.to_json(), progress=50, is_file=True,
-                           message='', room=str(user.id))
-
-            connection = current_app.config['SQLITE_CONNECTION']
-
-            # Start async upload
-            gevent.spawn(upload_documents, connection, id, plug,
-                         chroma_collection, formatted_file_name, documents, is_tabular=is_tabular, room=str(user.id))
+            payload = {
+                "fileSuffix": file_suffix,
+                "isTabular": is_tabular,
+                "formattedFileName": formatted_file_name,
+                "contentHash": content_hash
+            }
+            if exists:
+                # staged for the worker, the stored file is replaced once the new one is ingested
+                uploaded_file.seek(0)
+                payload["uploadId"] = str(upload_fs.put(
+                    uploaded_file, source=uploaded_file.filename))
+
+            # Queue the upload, parsing and embedding run in the ingestion worker (task.py)
+            enqueue_ingestion("file", id, plug.id, user.id, payload)
 
         except Exception as e:
             ContextItem.objects(id=ObjectId(id)).delete()
@@ -436,22 +276,19 @@ def web_upload():
         if not name:
             return {"code": 400, "message": "Missing body"}, HTTP_400_BAD_REQUEST
 
-        plug = Plug.objects(
-            id=plug_id, userId=user_id).first()
+        context = get_auth_context(user_id)
+        user = context.user
+        plug = context.get_plug(plug_id)
 
         if not plug:
             return {"code": 404, "message": "Plug not found"}, HTTP_404_NOT_FOUND
 
         if not plug.active:
             return {"code": 400, "message": "Plug is not active"}, HTTP_400_BAD_REQUEST
-        user = User.objects(id=user_id).first()
-        subscription = Subscription.objects(id=user.subscriptionId).first()
-        feature_limit = subscription.featuresLimit
-        upload_limit = [
-            feature.limit for feature in feature_limit if feature.name == "crawl website"]
+        upload_limit = context.get_feature_limit("crawl website")
         file_uploaded = ContextItem.objects(
             plugId=plug_id, isFile=False, isParent=True).count()
-        if upload_limit and file_uploaded == int(upload_limit[0]):
+        if upload_limit is not None and file_uploaded >= upload_limit:
             return {"code": 400, "message": "You have reached the upload limit"}, HTTP_400_BAD_REQUEST
         if current_app.config['CRAWL_WEBSITE'] not in plug.features:
             return {"code": 400, "message": "This plug doesn't have that feature"}, HTTP_400_BAD_REQUEST
@@ -474,15 +311,8 @@ def web_upload():
             progressUpdate(context_item=context_item.to_json(), progress=0, is_file=False,
                            message='Web crawl started', room=str(user.id))
 
-            # get plug's chroma collection
-            chroma_client = current_app.config['CHROMA_CLIENT']
-            chroma_collection = chroma_client.get_collection(
-                name=str(plug.id))
-
-            apify_token = current_app.config['APIFY_TOKEN']
-
-            gevent.spawn(upload_documents, None, id, plug,
-                         chroma_collection, None, None, False, True, apify_token, data, room=str(user.id))
+            enqueue_ingestion("website", id, plug.id,
+                              user.id, {"crawlUrl": data})
 
         except Exception as e:
             ContextItem.objects(id=ObjectId(id)).delete()
@@ -523,20 +353,18 @@ def api_upload():
         if not plug.active:
             return {"code": 400, "message": "Plug is not active"}, HTTP_400_BAD_REQUEST
 
-        user = User.objects(id=ObjectId(user_id)).first()
+        context = get_auth_context(user_id)
+        user = context.user
         if not user:
             return {"code": 404, "message": "User not found"}, HTTP_404_NOT_FOUND
 
         if current_app.config['CRAWL_WEBSITE'] not in plug.features:
             return {"code": 400, "message": "This plug doesn't have that feature"}, HTTP_400_BAD_REQUEST
 
-        subscription = Subscription.objects(id=user.subscriptionId).first()
-        feature_limit = subscription.featuresLimit
-        upload_limit = [
-            feature.limit for feature in feature_limit if feature.name == "crawl website"]
+        upload_limit = context.get_feature_limit("crawl website")
         file_uploaded = ContextItem.objects(
             plugId=plug.id, isFile=False, isParent=True).count()
-        if upload_limit and file_uploaded == int(upload_limit[0]):
+        if upload_limit is not None and file_uploaded >= upload_limit:
             return {"code": 400, "message": "You have reached the upload limit"}, HTTP_400_BAD_REQUEST
 
         embedded_documents = []
@@ -554,10 +382,6 @@ def api_upload():
         progressUpdate(context_item=existing_context_item.to_json(), progress=0, is_file=True,
                        message='', room=str(user.id))
 
-        connection = current_app.config['SQLITE_CONNECTION']
-        chroma_client = current_app.config['CHROMA_CLIENT']
-        chroma_collection = chroma_client.get_collection(name=str(plug.id))
-
         for api in apis:
             payload = api.get("payload")
             response = api.get("response")
@@ -571,9 +395,7 @@ def api_upload():
                 mongo_documents.append(existing_child)
                 existing_child.uploadDate = datetime.datetime.now(pytz.UTC)
                 existing_child.save()
-                # delete existing embedded documents before inserting new ones
-                chroma_collection.delete(
-                    where={"context_id": str(existing_child.id)})
+                # unchanged chunks are kept, the ingestion job deletes the ones that disappeared
                 embedded_documents.append(Document(text=document_str, metadata={
                     "url": url, "context_id": str(existing_child.id)}))
             else:
@@ -586,8 +408,8 @@ def api_upload():
                     "url": url, "context_id": str(new_context_item.id)}))
         existing_context_item.save()
 
-        gevent.spawn(upload_documents, connection, existing_context_item.id, plug, chroma_collection,
-                     None, embedded_documents, is_tabular=False, is_website=True, room=str(user.id), is_recording=True)
+        enqueue_ingestion("api", existing_context_item.id, plug.id, user.id, {
+            "documents": [{"text": document.text, "metadata": document.metadata} for document in embedded_documents]})
         return {
             "code": 200,
             "message": "API upload started.",
@@ -619,20 +441,18 @@ def dom_upload():
         if not plug.active:
             return {"code": 400, "message": "Plug is not active"}, HTTP_400_BAD_REQUEST
 
-        user = User.objects(id=ObjectId(user_id)).first()
+        context = get_auth_context(user_id)
+        user = context.user
         if not user:
             return {"code": 404, "message": "User not found"}, HTTP_404_NOT_FOUND
 
         if current_app.config['CRAWL_WEBSITE'] not in plug.features:
             return {"code": 400, "message": "This plug doesn't have that feature"}, HTTP_400_BAD_REQUEST
 
-        subscription = Subscription.objects(id=user.subscriptionId).first()
-        feature_limit = subscription.featuresLimit
-        upload_limit = [
-            feature.limit for feature in feature_limit if feature.name == "crawl website"]
+        upload_limit = context.get_feature_limit("crawl website")
         file_uploaded = ContextItem.objects(
             plugId=plug.id, isFile=False, isParent=True).count()
-        if upload_limit and file_uploaded == int(upload_limit[0]):
+        if upload_limit is not None and file_uploaded >= upload_limit:
             return {"code": 400, "message": "You have reached the upload limit"}, HTTP_400_BAD_REQUEST
 
         embedded_documents = []
@@ -649,10 +469,6 @@ def dom_upload():
         progressUpdate(context_item=existing_context_item.to_json(), progress=0, is_file=True,
                        message='', room=str(user.id))
 
-        connection = current_app.config['SQLITE_CONNECTION']
-        chroma_client = current_app.config['CHROMA_CLIENT']
-        chroma_collection = chroma_client.get_collection(name=str(plug.id))
-
         for dom in doms:
             dom_str = dom.get("dom")
             url = dom.get("url")
@@ -670,8 +486,7 @@ def dom_upload():
                 plug.id), isFile=False, isParent=False).first()
 
             if existing_child:
-                chroma_collection.delete(
-                    where={"context_id": str(existing_child.id)})
+                # unchanged chunks are kept, the ingestion job deletes the ones that disappeared
                 existing_child.uploadDate = datetime.datetime.now(pytz.UTC)
             else:
                 existing_child = ContextItem(source=url, plugId=ObjectId(
@@ -687,9 +502,8 @@ def dom_upload():
                     "url": url, "context_id": str(existing_child.id)})
                 embedded_documents.append(document)
         try:
-            gevent.spawn(upload_documents, connection, existing_context_item.id, plug, chroma_collection,
-                         None, embedded_documents, is_tabular=False, is_website=True, room=str(user.id),
-                         is_recording=True)
+            enqueue_ingestion("dom", existing_context_item.id, plug.id, user.id, {
+                "documents": [{"text": document.text, "metadata": document.metadata} for document in embedded_documents]})
         except Exception as e:
             if not existing_context_item:
                 ContextItem.objects(id=existing_child.id).delete()
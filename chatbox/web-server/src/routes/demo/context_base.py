@@ -17,6 +17,8 @@ from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index import VectorStoreIndex
 from llama_index.indices import SummaryIndex
 from src.helper.crawl import ApifyActor
+from src.database.sqlite.bm25 import BM25Store
+from src.helper.token_usage import token_usage_ledger
 from src.helper import (
     get_token_counter,
     is_valid_base_url,
@@ -132,9 +134,10 @@ def upload_documents(connection, id, plug, chroma_collection, formatted_file_nam
         for split_document in split_documents:
             VectorStoreIndex(split_document, storage_context=storage_context,
                              show_progress=True if flask_env == "development" else False)
+        # keyword index for hybrid retrieval, ids match the Chroma ids
+        BM25Store().add_documents(plug.id, documents)
 
-        plug.token += (token_counter.total_llm_token_count +
-                       token_counter.total_embedding_token_count)
+        token_usage_ledger.record(plug.id, token_counter, source="upload")
 
         summary_index = SummaryIndex.from_documents(documents)
         query_engine = summary_index.as_query_engine(
@@ -142,10 +145,9 @@ def upload_documents(connection, id, plug, chroma_collection, formatted_file_nam
         summary_str = query_engine.query(
             "Summarize these documents in under 300 words, must have 1 title and 1 subtitle, respond in markdown format")
 
-        # Update tokens,updatedAt, ...
-        plug.client.origin = crawl_url
-        plug.updatedAt = datetime.datetime.now(pytz.UTC)
-        plug.save()
+        # only these fields, a save of the whole plug could overwrite the token counters the ledger increments
+        Plug.objects(id=plug.id).update_one(
+            set__client__origin=crawl_url, max__updatedAt=datetime.datetime.now(pytz.UTC))
 
         # Update upload status to finished
         data.summary = str(summary_str)
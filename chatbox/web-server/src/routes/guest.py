@@ -5,8 +5,9 @@ from src.constants.http_status_codes import (
 )
 from bson.objectid import ObjectId
 from flask_jwt_extended import jwt_required, get_jwt_identity
-import math
 from src.config.config import URL_PATH
+from src.helper.pagination import count_cache, keyset_stages, get_next_cursor, get_page_info
+from src.services.historyService import get_user_plug_id
 guest = Blueprint("guest", __name__, url_prefix=f"{URL_PATH}/web/api/v1/guest")
 
 
@@ -25,86 +26,28 @@ def get_guests():
         if page_size > 30:
             page_size = 30
 
-        pipeline = [
-            {
-                "$match": {
-                    "client._id": ObjectId(client_id),
-                    "userId": ObjectId(user_id),
-                    "active": True,
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "guest",
-                    "localField": "client._id",
-                    "foreignField": "client",
-                    "as": "guests"
-                }
-            },
-            {
-                "$addFields": {
-                    "totalDocuments": {"$size": "$guests"},
-                }
-            },
-            {
-                "$project": {
-                    "_id": 0,
-                    "totalDocuments": 1,
-                    "guests": {
-                        "$map": {
-                            "input": "$guests",
-                            "as": "guest",
-                            "in": {
-                                "_id": "$$guest._id",
-                                "ip": "$$guest.ip"
-                            }
-                        }}
-                }
-            },
-            {
-                "$unwind": "$guests"
-            },
-            {
-                "$addFields": {
-                    "guests._id": {"$toString": "$guests._id"}
-                }
-            },
-            {
-                "$sort": {
-                    "guests._id": -1
-                }
-            },
-            {
-                "$skip": (page - 1) * page_size
-            },
-            {
-                "$limit": page_size
-            },
-            {
-                "$group": {
-                    "_id": "$_id",
-                    "totalDocuments": {"$first": "$totalDocuments"},
-                    "guests": {"$push": "$guests"}
-                }
-            },
+        # id of the last guest of the previous page
+        cursor = request.args.get('cursor')
+        if cursor and not ObjectId.is_valid(cursor):
+            return {"code": 400, "message": "Invalid cursor"}, HTTP_400_BAD_REQUEST
+
+        if not get_user_plug_id(client_id, user_id):
+            return {"code": 200, "data": [], **get_page_info(0, page, page_size, None), "message": "Guests retrieved successfully"}, HTTP_200_OK
+
+        # newest first on the (client, -_id) index, only the page is read
+        pipeline = keyset_stages({"client": ObjectId(client_id)}, page, page_size, cursor) + [
             {
                 "$project": {
-                    "_id": 0,
+                    "_id": {"$toString": "$_id"},
+                    "ip": 1
                 }
             }
         ]
+        guests = list(Guest.objects().aggregate(pipeline))
+        total_documents = count_cache.get(
+            ("guest", client_id), lambda: Guest.objects(client=ObjectId(client_id)).count())
 
-        results = list(Plug.objects().aggregate(*pipeline))
-        if results:
-            total_documents = results[0]['totalDocuments']
-            total_pages = math.ceil(total_documents / page_size)
-            guests = results[0]['guests']
-        else:
-            total_documents = 0
-            total_pages = 0
-            guests = []
-
-        return {"code": 200, "data": guests, "page": page * 1, "pageSize": page_size * 1, "totalPages": total_pages * 1,   "totalItems": total_documents, "message": "Guests retrieved successfully"}, HTTP_200_OK
+        return {"code": 200, "data": guests, **get_page_info(total_documents, page, page_size, get_next_cursor(guests, page_size, key="_id")), "message": "Guests retrieved successfully"}, HTTP_200_OK
 
     except Exception as e:
         return {"code": 500, "message": "Failed to retrieve guests", "error": str(e)}, HTTP_500_INTERNAL_SERVER_ERROR
@@ -249,6 +192,7 @@ def delete_guest(guest_id):
             return {"code": 404, f"message": "Guest not found"}, HTTP_404_NOT_FOUND
 
         Guest.objects(id=ObjectId(guests[0]['_id'])).delete()
+        count_cache.invalidate(("guest", client_id))
         return {"code": 200, "data": guests[0], "message": "Guest deleted successfully"}, HTTP_200_OK
 
     except Exception as e:
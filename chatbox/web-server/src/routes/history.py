@@ -27,12 +27,16 @@ def get_history_message_by_client_id_history_id():
         history_id = request.args.get("historyId")
         page = request.args.get("page", 1, type=int)
         page_size = request.args.get("pageSize", 10, type=int)
+        # id of the last message of the previous page, pages after it are read without skipping
+        cursor = request.args.get("cursor")
         if not ObjectId.is_valid(client_id) or not ObjectId.is_valid(history_id):
             return {"code": 400, "message": "Invalid id"}, HTTP_400_BAD_REQUEST
+        if cursor and not ObjectId.is_valid(cursor):
+            return {"code": 400, "message": "Invalid cursor"}, HTTP_400_BAD_REQUEST
         if int(page_size) > 30:
             page_size = 30
         result = historyService.handle_get_history_message_by_client_id_history_id(history_id, client_id, page,
-                                                                                   page_size, user_id)
+                                                                                   page_size, user_id, cursor)
         if not result:
             return {"code": 404, "message": "History not found"}, HTTP_404_NOT_FOUND
 
@@ -85,6 +89,8 @@ def search_client_message():
         client_id = request.args.get("clientId")
         page = request.args.get("page", 1, type=int)
         page_size = request.args.get("pageSize", 10, type=int)
+        # nextCursor of the previous page
+        cursor = request.args.get("cursor")
 
         if not ObjectId.is_valid(client_id):
             return {"code": 400, "message": "Invalid client id"}, HTTP_400_BAD_REQUEST
@@ -93,13 +99,18 @@ def search_client_message():
             page_size = 30
 
         if not message:
+            if cursor and not ObjectId.is_valid(cursor):
+                return {"code": 400, "message": "Invalid cursor"}, HTTP_400_BAD_REQUEST
             result = historyService.handle_get_histories_by_client_id(
-                client_id, page, page_size, user_id)
+                client_id, page, page_size, user_id, cursor)
             return {"code": 200, "message": "Client history retrieved successfully", **result}, HTTP_200_OK
 
         elif message:
+            search_cursor = clientService.parse_search_cursor(cursor) if cursor else None
+            if cursor and not search_cursor:
+                return {"code": 400, "message": "Invalid cursor"}, HTTP_400_BAD_REQUEST
             result = clientService.handle_search_client_message(
-                page, page_size, client_id, message, user_id)
+                page, page_size, client_id, message, user_id, search_cursor)
             return {"code": 200, "message": "Search successfully", **result}, HTTP_200_OK
         return {"code": 400, "message": "Invalid query params"}, HTTP_400_BAD_REQUEST
     except Exception as e:
@@ -5,8 +5,9 @@ from src.constants.http_status_codes import (
 )
 from bson.objectid import ObjectId
 from flask_jwt_extended import jwt_required, get_jwt_identity
-import math
 from src.config.config import URL_PATH
+from src.helper.pagination import count_cache, keyset_stages, get_next_cursor, get_page_info
+from src.services.historyService import is_user_history, count_messages
 message = Blueprint("message", __name__, url_prefix=f"{URL_PATH}/web/api/v1/message")
 
 
@@ -24,129 +25,34 @@ def get_messages():
         page_size = int(request.args.get('pageSize', 30))
         if page_size > 60:
             page_size = 60
-        pipeline = [
-            {
-                "$match": {
-                    "_id": ObjectId(history_id),
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "message",
-                    "localField": "_id",
-                    "foreignField": "history",
-                    "as": "messages",
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "guest",
-                    "localField": "guest",
-                    "foreignField": "_id",
-                    "as": "guest"
-                }
-            },
-            {
-                "$project": {
-                    "messages": 1,
-                    "guest": {"$arrayElemAt": ["$guest", 0]}
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "plug",
-                    "localField": "guest.client",
-                    "foreignField": "client._id",
-                    "as": "plug"
-                }
-            },
-            {
-                "$project": {
-                    "messages": 1,
-                    "messages": {
-                        "$map": {
-                            "input": "$messages",
-                            "as": "message",
-                            "in": {
-                                "_id": "$$message._id",
-                                "role": "$$message.role",
-                                "content": "$$message.content",
-                                "createdAt": {
-                                        "$toLong": {
-                                            "$toDate": "$$message.createdAt"
-                                        }
-                                    }
-                            }
-                        }},
-                    "plug": {"$arrayElemAt": ["$plug", 0]}
-                }
-            },
-            {
-                "$match": {
-                    "plug.userId": ObjectId(user_id),
-                }
-            },
-            {
-                "$addFields": {
-                    "totalDocuments": {"$size": "$messages"},
-                }
-            },
-            {
-                "$unwind": "$messages"
-            },
-            {
-                "$sort": {
-                    "messages._id": -1
-                }
-            },
-            {
-                "$skip": (page - 1) * page_size
-            },
-            {
-                "$limit": page_size
-            },
-            {
-                "$addFields": {
-                    "messages._id": {"$toString": "$messages._id"},
-                }
-            },
-            {
-                "$addFields": {
-                    "messages.id": "$messages._id"
-                }
-            },
-            {
-                "$project": {
-                    "messages._id": 0
-                }
-            },
-            {
-                "$group": {
-                    "_id": "$_id",
-                    "totalDocuments": {"$first": "$totalDocuments"},
-                    "messages": {"$push": "$messages"}
-                }
-            },
+        # id of the last message of the previous page
+        cursor = request.args.get('cursor')
+        if cursor and not ObjectId.is_valid(cursor):
+            return {"code": 400, "message": "Invalid cursor"}, HTTP_400_BAD_REQUEST
+
+        if not is_user_history(history_id, user_id):
+            return {"code": 200, "data": {'messages': []}, **get_page_info(0, page, page_size, None), "message": "Messages retrieved successfully"}, HTTP_200_OK
+
+        # newest first on the (history, _id) index, only the page is read
+        pipeline = keyset_stages({"history": ObjectId(history_id)}, page, page_size, cursor) + [
             {
                 "$project": {
-                    "messages": 1,
-                    "totalDocuments": 1,
-                    "_id": 0
-                }
-            },
-
+                    "_id": 0,
+                    "id": {"$toString": "$_id"},
+                    "role": 1,
+                    "content": 1,
+                    "createdAt": {
+                        "$toLong": {
+                            "$toDate": "$createdAt"
+                        }
+                    }
+                }
+            }
         ]
-        results = list(History.objects().aggregate(*pipeline))
-        if results:
-            total_documents = results[0]['totalDocuments']
-            total_pages = math.ceil(total_documents / page_size)
-            messages = results[0]['messages']
-        else:
-            total_documents = 0
-            total_pages = 0
-            messages = []
+        messages = list(Message.objects().aggregate(pipeline))
+        total_documents = count_messages(history_id)
 
-        return {"code": 200, "data": {'messages': messages}, "page": page * 1, "pageSize": page_size * 1, "totalPages": total_pages * 1,   "totalItems": total_documents, "message": "Messages retrieved successfully"}, HTTP_200_OK
+        return {"code": 200, "data": {'messages': messages}, **get_page_info(total_documents, page, page_size, get_next_cursor(messages, page_size)), "message": "Messages retrieved successfully"}, HTTP_200_OK
 
     except Exception as e:
         return {"code": 500, "message": "Failed to retrieve messages", "error": str(e)}, HTTP_500_INTERNAL_SERVER_ERROR
@@ -343,6 +249,7 @@ def delete_message(message_id):
             return {"code": 404, f"message": "Message not found"}, HTTP_404_NOT_FOUND
 
         Message.objects(id=ObjectId(messages[0]['_id'])).delete()
+        count_cache.invalidate(("message", history_id))
         return {"code": 200, "data": messages[0], "message": "Message deleted successfully"}, HTTP_200_OK
 
     except Exception as e:
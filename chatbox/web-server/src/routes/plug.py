@@ -1,7 +1,7 @@
 from datetime import datetime, timedelta
 from flask import Blueprint, request, make_response
-from mongoengine import ValidationError, Q
-from src.models import Plug, Message, Subscription, User, Client, Guest, History, MODEL_DICT, FEATURE_DICT
+from mongoengine import ValidationError
+from src.models import Plug, Message, User, Client, MODEL_DICT, FEATURE_DICT
 from src.constants.http_status_codes import (
     HTTP_200_OK, HTTP_201_CREATED, HTTP_400_BAD_REQUEST, HTTP_500_INTERNAL_SERVER_ERROR, HTTP_404_NOT_FOUND)
 from bson.objectid import ObjectId
@@ -9,9 +9,10 @@ from flask_jwt_extended import jwt_required, get_jwt_identity
 from src.services import plugService
 from calendar import month_name
 from src.helper import growth, dict_to_list_of_lists
+from src.helper.analytics import get_daily_analytics
+from src.helper.auth_context import get_auth_context, invalidate_auth_context
 from src.config.config import URL_PATH
 import pytz
-import copy
 from dateutil.relativedelta import relativedelta
 
 
@@ -89,8 +90,8 @@ def create_plug():
         data = request.json
         user_id = get_jwt_identity()
 
-        user = User.objects(id=user_id).first()
-        plug_limit = user.plugLimit
+        context = get_auth_context(user_id)
+        plug_limit = context.user.plugLimit
         total_plugs = Plug.objects(userId=user_id).count()
 
         # Check plug limit
@@ -104,8 +105,7 @@ def create_plug():
             return {"code": 400, "message": f"Names can't have more than 20 characters"}, HTTP_400_BAD_REQUEST
 
         # Check subscription
-        subscription = Subscription.objects(
-            id=ObjectId(user.subscriptionId)).first()
+        subscription = context.subscription
         if not subscription:
             return {"code": 400, "message": "Please subscribe to create a plug"}, HTTP_400_BAD_REQUEST
 
@@ -119,20 +119,18 @@ def create_plug():
         client = Client()
         plug.client = client
         plug.save()
+        invalidate_auth_context(user_id)
         customize_features = {
         }
-        print(subscription.featuresLimit)
-        subscription_features_limit = subscription.featuresLimit if not None else []
-        for limit in subscription_features_limit:
+        # the subscription is shared by the cached auth contexts, its limits aren't renamed in place
+        for limit in subscription.featuresLimit or []:
             if limit['name'] == "gpt-3.5" or limit['name'] == "gpt-4":
-                if limit['name'] == "gpt-3.5":
-                    limit['name'] = "gpt-4"
-                limit['name'] = MODEL_DICT.get(limit['name'])
+                name = MODEL_DICT.get("gpt-4")
             else:
-                limit['name'] = FEATURE_DICT.get(limit['name'])
+                name = FEATURE_DICT.get(limit['name'])
             feature = {
-                f"{limit['name']}": {
-                    "limit": int(limit['limit']) if not limit['unlimited'] and 'gpt' not in limit['name'] else -1,
+                f"{name}": {
+                    "limit": int(limit['limit']) if not limit['unlimited'] and 'gpt' not in name else -1,
                     "active": True,
                     "unlimited": limit['unlimited']
                 }
@@ -161,8 +159,8 @@ def update_plug(plug_id):
         if not ObjectId.is_valid(plug_id):
             return {"code": 400, "message": "Invalid id"}, HTTP_400_BAD_REQUEST
 
-        user = User.objects(id=user_id).first()
-        if not user:
+        context = get_auth_context(user_id)
+        if not context.user:
             return {"code": 404, "message": "User not found"}, HTTP_404_NOT_FOUND
 
         data = request.json
@@ -179,13 +177,11 @@ def update_plug(plug_id):
         # user can only modify these fields
         modifiable_fields = ["model", "plugName", "isAutoCreateMap", "userKey"]
 
-        subscription = Subscription.objects(
-            id=ObjectId(user.subscriptionId)).first()
-        if not subscription:
+        if not context.subscription:
             return {"code": 400, "message": "Please subscribe to update a plug"}, HTTP_400_BAD_REQUEST
 
         model = data.get("model", None)
-        if model and model not in subscription.models:
+        if model and not context.has_model(model):
             return {"code": 400, "message": "The user's subscription doesn't have that llm"}, HTTP_400_BAD_REQUEST
         if model == "gpt-3.5":
             model = "gpt-4"
@@ -202,6 +198,7 @@ def update_plug(plug_id):
                         else:
                             plug[field] = field_value
         plug.save()
+        invalidate_auth_context(user_id)
 
         return {
             "code": 200,
@@ -239,11 +236,12 @@ def delete_plug(plug_id):
         list_plugs = Plug.objects(userId=user_id)
         if len(list_plugs) >= 1:
             list_plugs.order_by("-id")
-            user = User.objects(id=user_id).first()
+            user = get_auth_context(user_id).user
             for i in range(0, len(list_plugs)):
                 if not list_plugs[i].active and i < user.plugLimit:
                     list_plugs[i].update(active=True)
                     break
+        invalidate_auth_context(user_id)
         return {
             "code": 200,
             "data": plug.to_json(),
@@ -306,14 +304,12 @@ def export_plug(plug_id):
 @jwt_required()
 def get_analytics(plug_id):
     try:
-        user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
-        if user is None:
+        context = get_auth_context()
+        if context.user is None:
             return {"code": 404, "message": "User not found"}, HTTP_404_NOT_FOUND
-        plug = Plug.objects(id=ObjectId(plug_id), userId=user_id).first()
+        plug = context.get_plug(plug_id)
         if not plug:
             return {"code": 404, "message": "Plug not found"}, HTTP_404_NOT_FOUND
-        guests = list(Guest.objects(client=plug.client.id))
 
         current_date = datetime.now(pytz.UTC).replace(
             hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
@@ -322,87 +318,36 @@ def get_analytics(plug_id):
         next_month = first_day_of_month + relativedelta(months=1)
         last_month = first_day_of_month - relativedelta(months=1)
 
-        last_month_guest_dict = {}
-        current_month_guest_dict = {}
-
-        current_day_last_month = last_month
-        current_day = first_day_of_month
-        while current_day_last_month < first_day_of_month:
-            timestamp = current_day_last_month.timestamp()
-            last_month_guest_dict[timestamp] = 0
-            current_day_last_month += timedelta(days=1)
-
-        while current_day < next_month:
-            timestamp = current_day.timestamp()
-            current_month_guest_dict[timestamp] = 0
-            current_day += timedelta(days=1)
-
-        current_month_history_dict = copy.deepcopy(current_month_guest_dict)
-        last_month_history_dict = copy.deepcopy(last_month_guest_dict)
-
-        current_month_duration_dict = copy.deepcopy(current_month_guest_dict)
-        last_month_duration_dict = copy.deepcopy(last_month_guest_dict)
-
-        last_month_guests = 0
-        this_month_guests = 0
-        guest_ids = []
-
-        # Iterate and count each day
-        for guest in guests:
-            guest_ids.append(guest.id)
-            day = guest.createdAt.replace(
-                hour=0, minute=0, second=0, microsecond=0).timestamp()
-            if guest.createdAt.month == last_month.month:
-                if day in last_month_guest_dict:
-                    last_month_guest_dict[day] += 1
-                    last_month_guests += 1
-            elif guest.createdAt.month == first_day_of_month.month:
-                if day in current_month_guest_dict:
-                    current_month_guest_dict[day] += 1
-                    this_month_guests += 1
-
-        last_month_histories = 0
-        this_month_histories = 0
-
-        last_month_duration = 0
-        this_month_duration = 0
-
-        histories = list(History.objects(Q(guest__in=guest_ids)))
-        for history in histories:
-            duration = history.updatedAt.timestamp() - history.createdAt.timestamp()
-            day = history.createdAt.replace(
-                hour=0, minute=0, second=0, microsecond=0).timestamp()
-            if history.createdAt.month == last_month.month:
-                if day in last_month_history_dict:
-                    last_month_histories += 1
-                    last_month_history_dict[day] += 1
-                if day in last_month_duration_dict:
-                    last_month_duration_dict[day] += duration
-                    last_month_duration += duration
-            elif history.createdAt.month == first_day_of_month.month:
-                if day in current_month_history_dict:
-                    this_month_histories += 1
-                    current_month_history_dict[day] += 1
-                if day in current_month_duration_dict:
-                    current_month_duration_dict[day] += duration
-                    this_month_duration += duration
-
-        current_duration_key_list = list(current_month_duration_dict.keys())
-        last_duration_key_list = list(last_month_duration_dict.keys())
-        for i in range(len(current_duration_key_list)):
-            index = current_duration_key_list[i]
-            history_num = 0
-            if index in current_month_history_dict:
-                history_num = current_month_history_dict[index]
-            if history_num != 0 and index in current_month_duration_dict:
-                current_month_duration_dict[index] /= history_num
-        for i in range(len(last_duration_key_list)):
-            index = last_duration_key_list[i]
-            history_num = 0
-            if index in last_month_history_dict:
-                history_num = last_month_history_dict[index]
-            if history_num != 0 and index in last_month_duration_dict:
-                last_month_duration_dict[index] /= history_num
+        # two months of daily rollups (see src/helper/analytics.py)
+        rows = get_daily_analytics(plug.client.id, last_month, next_month)
+
+        def get_series(start, end, value):
+            series = {}
+            day = start
+            while day < end:
+                series[day.timestamp()] = value(rows[day]) if day in rows else 0
+                day += timedelta(days=1)
+            return series
+
+        def average_duration(row):
+            return row.duration / row.conversations if row.conversations else 0
+
+        last_month_guest_dict = get_series(last_month, first_day_of_month, lambda row: row.guests)
+        current_month_guest_dict = get_series(first_day_of_month, next_month, lambda row: row.guests)
+        last_month_history_dict = get_series(last_month, first_day_of_month, lambda row: row.conversations)
+        current_month_history_dict = get_series(first_day_of_month, next_month, lambda row: row.conversations)
+        last_month_duration_dict = get_series(last_month, first_day_of_month, average_duration)
+        current_month_duration_dict = get_series(first_day_of_month, next_month, average_duration)
+
+        last_month_rows = [row for day, row in rows.items() if day < first_day_of_month]
+        this_month_rows = [row for day, row in rows.items() if day >= first_day_of_month]
+        last_month_guests = sum(row.guests for row in last_month_rows)
+        this_month_guests = sum(row.guests for row in this_month_rows)
+        last_month_histories = sum(row.conversations for row in last_month_rows)
+        this_month_histories = sum(row.conversations for row in this_month_rows)
+        last_month_duration = sum(row.duration for row in last_month_rows)
+        this_month_duration = sum(row.duration for row in this_month_rows)
+
         data = {
             'graph1': {
                 'series': [
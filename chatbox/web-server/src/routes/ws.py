@@ -1,7 +1,10 @@
 from flask_socketio import SocketIO, join_room
 from flask import Blueprint, request
-from src.config.config import URL_PATH
+from src.config.config import URL_PATH, PROGRESS_EMIT_INTERVAL, SOCKETIO_MESSAGE_QUEUE, SOCKETIO_TRANSPORTS
+from src.helper.progress_emitter import ProgressEmitter
+from src.helper.socketio_manager import get_client_manager
 from dotenv import load_dotenv
+import atexit
 import os
 import json
 
@@ -9,26 +12,44 @@ load_dotenv()
 flask_env = os.environ.get("FLASK_ENV")
 
 path = f"{URL_PATH}/web/socket.io"[1:]
-socketio = SocketIO(path=path, cors_allowed_origins="*",
+socketio = SocketIO(path=path, cors_allowed_origins="*", transports=SOCKETIO_TRANSPORTS,
                     logger=True if flask_env == 'development' else False,
                     engineio_logger=True if flask_env == 'development' else False)
 
+
+def init_socketio(app=None):
+    """
+    Events go through the message queue, so an emit from any web worker or ingestion worker
+    (task.py) reaches the clients of a room whichever worker they are connected to. Without an
+    app the manager only publishes, for processes that serve no clients.
+    """
+    socketio.init_app(app, client_manager=get_client_manager(
+        SOCKETIO_MESSAGE_QUEUE, write_only=app is None))
+
+
+# emit-only until create_app initializes the server with its app
+init_socketio()
+
 websocket = Blueprint("websocket", __name__,
                       url_prefix=f"{URL_PATH}/web/api/v1/websocket")
 
 
-def progressUpdate(progress, is_file, message, room, context_item={}):
-    response = {**context_item, 'progress': progress,
-                'isFile': is_file, 'message': message}
-    print("progressUpdate",message)
-    socketio.emit('context_item_upload', response, broadcast=True, to=room)
+progress_emitter = ProgressEmitter(
+    socketio.emit, flush_interval=PROGRESS_EMIT_INTERVAL)
+# don't drop the last window's updates on graceful worker shutdown
+atexit.register(progress_emitter.flush_quietly)
+
+
+def progressUpdate(progress, is_file, message, room, context_item=None):
+    # context_item is a ContextItem or its to_json(), see ProgressEmitter
+    progress_emitter.publish('context_item_upload', room, context_item=context_item,
+                             progress=progress, isFile=is_file, message=message)
     socketio.sleep(0)
 
 
-def statusUpdate(is_file, message, room, context_item={}, event="message"):
-    response = {**context_item, 'isFile': is_file, 'message': message}
-    print("statusUpdate",message)
-    socketio.emit(event, response, broadcast=True, to=room)
+def statusUpdate(is_file, message, room, context_item=None, event="message"):
+    progress_emitter.publish(event, room, context_item=context_item,
+                             isFile=is_file, message=message)
     socketio.sleep(0)
 
 
@@ -50,20 +71,21 @@ def notify():
     room = body.get("room")
     context_item = body.get("contextItem")
 
-    response = {**context_item, 'isFile': False}
+    fields = {'isFile': False}
 
     if event_type == 'ACTOR.RUN.CREATED':
-        response['message'] = 'Run initiated'
-        response['progress'] = 30
+        fields['message'] = 'Run initiated'
+        fields['progress'] = 30
     elif event_type == 'ACTOR.RUN.SUCCEEDED' or event_type == 'ACTOR.RUN.TIMED_OUT':
-        response['message'] = 'Run finished'
-        response['progress'] = 50
+        fields['message'] = 'Run finished'
+        fields['progress'] = 50
     elif event_type == 'ACTOR.RUN.ABORTED':
-        response['message'] = 'Run aborted'
-        response['progress'] = 50
+        fields['message'] = 'Run aborted'
+        fields['progress'] = 50
     elif event_type == 'ACTOR.BUILD.FAILED':
-        response['message'] = 'Run failed'
-        response['progress'] = 100
+        fields['message'] = 'Run failed'
+        fields['progress'] = 100
 
-    socketio.send(response, broadcast=True, to=room)
+    # Apify calls whichever worker the load balancer picks, the emit is fanned out to the room
+    progress_emitter.publish('message', room, context_item=context_item, **fields)
     return "ok", 200
@@ -26,3 +26,6 @@ from src.services.contextBaseService import (
     handler_create_map_point,
     delete_map_point
 )
+from src.services.ingestionService import (
+    enqueue_ingestion
+)
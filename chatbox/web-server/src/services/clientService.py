@@ -1,183 +1,173 @@
-from src.models import Client, User, Subscription, Plug, History, Message
+import re
+from src.models import History, Message
+from src.services.historyService import get_user_plug_id
+from src.helper.pagination import get_page_info
+from src.config.config import MESSAGE_SEARCH_MAX_MATCHES, MESSAGE_SEARCH_SNIPPET_LENGTH
 from bson import ObjectId
-import math
 
+# "quoted phrases" or words of a search
+SEARCH_TERM_PATTERN = re.compile(r'"([^"]+)"|(\S+)')
 
-def query_history_client_by_message(client_id, page, page_size, regex_filter, user_id):
-    pipeline = [
-        {
-            "$match": {
-                "client._id": ObjectId(client_id),
-                "active": True,
-                "userId": ObjectId(user_id)
-            }
-        },
+
+def get_search_terms(search):
+    # -word excludes it, there's nothing to highlight
+    terms = [phrase or word for phrase, word in SEARCH_TERM_PATTERN.findall(search)
+             if phrase or not word.startswith("-")]
+    # longest first, so a phrase is highlighted rather than its words
+    return sorted({term.strip() for term in terms if term.strip()}, key=len, reverse=True)
+
+
+def get_snippet(content, terms, length=MESSAGE_SEARCH_SNIPPET_LENGTH):
+    """
+    Part of content around the first match of the terms, with the [start, end] offsets of the
+    matches in it. Terms match at word starts, case-insensitively, like the text index.
+    """
+    pattern = re.compile(r"(?<!\w)(?:" + "|".join(re.escape(term)
+                         for term in terms) + ")", re.IGNORECASE) if terms else None
+    first = pattern.search(content) if pattern else None
+    start = max(0, first.start() - length // 3) if first else 0
+    # whole words at both ends
+    if start > 0:
+        space = content.rfind(" ", 0, start)
+        start = space + 1 if space != -1 and start - space < 20 else start
+    end = min(len(content), start + length)
+    if end < len(content):
+        space = content.find(" ", end)
+        end = space if space != -1 and space - end < 20 else end
+
+    prefix = "..." if start > 0 else ""
+    snippet = prefix + content[start:end] + ("..." if end < len(content) else "")
+    highlights = [[match.start() + len(prefix), match.end() + len(prefix)]
+                  for match in pattern.finditer(content[start:end])] if pattern else []
+    return snippet, highlights
+
+
+def parse_search_cursor(cursor):
+    """(score, history id) of a cursor "score:historyId", None when it isn't one."""
+    try:
+        score, history_id = cursor.split(":")
+        return float(score), ObjectId(history_id)
+    except Exception:
+        return None
+
+
+def query_search_client_messages(client_id, user_id, search, page, page_size, cursor=None):
+    """
+    Conversations of the client whose messages match the search on the text index, ranked by their
+    best message. The MESSAGE_SEARCH_MAX_MATCHES best messages are grouped by history, then the
+    page (after the cursor) is joined with its message, history and guest.
+    """
+    if not get_user_plug_id(client_id, user_id):
+        return None
+
+    page_stages = []
+    if cursor:
+        score, history_id = cursor
+        page_stages.append({"$match": {"$or": [{"score": {"$lt": score}},
+                                               {"score": score, "_id": {"$lt": history_id}}]}})
+    page_stages.append({"$sort": {"score": -1, "_id": -1}})
+    if not cursor and page > 1:
+        page_stages.append({"$skip": (page - 1) * page_size})
+    page_stages += [
+        {"$limit": page_size},
         {
             "$lookup": {
-                "from": "guest",
-                "localField": "client._id",
-                "foreignField": "client",
-                "as": "client_guests"
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "client_guests": 1
-            }
-        },
-        {
-            "$unwind": "$client_guests"
-        },
-        {
-            "$replaceRoot": {
-                "newRoot": "$client_guests"
+                "from": Message._get_collection_name(),
+                "localField": "messageId",
+                "foreignField": "_id",
+                "as": "message"
             }
         },
         {
             "$lookup": {
-                "from": "history",
+                "from": History._get_collection_name(),
                 "localField": "_id",
-                "foreignField": "guest",
-                "as": "guest_histories"
-            }
-        },
-        {
-            "$unwind": "$guest_histories"
-        },
-        {
-            "$sort": {
-                "guest_histories._id": -1
+                "foreignField": "_id",
+                "as": "history"
             }
         },
         {
-            "$group": {
-                "_id": "$_id",
-                "histories": {
-                    "$push": {
-                        "ip": "$ip",
-                        "historyId": "$guest_histories._id",
-                        "createdAt": {"$toLong": {"$toDate": "$guest_histories.createdAt"}},
-                        "updatedAt": {"$toLong": {"$toDate": "$guest_histories.updatedAt"}},
-
-                    }
-                }
+            "$lookup": {
+                "from": "guest",
+                "localField": "history.guest",
+                "foreignField": "_id",
+                "as": "guest"
             }
         },
         {
             "$project": {
                 "_id": 0,
-                "histories": 1
+                "historyId": {"$toString": "$_id"},
+                "messageId": {"$toString": "$messageId"},
+                "score": 1,
+                "matches": 1,
+                "content": {"$arrayElemAt": ["$message.content", 0]},
+                "role": {"$arrayElemAt": ["$message.role", 0]},
+                "ip": {"$arrayElemAt": ["$guest.ip", 0]},
+                "createdAt": {"$toLong": {"$toDate": {"$arrayElemAt": ["$history.createdAt", 0]}}},
+                "updatedAt": {"$toLong": {"$toDate": {"$arrayElemAt": ["$history.updatedAt", 0]}}}
             }
-        },
-        {
-            "$unwind": "$histories"
-        },
-        {
-            "$group": {
-                "_id": "$histories.historyId",
-                "ip": {"$first": "$histories.ip"},
-                "createdAt": {"$first": "$histories.createdAt"},
-                "updatedAt": {"$first": "$histories.updatedAt"},
-            }
-        },
-        {
-            "$lookup": {
-                "from": "message",
-                "localField": "_id",
-                "foreignField": "history",
-                "as": "messages",
-            }
-        },
+        }
+    ]
+
+    pipeline = [
         {
             "$match": {
-                "messages.content": {**regex_filter}  # Filter for messages with the desired content
+                "client": ObjectId(client_id),
+                "$text": {"$search": search}
             }
         },
         {
             "$project": {
-                "messages": 0
-            }
-        },
-
-        {
-            "$group": {
-                "_id": None,
-                "histories": {
-                    "$push": {
-                        "historyId": {"$toString": "$_id"},
-                        "ip": "$ip",
-                        "createdAt": "$createdAt",
-                        "updatedAt": "$updatedAt"
-                    }
-                },
-                "total_items": {
-                    "$sum": 1
-                }
+                "history": 1,
+                "score": {"$meta": "textScore"}
             }
         },
         {
-            "$addFields": {
-                "total_items": {
-                    "$size": "$histories"
-                }
-            }
+            "$sort": {"score": {"$meta": "textScore"}, "_id": -1}
         },
         {
-            "$unwind": "$histories"
+            "$limit": MESSAGE_SEARCH_MAX_MATCHES
         },
         {
-            "$sort": {
-                "histories.historyId": -1
+            "$group": {
+                "_id": "$history",
+                "messageId": {"$first": "$_id"},
+                "score": {"$first": "$score"},
+                "matches": {"$sum": 1}
             }
         },
         {
-            "$skip": (page - 1) * page_size
-        },
-        {
-            "$limit": page_size
-        },
-        {
-            "$group": {
-                "_id": None,
-                "histories": {
-                    "$push": "$histories"
-                },
-                "total_items": {"$first": "$total_items"}
+            "$facet": {
+                "total": [{"$count": "count"}],
+                "page": page_stages
             }
         }
     ]
+    return list(Message.objects().aggregate(pipeline))[0]
 
-    result = list(Plug.objects().aggregate(pipeline))
-    return result
 
-
-def handle_search_client_message(page, page_size, client_id, message_content, user_id):
+def handle_search_client_message(page, page_size, client_id, message_content, user_id, cursor=None):
     try:
-        message_regex = f"(?i){message_content}"  # Case-insensitive regex pattern
-        regex_filter = {
-            "$regex": message_regex,
-            "$options": "i"
-        }
+        result = query_search_client_messages(
+            client_id, user_id, message_content, page, page_size, cursor)
+        total_items = result["total"][0]["count"] if result and result["total"] else 0
+        histories = result["page"] if result else []
 
-        result = query_history_client_by_message(client_id, page, page_size, regex_filter, user_id)
-        if not result:
-            return {
-                "data": [],
-                "totalItems": 0,
-                "totalPage": 1,
-                "page": 1,
-                "pageSize": page_size
-            }
-        total_page = math.ceil(result[0]["total_items"] / page_size)
-
-        serialized_result = {
-            "data": result[0]["histories"],
-            "totalItems": result[0]["total_items"],
-            "totalPage": total_page,
-            "page": page,
-            "pageSize": page_size
+        terms = get_search_terms(message_content)
+        for history in histories:
+            history["snippet"], history["highlights"] = get_snippet(
+                history.pop("content") or "", terms)
+
+        next_cursor = None
+        if len(histories) == page_size:
+            next_cursor = f"{histories[-1]['score']!r}:{histories[-1]['historyId']}"
+        page_info = get_page_info(total_items, page, page_size, next_cursor)
+        return {
+            "data": histories,
+            **page_info,
+            # former name, read by the dashboard search
+            "totalPage": page_info["totalPages"]
         }
-        return serialized_result
     except Exception as e:
         raise e
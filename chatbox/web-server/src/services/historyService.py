@@ -1,277 +1,87 @@
-import math
-
 from bson.objectid import ObjectId
-from src.models import Client, User, Subscription, Plug, History
+from src.models import Plug, History, Message
+from src.helper.pagination import count_cache, keyset_stages, get_next_cursor, get_page_info
 
 
-def query_get_histories_by_client_id(client_id, page, page_size, user_id):
-    pipeline = [
-        {
-            "$match": {
-                "client._id": ObjectId(client_id),
-                "active": True,
-                "userId": ObjectId(user_id)
-            }
-        },
-        {
-            "$lookup": {
-                "from": "guest",
-                "localField": "client._id",
-                "foreignField": "client",
-                "as": "client_guests"
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "client_guests": 1
-            }
-        },
-        {
-            "$unwind": "$client_guests"
-        },
+def get_user_plug_id(client_id, user_id):
+    """Id of the user's active plug of the client, None when the client isn't theirs."""
+    return Plug.objects(client__id=ObjectId(client_id), userId=ObjectId(user_id),
+                        active=True).scalar('id').first()
 
-        {
-            "$replaceRoot": {
-                "newRoot": "$client_guests"
-            }
-        },
-        {
-            "$lookup": {
-                "from": "history",
-                "localField": "_id",
-                "foreignField": "guest",
-                "as": "guest_histories"
-            }
-        },
-        {
-            "$unwind": "$guest_histories"
-        },
 
-        {
-            "$group": {
-                "_id": None,
-                "histories": {
-                    "$push": {
-                        "ip": "$ip",
-                        "guestId": {"$toString": "$_id"},
-                        "historyId": {"$toString": "$guest_histories._id"},
-                        "createdAt": {"$toLong": {"$toDate": "$guest_histories.createdAt"}},
-                        "updatedAt": {"$toLong": {"$toDate": "$guest_histories.updatedAt"}},
-                        "clientId": client_id,
-                    }
-                },
-                "total_items": {"$sum": 1}
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "histories": 1,
-                "total_items": 1
-            }
-        },
+def is_user_history(history_id, user_id):
+    client_id = History.objects(id=ObjectId(history_id)).scalar('client').first()
+    return client_id is not None and Plug.objects(
+        client__id=client_id, userId=ObjectId(user_id)).scalar('id').first() is not None
 
-        {
-            "$unwind": "$histories"
-        },
-        {
-            "$sort": {
-                "histories.historyId": -1
-            }
-        },
-        {
-            "$skip": (page - 1) * page_size
-        },
-        {
-            "$limit": page_size
-        },
-        {
-            "$group": {
-                "_id": None,
-                "histories": {
-                    "$push": "$histories"
-                },
-                "total_items": {"$first": "$total_items"}
-            }
-        },
 
-    ]
-    results = list(Plug.objects().aggregate(pipeline))
-    return results
+def count_histories(client_id):
+    return count_cache.get(("history", str(client_id)),
+                           lambda: History.objects(client=ObjectId(client_id)).count())
 
 
-def query_message_history_paginate(user_id, client_id, history_id, page, page_size):
-    pipeline = [
-        {
-            "$match": {
-                "client._id": ObjectId(client_id),
-                "active": True,
-                "userId": ObjectId(user_id)
-            }
-        },
+def count_messages(history_id):
+    return count_cache.get(("message", str(history_id)),
+                           lambda: Message.objects(history=ObjectId(history_id)).count())
+
+
+def query_get_histories_by_client_id(client_id, page, page_size, user_id, cursor=None):
+    """A page of the client's histories, newest first, None when the client isn't the user's."""
+    if not get_user_plug_id(client_id, user_id):
+        return None
+    # the page is taken on the (client, -_id) index, only its guests are joined
+    pipeline = keyset_stages({"client": ObjectId(client_id)}, page, page_size, cursor) + [
         {
             "$lookup": {
                 "from": "guest",
-                "localField": "client._id",
-                "foreignField": "client",
-                "as": "client_guests"
+                "localField": "guest",
+                "foreignField": "_id",
+                "as": "guest_doc"
             }
         },
         {
             "$project": {
                 "_id": 0,
-                "client_guests": 1
-            }
-        },
-        {
-            "$unwind": "$client_guests"
-        },
-        {
-            "$replaceRoot": {
-                "newRoot": "$client_guests"
-            }
-        },
-        {
-            "$lookup": {
-                "from": "history",
-                "localField": "_id",
-                "foreignField": "guest",
-                "as": "guest_histories"
-            }
-        },
-        {
-            "$unwind": "$guest_histories"
-        },
-        {
-            "$sort": {
-                "guest_histories._id": -1
+                "ip": {"$arrayElemAt": ["$guest_doc.ip", 0]},
+                "guestId": {"$toString": "$guest"},
+                "historyId": {"$toString": "$_id"},
+                "createdAt": {"$toLong": {"$toDate": "$createdAt"}},
+                "updatedAt": {"$toLong": {"$toDate": "$updatedAt"}},
+                "clientId": client_id,
             }
-        },
-        {
-            "$group": {
-                "_id": "$_id",
-                "histories": {
-                    "$push": {
-                        "ip": "$ip",
-                        "historyId": "$guest_histories._id",
-                        "createdAt": "$guest_histories.createdAt",
-                        "updatedAt": "$guest_histories.updatedAt",
+        }
+    ]
+    return list(History.objects().aggregate(pipeline))
 
-                    }
-                }
-            }
-        },
+
+def query_message_history_paginate(user_id, client_id, history_id, page, page_size, cursor=None):
+    """A page of the history's messages, oldest first, None when it isn't a history of the user's client."""
+    if not get_user_plug_id(client_id, user_id):
+        return None
+    if not History.objects(id=ObjectId(history_id), client=ObjectId(client_id)).scalar('id').first():
+        return None
+    pipeline = keyset_stages({"history": ObjectId(history_id)}, page, page_size, cursor,
+                             descending=False) + [
         {
             "$project": {
                 "_id": 0,
-                "histories": 1
-            }
-        },
-        {
-            "$unwind": "$histories"
-        },
-        {
-            "$group": {
-                "_id": "$histories.historyId",
-                "ip": {"$first": "$histories.ip"},
-                "updatedAt": {"$first": "$histories.updatedAt"},
-            }
-        },
-        {
-            "$match": {
-                "_id": ObjectId(history_id)
-            }
-        },
-        {
-            "$lookup": {
-                "from": "message",
-                "localField": "_id",
-                "foreignField": "history",
-                "as": "messages",
-            }
-        },
-        {
-            "$addFields": {
-                "total_items": {"$size": "$messages"},
+                "id": {"$toString": "$_id"},
+                "content": 1,
+                "role": 1
             }
-        },
-        {
-            "$project": {
-                "historyId": "$_id",
-                "total_items": 1,
-                "messages": {
-                    "$map": {
-                        "input": "$messages",
-                        "as": "message",
-                        "in": {
-                            "id": {"$toString": "$$message._id"},
-                            "content": "$$message.content",
-                            "role": "$$message.role"
-                        }
-                    }}
-            }
-        },
+        }
     ]
-    results = list(Plug.objects().aggregate(pipeline))
-    return results
+    return list(Message.objects().aggregate(pipeline))
 
 
 def query_delete_history(user_id, client_id, history_id):
+    if not get_user_plug_id(client_id, user_id):
+        return []
     pipeline = [
         {
             "$match": {
-                "client._id": ObjectId(client_id),
-                "userId": ObjectId(user_id),
-                "active": True,
-            }
-        },
-        {
-            "$lookup": {
-                "from": "guest",
-                "localField": "client._id",
-                "foreignField": "client",
-                "as": "guests"
-            }
-        },
-        {
-            "$project": {
-                "guests": 1,
-                "_id": 0
-            }
-        },
-        {
-            "$unwind": "$guests"
-        },
-        {
-            "$replaceRoot": {
-                "newRoot": "$guests"
-            }
-        },
-        {
-            "$lookup": {
-                "from": "history",
-                "localField": "_id",
-                "foreignField": "guest",
-                "as": "histories"
-            }
-        },
-        {
-            "$project": {
-                "histories": 1,
-            }
-        },
-        {
-            "$unwind": "$histories"
-        },
-        {
-            "$match": {
-                "histories._id": ObjectId(history_id)
-            }
-        },
-        {
-            "$replaceRoot": {
-                "newRoot": "$histories"
+                "_id": ObjectId(history_id),
+                "client": ObjectId(client_id)
             }
         },
         {
@@ -284,29 +94,20 @@ def query_delete_history(user_id, client_id, history_id):
             }
         }
     ]
-    results = list(Plug.objects().aggregate(pipeline))
-    return results
+    return list(History.objects().aggregate(pipeline))
 
 
-def handle_get_histories_by_client_id(client_id, page, page_size, user_id):
+def handle_get_histories_by_client_id(client_id, page, page_size, user_id, cursor=None):
     try:
-        result = query_get_histories_by_client_id(
-            client_id, page, page_size, user_id)
-        if not result:
-            return {
-                "data": [],
-                "totalItems": 0,
-                "totalPage": 0,
-                "page": page,
-                "pageSize": page_size
-            }
-        total_items = result[0]["total_items"]
+        histories = query_get_histories_by_client_id(
+            client_id, page, page_size, user_id, cursor)
+        if not histories:
+            total_items = count_histories(client_id) if histories is not None else 0
+            return {"data": [], **get_page_info(total_items, page, page_size, None)}
         return {
-            "data": result[0]["histories"],
-            "totalItems": total_items,
-            "totalPages": math.ceil(total_items / page_size),
-            "page": page,
-            "pageSize": page_size
+            "data": histories,
+            **get_page_info(count_histories(client_id), page, page_size,
+                            get_next_cursor(histories, page_size, key="historyId"))
         }
     except Exception as e:
         raise e
@@ -370,25 +171,21 @@ def handle_get_history_by_id(history_id, user_id):
     return results
 
 
-def handle_get_history_message_by_client_id_history_id(history_id, client_id, page, page_size, user_id):
+def handle_get_history_message_by_client_id_history_id(history_id, client_id, page, page_size, user_id,
+                                                       cursor=None):
     try:
         page = int(page)
         page_size = int(page_size)
-        result = query_message_history_paginate(
-            user_id, client_id, history_id, page, page_size)
-        if not result:
+        messages = query_message_history_paginate(
+            user_id, client_id, history_id, page, page_size, cursor)
+        if messages is None:
             return None
-        total_items = result[0]["total_items"]
-        total_pages = math.ceil(total_items / page_size)
-        serialized_result = {
-            "id": str(result[0]["historyId"]),
-            "messages": result[0]["messages"],
-            "totalItems": total_items,
-            "totalPages": total_pages,
-            "page": page,
-            "pageSize": page_size
+        return {
+            "id": history_id,
+            "messages": messages,
+            **get_page_info(count_messages(history_id), page, page_size,
+                            get_next_cursor(messages, page_size))
         }
-        return serialized_result
     except Exception as e:
         raise e
 
@@ -401,6 +198,8 @@ def handle_delete_history(user_id, client_id, history_id):
         else:
             history = History.objects(id=result[0]["historyId"]).first()
             history.delete()
+            count_cache.invalidate(("history", str(client_id)))
+            count_cache.invalidate(("message", str(history_id)))
             return result
     except Exception as e:
         raise e
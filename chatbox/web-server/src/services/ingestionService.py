@@ -0,0 +1,531 @@
+import datetime
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+import unicodedata
+import pytz
+import redis
+from io import BytesIO
+from bson import ObjectId
+from gridfs import GridFS
+from mongoengine import Q
+from mongoengine.connection import get_db
+from werkzeug.datastructures import FileStorage
+from llama_index import VectorStoreIndex, SummaryIndex
+from llama_index.readers.schema.base import Document
+from llama_index.storage.storage_context import StorageContext
+from llama_index.vector_stores import ChromaVectorStore
+from llama_index.chat_engine.simple import SimpleChatEngine
+from llama_index.llms import OpenAI
+from src.models import ContextItem, Plug, IngestionJob
+from src.database.chromadb import ChromaClient
+from src.database.sqlite import SQLiteConnection
+from src.database.sqlite.bm25 import BM25Store
+from src.routes.ws import progressUpdate
+from src.helper import get_token_counter, init_token_counting, iter_batches
+from src.helper.crawl import ApifyActor
+from src.helper.file_reader import FileReader, DEFAULT_FILE_READER_CLS
+from src.helper.table_schema_index import upsert_table_schema, get_table_context
+from src.helper.tabular_import import import_table_chunks
+from src.helper.token_usage import token_usage_ledger
+from src.services.contextBaseService import handler_create_map_point
+from src.config.config import (
+    REDIS_URL,
+    APIFY_TOKEN,
+    UPLOAD_FILES,
+    INGESTION_MAX_CONCURRENCY_PER_USER,
+    INGESTION_LEASE_TIMEOUT,
+    INGESTION_HEARTBEAT_INTERVAL,
+    INGESTION_RETRY_BACKOFF_MAX
+)
+import src.database.mongodb as mongo
+
+mongo.create_db_connection()
+fs = GridFS(get_db(), collection="contextItem")
+# re-uploads of an existing table and the scraped documents of api/dom jobs, kept until their job is done
+upload_fs = GridFS(get_db(), collection="ingestionUpload")
+
+server_url = os.environ.get("URL_API_BE")
+flask_env = os.environ.get("FLASK_ENV")
+
+# small enough that embedding of a streamed pdf starts while later pages are still parsed
+EMBED_BATCH_SIZE = 100
+SUMMARY_DOCUMENT_LIMIT = 1000
+# Celery's Redis transport runs lower values first, small api/dom jobs don't queue behind large files
+INGESTION_PRIORITIES = {"api": 0, "dom": 0, "file": 5, "website": 5}
+
+# KEYS[1] tenant slots (sorted set of job ids scored by lease start)
+# ARGV: now, lease timeout, limit, job id
+ACQUIRE_SLOT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[1]) - tonumber(ARGV[2]))
+if redis.call('ZSCORE', KEYS[1], ARGV[4]) or redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+_redis_client = None
+
+
+def get_redis_client():
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(REDIS_URL)
+    return _redis_client
+
+
+def get_ingestion_slots_key(user_id):
+    return f"ingestion:slots:{user_id}"
+
+
+def acquire_ingestion_slot(job):
+    # slots of a crashed worker are released once their lease times out
+    acquired = get_redis_client().eval(
+        ACQUIRE_SLOT_SCRIPT, 1, get_ingestion_slots_key(job.userId),
+        time.time(), INGESTION_LEASE_TIMEOUT, INGESTION_MAX_CONCURRENCY_PER_USER, str(job.id))
+    return bool(acquired)
+
+
+def release_ingestion_slot(job):
+    get_redis_client().zrem(get_ingestion_slots_key(job.userId), str(job.id))
+
+
+def acquire_job_lease(job, owner):
+    """Lease the job to owner (one delivery of its task), False while another worker holds it."""
+    now = datetime.datetime.now(pytz.UTC)
+    return bool(IngestionJob.objects(
+        Q(id=job.id) & (Q(leaseOwner=None) | Q(leaseOwner=owner) | Q(leaseExpiresAt__lte=now))
+    ).update_one(set__leaseOwner=owner,
+                 set__leaseExpiresAt=now + datetime.timedelta(seconds=INGESTION_LEASE_TIMEOUT)))
+
+
+def renew_job_lease(job, owner):
+    now = datetime.datetime.now(pytz.UTC)
+    renewed = IngestionJob.objects(id=job.id, leaseOwner=owner).update_one(
+        set__leaseExpiresAt=now + datetime.timedelta(seconds=INGESTION_LEASE_TIMEOUT))
+    # the user slot of a running job doesn't time out either
+    slots_key = get_ingestion_slots_key(job.userId)
+    get_redis_client().zadd(slots_key, {str(job.id): time.time()}, xx=True)
+    get_redis_client().expire(slots_key, INGESTION_LEASE_TIMEOUT)
+    return bool(renewed)
+
+
+def release_job_lease(job, owner):
+    IngestionJob.objects(id=job.id, leaseOwner=owner).update_one(
+        set__leaseOwner=None, set__leaseExpiresAt=None)
+
+
+class IngestionHeartbeat:
+    """Renews the job's lease every INGESTION_HEARTBEAT_INTERVAL seconds while the block runs."""
+
+    def __init__(self, job, owner):
+        self.job = job
+        self.owner = owner
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(INGESTION_HEARTBEAT_INTERVAL):
+            try:
+                if not renew_job_lease(self.job, self.owner):
+                    print("Ingestion job lease lost", str(self.job.id))
+            except Exception as e:
+                print("Ingestion job lease renewal failed", str(e))
+
+
+def get_ingestion_retry_delay(attempts):
+    # exponential backoff with jitter: 10s, 20s, 40s, ... capped
+    return min(INGESTION_RETRY_BACKOFF_MAX, 10 * 2 ** max(attempts - 1, 0)) + random.uniform(0, 5)
+
+
+def stage_documents(documents):
+    """Store documents ({"text", "metadata"} dicts) in GridFS as JSON lines, returns the file id."""
+    with upload_fs.new_file(contentType="application/x-ndjson") as grid_file:
+        for document in documents:
+            grid_file.write((json.dumps(document) + "\n").encode("utf-8"))
+    return str(grid_file._id)
+
+
+def load_staged_documents(payload):
+    if payload.get("documentsId"):
+        grid_file = upload_fs.get(ObjectId(payload["documentsId"]))
+        documents = (json.loads(line) for line in iter(grid_file.readline, b"") if line.strip())
+    else:
+        # jobs enqueued with the documents inline
+        documents = payload["documents"]
+    return [Document(text=document["text"], metadata=document["metadata"]) for document in documents]
+
+
+def delete_staged_files(payload):
+    for key in ("uploadId", "documentsId"):
+        if payload.get(key):
+            upload_fs.delete(ObjectId(payload[key]))
+
+
+def enqueue_ingestion(kind, context_item_id, plug_id, user_id, payload=None):
+    payload = dict(payload or {})
+    if "documents" in payload:
+        # a crawl can outgrow a 16 MB job document, the job only keeps a reference
+        payload["documentsId"] = stage_documents(payload.pop("documents"))
+    job = IngestionJob(contextItemId=ObjectId(context_item_id), plugId=ObjectId(plug_id),
+                       userId=ObjectId(user_id), kind=kind, payload=payload).save()
+
+    # task.py imports the models and this service
+    from task import ingest_context_item
+    ingest_context_item.apply_async(
+        args=[str(job.id)], priority=INGESTION_PRIORITIES[kind])
+    return job
+
+
+def update_job_progress(job, context_item, progress, room, is_file, message=''):
+    job.progress = progress
+    job.updatedAt = datetime.datetime.now(pytz.UTC)
+    job.save()
+    progressUpdate(context_item=context_item, progress=progress,
+                   is_file=is_file, message=message, room=room)
+
+
+def handle_ingestion_failed(job, error):
+    job.status = "failed"
+    job.error = error
+    job.updatedAt = datetime.datetime.now(pytz.UTC)
+    job.save()
+
+    context_item = ContextItem.objects(id=job.contextItemId).first()
+    if context_item:
+        progressUpdate(context_item=context_item, progress=-1, is_file=job.kind == "file",
+                       message=f'Document upload failed. Error: {error}', room=str(job.userId))
+        ContextItem.objects(id=job.contextItemId).delete()
+    delete_staged_files(job.payload)
+
+
+def load_file_documents(job, context_item, lazy=False):
+    payload = job.payload
+    if payload.get("uploadId"):
+        grid_file = upload_fs.get(ObjectId(payload["uploadId"]))
+    else:
+        grid_file = fs.get(job.contextItemId)
+
+    reader = FileReader()
+    metadata = {
+        "file_name": context_item.source,
+        "context_id": str(context_item.id),
+        "plug_id": str(job.plugId)
+    }
+    if lazy:
+        # streamed from GridFS, documents are yielded while the file is still being parsed
+        uploaded_file = FileStorage(
+            stream=grid_file, filename=context_item.source)
+        return reader.lazy_load_data(input_file=uploaded_file, file_suffix=payload["fileSuffix"],
+                                     metadata=metadata, context_item=context_item, room=str(job.userId))
+
+    uploaded_file = FileStorage(stream=BytesIO(
+        grid_file.read()), filename=context_item.source)
+    return reader.load_data(input_file=uploaded_file, file_suffix=payload["fileSuffix"],
+                            metadata=metadata, context_item=context_item, room=str(job.userId))
+
+
+def replace_file_content(context_item, grid_file):
+    """Write a staged re-upload over the context item's stored file, keeping its id."""
+    chunk_size = context_item.chunkSize or grid_file.chunk_size
+    chunks = get_db()["contextItem.chunks"]
+    chunks.delete_many({"files_id": context_item.id})
+    n = 0
+    while True:
+        data = grid_file.read(chunk_size)
+        if not data:
+            break
+        chunks.insert_one({"files_id": context_item.id, "n": n, "data": data})
+        n += 1
+    context_item.chunkSize = chunk_size
+    context_item.length = grid_file.length
+    context_item.uploadDate = datetime.datetime.now(pytz.UTC)
+
+
+def crawl_website(job, context_item, plug, room):
+    time_out = 120
+    max_pages = 20
+
+    if flask_env == "production":
+        web_hook_url = f"{server_url}/web/api/v1/websocket/notify"
+    elif flask_env == "staging":
+        web_hook_url = f"{server_url}/stage/web/api/v1/websocket/notify"
+    else:
+        # web_hook_url = f"{server_url}/web/api/v1/websocket/notify"
+        web_hook_url = "https://webaipilot.neoprototype.ca//web/api/v1/websocket/notify"
+
+    def tranform_dataset_item(item):
+        return Document(
+            text=item.get("text"),
+            extra_info={
+                "url": item.get("url"),
+                "context_id": str(context_item.id),
+            },
+        )
+
+    reader = ApifyActor(APIFY_TOKEN)
+    # a retried job waits for the run it already started instead of crawling again
+    if not job.apifyRunId:
+        job.apifyRunId = reader.start_run(
+            actor_id="apify/website-content-crawler",
+            run_input={
+                "startUrls": [{
+                    "url": job.payload["crawlUrl"]
+                }],
+                "initialConcurrency": 10,
+                "htmlTransformer": "none",
+                "maxCrawlDepth": 3,
+                "maxCrawlPages": max_pages,
+                "maxResults": max_pages,
+            },
+            memory_mbytes=4096,
+            wait_secs=time_out,
+            timeout_secs=time_out,
+            webhooks=[{"event_types": ['ACTOR.RUN.CREATED', 'ACTOR.RUN.SUCCEEDED', 'ACTOR.RUN.FAILED',
+                                       'ACTOR.RUN.TIMED_OUT', 'ACTOR.RUN.ABORTED', 'ACTOR.RUN.RESURRECTED',
+                                       'ACTOR.BUILD.CREATED', 'ACTOR.BUILD.SUCCEEDED', 'ACTOR.BUILD.FAILED',
+                                       'ACTOR.BUILD.TIMED_OUT', 'ACTOR.BUILD.TIMED_OUT'],
+                       "request_url": web_hook_url,
+                       "payload_template": '{"eventType": {{eventType}},"eventData": {{eventData}},"resource": {{resource}}, "room":' + f'"{room}",' + '"contextItem":' + f'{json.dumps(context_item.to_json())}' + "}"}])
+        job.save()
+
+    documents = reader.finish_run(
+        run_id=job.apifyRunId, wait_secs=time_out, dataset_mapping_function=tranform_dataset_item)
+
+    for document in documents:
+        url = document.metadata["url"]
+        if url in context_item.urls:
+            continue
+        new_context_item = ContextItem(
+            source=url, plugId=ObjectId(plug.id), isFile=False, progress=100).save()
+        context_item.children.append(new_context_item.id)
+        context_item.urls.append(url)
+    context_item.save()
+    return documents
+
+
+def get_chunk_hash(document):
+    # content-addressed chunk id: normalised text plus metadata (which holds the context id)
+    text = " ".join(unicodedata.normalize(
+        "NFKC", document.get_content() or "").split())
+    metadata = json.dumps(document.metadata, sort_keys=True, default=str)
+    return hashlib.sha256(f"{text}\n{metadata}".encode("utf-8")).hexdigest()
+
+
+def delete_stale_chunks(chroma_collection, plug_id, context_ids, kept_ids):
+    """Delete the chunks of the uploaded context items that are not part of the upload anymore."""
+    stale_ids = []
+    for context_id in context_ids:
+        stored_ids = chroma_collection.get(
+            where={"context_id": context_id}, include=[])["ids"]
+        stale_ids.extend(
+            chunk_id for chunk_id in stored_ids if chunk_id not in kept_ids)
+    if stale_ids:
+        chroma_collection.delete(ids=stale_ids)
+        BM25Store().delete_documents(plug_id, stale_ids)
+    return len(stale_ids)
+
+
+def embed_documents(job, context_item, plug, documents, room, is_file):
+    """
+    Embed documents (a list or a stream) in batches of EMBED_BATCH_SIZE, a batch is embedded as
+    soon as it is full. Progress is only reported per batch when the document count is known,
+    streaming readers report their own progress.
+
+    Chunks already stored for the plug (same content hash) are not embedded again and chunks of
+    the uploaded context items that disappeared are deleted.
+    """
+    chroma_collection = ChromaClient().get_collection(name=str(plug.id))
+    storage_context = StorageContext.from_defaults(
+        vector_store=ChromaVectorStore(chroma_collection=chroma_collection))
+
+    start_progress = 30 if job.kind == "dom" else 70
+    total_batches = math.ceil(len(documents) / EMBED_BATCH_SIZE) \
+        if isinstance(documents, list) else None
+    summary_documents = []
+    chunk_ids = set()
+    context_ids = set()
+    embedded_count = 0
+
+    for batch_index, batch in enumerate(iter_batches(documents, EMBED_BATCH_SIZE)):
+        new_documents = []
+        for document in batch:
+            document.id_ = get_chunk_hash(document)
+            # identical chunks within the upload are stored once
+            if document.id_ in chunk_ids:
+                continue
+            chunk_ids.add(document.id_)
+            context_ids.add(document.metadata.get("context_id"))
+            new_documents.append(document)
+        if len(summary_documents) < SUMMARY_DOCUMENT_LIMIT:
+            summary_documents.extend(
+                batch[:SUMMARY_DOCUMENT_LIMIT - len(summary_documents)])
+
+        if batch_index < job.embeddedBatches:
+            continue
+
+        stored_ids = set()
+        if new_documents:
+            stored_ids = set(chroma_collection.get(
+                ids=[document.id_ for document in new_documents], include=[])["ids"])
+            new_documents = [
+                document for document in new_documents if document.id_ not in stored_ids]
+
+        if new_documents:
+            token_counter = get_token_counter(plug)
+            VectorStoreIndex(new_documents, storage_context=storage_context,
+                             show_progress=True if flask_env == "development" else False)
+            # keyword index for hybrid retrieval, ids match the Chroma ids
+            BM25Store().add_documents(plug.id, new_documents)
+            token_usage_ledger.record(plug.id, token_counter, source="upload")
+            embedded_count += len(new_documents)
+
+        job.embeddedBatches = batch_index + 1
+        job.documentCount = len(chunk_ids)
+        job.reusedDocuments += len(stored_ids)
+        if total_batches:
+            update_job_progress(job, context_item, start_progress + int(
+                (95 - start_progress) * job.embeddedBatches / total_batches), room, is_file)
+        else:
+            job.updatedAt = datetime.datetime.now(pytz.UTC)
+            job.save()
+
+    deleted_count = delete_stale_chunks(
+        chroma_collection, plug.id, context_ids - {None}, chunk_ids)
+
+    # nothing changed, keep the summary instead of paying for a new one
+    if not embedded_count and not deleted_count and context_item.summary:
+        return context_item.summary
+
+    summary_index = SummaryIndex.from_documents(summary_documents)
+    query_engine = summary_index.as_query_engine(
+        response_mode="tree_summarize")
+    return query_engine.query(
+        "Summarize these documents in under 300 words, must have 1 title and 1 subtitle, respond in markdown format")
+
+
+def load_table_chunks(job):
+    payload = job.payload
+    if payload.get("uploadId"):
+        grid_file = upload_fs.get(ObjectId(payload["uploadId"]))
+    else:
+        grid_file = fs.get(job.contextItemId)
+
+    # parsed straight from GridFS, chunk by chunk
+    reader = DEFAULT_FILE_READER_CLS[payload["fileSuffix"]]()
+    return reader.iter_chunks(grid_file, size=grid_file.length)
+
+
+def import_table(job, context_item, plug, room):
+    sqlite_pool = SQLiteConnection.get_pool(plug.id)
+    token_counter = get_token_counter(plug)
+    formatted_file_name = job.payload["formattedFileName"]
+    table_name = f'{plug.id}/{formatted_file_name}'
+
+    def on_progress(rows, fraction):
+        update_job_progress(job, context_item, 30 + int(35 * fraction), room, True,
+                            message=f'{rows} rows imported')
+
+    table = import_table_chunks(
+        sqlite_pool, table_name, load_table_chunks(job), on_progress=on_progress)
+
+    context_string = f'This table gives information regarding: {table["columns"]} from the document: {formatted_file_name}'
+    context_item.contextString = context_string
+    context_item.columnStats = table["columnStats"]
+
+    # embed the table schema once so the chat server doesn't have to on every message
+    with sqlite_pool.read() as connection:
+        upsert_table_schema(ChromaClient(), connection, plug.id, table_name,
+                            get_table_context(context_string, table["columnStats"]))
+    token_usage_ledger.record(plug.id, token_counter, source="upload")
+
+    update_job_progress(job, context_item, 70, room, True)
+
+    llm = OpenAI(model="gpt-4", temperature=0.3)
+    chat_engine = SimpleChatEngine.from_defaults(llm=llm)
+    return str(chat_engine.chat(
+        f'Summarize this table in under 300 words, only the first 3 rows is given for reference but there are more rows: {table["columns"]}\n{table["head"]}, must have 1 title and 1 subtitle, respond in markdown format'))
+
+
+def handle_ingestion_job(job):
+    """
+    Run one ingestion job, called by the Celery worker. Raises on failure so the task can retry,
+    completed embedding batches are checkpointed on the job and skipped when it resumes.
+    """
+    context_item = ContextItem.objects(id=job.contextItemId).first()
+    plug = Plug.objects(id=job.plugId).first()
+    if not context_item or not plug:
+        job.status = "failed"
+        job.error = "Context item or plug was deleted"
+        job.save()
+        return
+
+    job.status = "running"
+    job.attempts += 1
+    job.updatedAt = datetime.datetime.now(pytz.UTC)
+    job.save()
+    init_token_counting()
+
+    room = str(job.userId)
+    is_file = job.kind == "file"
+
+    if job.kind == "file" and job.payload.get("isTabular"):
+        summary_str = import_table(job, context_item, plug, room)
+    elif job.kind == "file":
+        documents = load_file_documents(job, context_item, lazy=True)
+        summary_str = embed_documents(
+            job, context_item, plug, documents, room, is_file)
+    elif job.kind == "website":
+        documents = crawl_website(job, context_item, plug, room)
+        summary_str = embed_documents(
+            job, context_item, plug, documents, room, is_file)
+    else:
+        documents = load_staged_documents(job.payload)
+        summary_str = embed_documents(
+            job, context_item, plug, documents, room, is_file)
+
+    # only updatedAt, a save of the whole plug could overwrite the token counters the ledger increments
+    Plug.objects(id=plug.id).update_one(max__updatedAt=datetime.datetime.now(pytz.UTC))
+
+    if job.payload.get("uploadId"):
+        replace_file_content(context_item, upload_fs.get(
+            ObjectId(job.payload["uploadId"])))
+    if job.payload.get("contentHash"):
+        context_item.contentHash = job.payload["contentHash"]
+
+    # Update upload status to finished
+    context_item.summary = str(summary_str)
+    context_item.progress = 100
+    context_item.save()
+
+    job.status = "succeeded"
+    job.progress = 100
+    job.error = None
+    job.updatedAt = datetime.datetime.now(pytz.UTC)
+    job.save()
+    delete_staged_files(job.payload)
+
+    if is_file:
+        progressUpdate(context_item=context_item, progress=100, is_file=is_file,
+                       message='File upload finished', room=room)
+        if plug.isAutoCreateMap:
+            # Create map
+            handler_create_map_point(
+                "nomic", plug.userId, plug, context_item.id, UPLOAD_FILES, fs=fs)
+    else:
+        progressUpdate(context_item=context_item, progress=100, is_file=is_file,
+                       message='Website upload finished', room=room)
@@ -5,6 +5,7 @@ from src.models import Subscription, User, Plug, PaymentInvoice
 from src.config.config import STRIPE_API_SECRET_KEY
 from src.helper.converter_datetime import convert_timestamp_to_datetime
 from src.helper.plug_helper import sort_plug_date
+from src.helper.auth_context import invalidate_auth_context
 from src.constants.http_status_codes import HTTP_200_OK
 from bson import ObjectId
 
@@ -81,6 +82,8 @@ def handle_product(product, event):
             old_subs = Subscription.objects(
                 stripeSubscriptionId=product.id).first()
             old_subs.delete()
+            # any cached user may have been on it
+            invalidate_auth_context()
 
         return {"status": "success"}
     except Exception as e:
@@ -129,6 +132,7 @@ def handle_user_payment_succeeded(payment_intent):
             if sorted_plug_date.index(plug) <= user.plugLimit - 1:
                 plug.active = True
             plug.save()
+        invalidate_auth_context(user.id)
 
     except Exception as e:
         raise Exception("Error handle_user_payment_succeeded :", str(e))
@@ -195,6 +199,7 @@ def handle_invoice_payment_failed(invoice):
                     old_sub = Subscription.objects(stripePriceId=old_sub_id).first()
                     user.subscriptionId = old_sub.id
                     user.save()
+                    invalidate_auth_context(user.id)
                     current_subscription = stripe.Subscription.retrieve(invoice.lines.data[0].subscription)
                     print("current_subscription", current_subscription)
                     stripe.Invoice.void_invoice(invoice.id)
@@ -218,6 +223,7 @@ def handle_invoice_payment_failed(invoice):
             user.subExpiredAt = None
             user.plugLimit = None
             user.save()
+            invalidate_auth_context(user.id)
 
         return {"code": 200, "message": "invoice payment fail"}, HTTP_200_OK
     except Exception as e:
@@ -270,6 +276,7 @@ def handle_invoice_payment_succeeded(invoice):
                 plug.features = subs_features
                 plug.model = subs_model
                 plug.save()
+            invalidate_auth_context(user.id)
     except Exception as e:
         raise Exception("Error handle_invoice_payment_succeeded:", str(e))
 
@@ -292,6 +299,7 @@ def handle_customer_subscription_deleted(subs):
             user.stripePortal = None
             user.subExpiredAt = None
             user.save()
+            invalidate_auth_context(user.id)
 
     except Exception as e:
         raise Exception("Error handle_customer_subscription_deleted:", str(e))
@@ -310,6 +318,7 @@ def handle_customer_subscription_update(subs):
             for plug in list_plug:
                 plug.features = free_sub_features
                 plug.save()
+            invalidate_auth_context(user.id)
         # Renew
         # if subs.cancellation_details.reason == 'null' and subs.cancel_at_period_end == False:
         #     price_id = subs['item']['data'][0]['price']['id']
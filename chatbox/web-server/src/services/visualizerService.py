@@ -1,7 +1,5 @@
 from sklearn.manifold import TSNE
 import seaborn as sns
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.embeddings.openai import OpenAIEmbeddingMode
 import src.database.mongodb as mongo
 import pandas as pd
 import numpy as np
@@ -9,6 +7,7 @@ import matplotlib.pyplot as plt
 import io
 from gridfs import GridFS
 from mongoengine.connection import get_db
+from src.helper import get_service_context
 
 max_tokens = 8000  # the maximum for text-embedding-ada-002 is 8191
 mongo.create_db_connection()
@@ -30,13 +29,10 @@ def visualize_embeddings(df, context_item=None, image_name=None, context_base_id
         # Add the formatted data to the processed lines list
         processed_lines.append(formatted_data)
 
-    # Join the processed lines into a single string
-    result_string = '\n'.join(processed_lines)
-
-    # Print or do further processing with the result string
-    model = OpenAIEmbedding(mode=OpenAIEmbeddingMode.SIMILARITY_MODE)
-    embeddings = model.get_text_embedding_batch(
-        result_string, show_progress=True)
+    # one point per column, embedded through the shared (cached) embedding model
+    embed_model = get_service_context().embed_model
+    embeddings = embed_model.get_text_embedding_batch(
+        processed_lines, show_progress=True)
     arr = np.array(embeddings)
 
     # Create a t-SNE model and transform the data
@@ -1,17 +1,61 @@
 from celery import Celery
 from celery.schedules import schedule
+from celery.signals import task_prerun
+import uuid
 from datetime import datetime
-from src.models import User, Plug, Guest
+from src.models import User, Plug, Guest, IngestionJob
+from src.services.ingestionService import (
+    handle_ingestion_job,
+    handle_ingestion_failed,
+    acquire_ingestion_slot,
+    release_ingestion_slot,
+    acquire_job_lease,
+    release_job_lease,
+    IngestionHeartbeat,
+    get_ingestion_retry_delay
+)
+from src.helper import clear_token_counter
+from src.helper.token_usage import token_usage_ledger
+from src.helper.analytics import rebuild_analytics
+from src.config.config import (
+    REDIS_URL,
+    INGESTION_WORKER_CONCURRENCY,
+    INGESTION_MAX_RETRIES,
+    INGESTION_LEASE_TIMEOUT,
+    INGESTION_VISIBILITY_TIMEOUT,
+    INGESTION_REQUEUE_DELAY
+)
 import src.database.mongodb as mongo
 import pytz
 from datetime import timedelta
 from celery.schedules import crontab
 from mongoengine import Q
 
-broker_url = "redis://localhost:6379/0"
+broker_url = REDIS_URL
 
 celery = Celery('task', broker=broker_url)
 
+
+@task_prerun.connect
+def reset_token_counter(**kwargs):
+    clear_token_counter()
+
+
+# ingestion runs on its own queue: celery -A task worker -Q ingestion
+celery.conf.task_routes = {
+    'task.ingest_context_item': {'queue': 'ingestion'},
+}
+celery.conf.worker_concurrency = INGESTION_WORKER_CONCURRENCY
+# ack after the job finished, a job lost with its worker is redelivered (after the visibility timeout)
+celery.conf.task_acks_late = True
+celery.conf.task_reject_on_worker_lost = True
+celery.conf.worker_prefetch_multiplier = 1
+celery.conf.broker_transport_options = {
+    'visibility_timeout': INGESTION_VISIBILITY_TIMEOUT,
+    'priority_steps': list(range(10)),
+    'queue_order_strategy': 'priority',
+}
+
 celery.conf.beat_schedule = {
     'delete_expired_users': {
         'task': 'task.delete_expired_users',
@@ -20,6 +64,12 @@ celery.conf.beat_schedule = {
     'delete_guests': {
         'task': 'task.delete_guests',
         'schedule': crontab(0, 0, day_of_month='1')
+    },
+    # folds deletes and increments lost with a worker into the last days' rollups
+    'rebuild_recent_analytics': {
+        'task': 'task.backfill_analytics',
+        'schedule': crontab(30, 0),
+        'args': (2,)
     }
 }
 
@@ -38,3 +88,47 @@ def delete_guests():
         createdAt__lte=two_months_ago, client__exists=True)]
     if client_ids:
         Guest.objects(Q(client__in=client_ids)).delete()
+
+
+@celery.task
+def backfill_analytics(days=None):
+    """Rebuild the daily analytics of the last days, all of them when None: celery -A task call task.backfill_analytics"""
+    mongo.create_db_connection()
+    since = datetime.now(pytz.UTC) - timedelta(days=days) if days else None
+    rows = rebuild_analytics(since)
+    print(f"Rebuilt {rows} daily analytics rows")
+
+
+@celery.task(bind=True, max_retries=None)
+def ingest_context_item(self, job_id):
+    mongo.create_db_connection()
+    job = IngestionJob.objects(id=job_id).first()
+    if not job or job.status in ["succeeded", "failed"]:
+        return
+
+    # every delivery is its own owner, a redelivered task has the same id
+    lease_owner = uuid.uuid4().hex
+    if not acquire_job_lease(job, lease_owner):
+        # still running on another worker, looked at again once its lease could have timed out
+        raise self.retry(countdown=INGESTION_LEASE_TIMEOUT)
+
+    if not acquire_ingestion_slot(job):
+        # the user already runs INGESTION_MAX_CONCURRENCY_PER_USER jobs
+        release_job_lease(job, lease_owner)
+        raise self.retry(countdown=INGESTION_REQUEUE_DELAY)
+
+    try:
+        with IngestionHeartbeat(job, lease_owner):
+            handle_ingestion_job(job)
+    except Exception as e:
+        if job.attempts > INGESTION_MAX_RETRIES:
+            handle_ingestion_failed(job, str(e))
+            return
+        job.status = "queued"
+        job.error = str(e)
+        job.save()
+        raise self.retry(countdown=get_ingestion_retry_delay(job.attempts))
+    finally:
+        release_ingestion_slot(job)
+        release_job_lease(job, lease_owner)
+        token_usage_ledger.flush_quietly()
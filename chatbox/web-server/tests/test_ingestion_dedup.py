@@ -0,0 +1,170 @@
+from types import SimpleNamespace
+
+import pytest
+
+# imports the models, Chroma, GridFS, the readers... like the worker does
+ingestion = pytest.importorskip("src.services.ingestionService", exc_type=ImportError)
+Document = ingestion.Document
+
+
+class FakeCollection:
+    def __init__(self):
+        self.metadatas = {}
+
+    def add(self, documents):
+        for document in documents:
+            self.metadatas[document.id_] = document.metadata
+
+    def get(self, ids=None, where=None, include=None):
+        if ids is not None:
+            return {"ids": [doc_id for doc_id in ids if doc_id in self.metadatas]}
+        return {"ids": [doc_id for doc_id, metadata in self.metadatas.items()
+                        if metadata.get("context_id") == where["context_id"]]}
+
+    def delete(self, ids):
+        for doc_id in ids:
+            del self.metadatas[doc_id]
+
+
+class FakeBM25Store:
+    def __init__(self):
+        self.doc_ids = set()
+
+    def add_documents(self, plug_id, documents):
+        self.doc_ids.update(document.id_ for document in documents)
+
+    def delete_documents(self, plug_id, doc_ids):
+        self.doc_ids.difference_update(doc_ids)
+
+
+class FakeSummaryIndex:
+    @classmethod
+    def from_documents(cls, documents):
+        return SimpleNamespace(as_query_engine=lambda **kwargs: SimpleNamespace(
+            query=lambda question: f"summary of {len(documents)}"))
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    chroma_collection = FakeCollection()
+    monkeypatch.setattr(ingestion, "ChromaClient", lambda: SimpleNamespace(
+        get_collection=lambda name: chroma_collection))
+    monkeypatch.setattr(ingestion, "StorageContext", SimpleNamespace(
+        from_defaults=lambda **kwargs: None))
+    monkeypatch.setattr(ingestion, "ChromaVectorStore", lambda **kwargs: None)
+    return chroma_collection
+
+
+@pytest.fixture
+def embedded(monkeypatch, collection):
+    # ids embedded by every VectorStoreIndex call
+    embedded_ids = []
+
+    def vector_store_index(documents, storage_context=None, show_progress=False):
+        embedded_ids.append([document.id_ for document in documents])
+        collection.add(documents)
+
+    monkeypatch.setattr(ingestion, "VectorStoreIndex", vector_store_index)
+    monkeypatch.setattr(ingestion, "SummaryIndex", FakeSummaryIndex)
+    monkeypatch.setattr(ingestion, "get_token_counter", lambda plug: None)
+    monkeypatch.setattr(ingestion, "token_usage_ledger", SimpleNamespace(
+        record=lambda *args, **kwargs: None))
+    monkeypatch.setattr(ingestion, "update_job_progress", lambda *args, **kwargs: None)
+    return embedded_ids
+
+
+@pytest.fixture(autouse=True)
+def bm25_store(monkeypatch):
+    store = FakeBM25Store()
+    monkeypatch.setattr(ingestion, "BM25Store", lambda: store)
+    return store
+
+
+def make_job():
+    return SimpleNamespace(kind="file", embeddedBatches=0, documentCount=0, reusedDocuments=0,
+                           updatedAt=None, save=lambda: None)
+
+
+def make_documents(*texts, context_id="context"):
+    return [Document(text=text, metadata={"context_id": context_id}) for text in texts]
+
+
+def ingest(documents, summary=None):
+    context_item = SimpleNamespace(summary=summary)
+    job = make_job()
+    summary = ingestion.embed_documents(
+        job, context_item, SimpleNamespace(id="plug"), documents, "room", True)
+    return job, summary
+
+
+def test_chunk_hash_is_content_addressed():
+    first, = make_documents("Free  returns\nwithin 30 days")
+    same, = make_documents("Free returns within 30 days")
+    other_context, = make_documents("Free returns within 30 days", context_id="other")
+
+    assert ingestion.get_chunk_hash(first) == ingestion.get_chunk_hash(same)
+    assert ingestion.get_chunk_hash(first) != ingestion.get_chunk_hash(other_context)
+    # compatibility forms are normalised
+    assert ingestion.get_chunk_hash(make_documents("ﬁle")[0]) == \
+        ingestion.get_chunk_hash(make_documents("file")[0])
+
+
+def test_identical_chunks_of_an_upload_are_embedded_once(embedded, bm25_store):
+    job, summary = ingest(make_documents("a", "b", "a"))
+
+    assert [len(ids) for ids in embedded] == [2]
+    assert job.documentCount == 2
+    assert bm25_store.doc_ids == set(embedded[0])
+    assert summary == "summary of 3"
+
+
+def test_unchanged_reupload_embeds_nothing_and_keeps_the_summary(embedded, collection):
+    ingest(make_documents("a", "b"))
+
+    job, summary = ingest(make_documents("a", "b"), summary="former summary")
+
+    assert len(embedded) == 1
+    assert job.reusedDocuments == 2
+    assert summary == "former summary"
+    assert len(collection.metadatas) == 2
+
+
+def test_reupload_embeds_new_chunks_and_deletes_stale_ones(embedded, collection, bm25_store):
+    ingest(make_documents("a", "b", "c"))
+    kept_ids = set(embedded[0])
+
+    job, summary = ingest(make_documents("a", "c", "d"), summary="former summary")
+
+    new_id = ingestion.get_chunk_hash(make_documents("d")[0])
+    stale_id = ingestion.get_chunk_hash(make_documents("b")[0])
+    assert embedded[1] == [new_id]
+    assert set(collection.metadatas) == kept_ids - {stale_id} | {new_id}
+    assert bm25_store.doc_ids == set(collection.metadatas)
+    assert job.reusedDocuments == 2
+    assert summary == "summary of 3"
+
+
+def test_stale_chunks_of_other_context_items_are_kept(embedded, collection, bm25_store):
+    ingest(make_documents("a", context_id="other"))
+    ingest(make_documents("b"))
+
+    ingest(make_documents("c"))
+
+    assert {metadata["context_id"] for metadata in collection.metadatas.values()} == {
+        "other", "context"}
+    assert len(collection.metadatas) == 2
+
+
+def test_resumed_job_skips_the_embedded_batches(monkeypatch, embedded, collection):
+    monkeypatch.setattr(ingestion, "EMBED_BATCH_SIZE", 2)
+    documents = make_documents("a", "b", "c")
+    job = make_job()
+    job.embeddedBatches = 1
+
+    ingestion.embed_documents(job, SimpleNamespace(summary=None), SimpleNamespace(id="plug"),
+                              documents, "room", True)
+
+    assert embedded == [[ingestion.get_chunk_hash(make_documents("c")[0])]]
+    assert job.embeddedBatches == 2
+    # chunks of the skipped batch are still part of the upload, they're not stale
+    assert job.documentCount == 3
@@ -0,0 +1,169 @@
+import gc
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from src.database.sqlite import pool as sqlite_pool_module
+from src.database.sqlite.pool import SQLitePool, SQLitePoolTimeout
+
+
+@pytest.fixture
+def pool(tmp_path):
+    sqlite_pool = SQLitePool(str(tmp_path / "plug.sqlite3"), read_pool_size=2, timeout=0.2)
+    yield sqlite_pool
+    sqlite_pool.close()
+
+
+def create_table(connection):
+    connection.execute("CREATE TABLE item (id INTEGER, name TEXT);")
+
+
+def test_file_is_created_by_the_first_write(pool):
+    assert not pool.exists()
+
+    pool.write(create_table)
+    assert pool.exists()
+    with pool.read() as connection:
+        assert connection.execute("PRAGMA journal_mode;").fetchone() == ("wal",)
+
+
+def test_write_commits_and_returns_the_result(pool):
+    pool.write(create_table)
+
+    def insert(connection):
+        connection.execute("INSERT INTO item VALUES (1, 'a');")
+        return "done"
+
+    assert pool.write(insert) == "done"
+    with pool.read() as connection:
+        assert connection.execute("SELECT * FROM item;").fetchall() == [(1, "a")]
+
+
+def test_failed_write_is_rolled_back_and_raised(pool):
+    pool.write(create_table)
+
+    def insert_then_fail(connection):
+        connection.execute("INSERT INTO item VALUES (1, 'a');")
+        raise ValueError("bad row")
+
+    with pytest.raises(ValueError, match="bad row"):
+        pool.write(insert_then_fail)
+    with pool.read() as connection:
+        assert connection.execute("SELECT COUNT(*) FROM item;").fetchone() == (0,)
+
+
+def test_reads_are_read_only(pool):
+    pool.write(create_table)
+
+    with pool.read() as connection:
+        with pytest.raises(sqlite3.OperationalError):
+            connection.execute("INSERT INTO item VALUES (1, 'a');")
+
+
+def test_read_times_out_when_every_connection_is_in_use(pool):
+    pool.write(create_table)
+
+    with pool.read(), pool.read():
+        started = time.monotonic()
+        with pytest.raises(SQLitePoolTimeout):
+            with pool.read():
+                pass
+        assert time.monotonic() - started >= 0.2
+    # returned connections are reused
+    with pool.read(), pool.read():
+        pass
+    assert pool._reader_count == 2
+
+
+def test_writes_of_every_thread_run_one_at_a_time(pool):
+    pool.write(create_table)
+    running = []
+    overlaps = []
+
+    def insert(value):
+        def write(connection):
+            running.append(value)
+            if len(running) > 1:
+                overlaps.append(list(running))
+            time.sleep(0.01)
+            connection.execute("INSERT INTO item VALUES (?, 'x');", (value,))
+            running.remove(value)
+        pool.write(write, timeout=10)
+
+    threads = [threading.Thread(target=insert, args=(value,)) for value in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert overlaps == []
+    with pool.read() as connection:
+        assert connection.execute("SELECT COUNT(*) FROM item;").fetchone() == (10,)
+
+
+def test_queued_write_times_out_without_running(pool):
+    pool.write(create_table)
+    writing = threading.Event()
+    release = threading.Event()
+
+    def long_write(connection):
+        writing.set()
+        release.wait()
+
+    blocking = threading.Thread(target=pool.write, args=(long_write,), kwargs={"timeout": 10})
+    blocking.start()
+    writing.wait()
+    ran = []
+
+    with pytest.raises(SQLitePoolTimeout):
+        pool.write(lambda connection: ran.append(True), timeout=0.1)
+    release.set()
+    blocking.join()
+
+    pool.write(lambda connection: None)
+    assert ran == []
+
+
+def test_reads_are_not_blocked_by_a_running_write(pool):
+    pool.write(create_table)
+    pool.write(lambda connection: connection.execute("INSERT INTO item VALUES (1, 'a');"))
+    writing = threading.Event()
+    release = threading.Event()
+
+    def long_write(connection):
+        connection.execute("INSERT INTO item VALUES (2, 'b');")
+        writing.set()
+        release.wait()
+
+    writer = threading.Thread(target=pool.write, args=(long_write,), kwargs={"timeout": 10})
+    writer.start()
+    writing.wait()
+    with pool.read() as connection:
+        # the former state until the write commits
+        assert connection.execute("SELECT COUNT(*) FROM item;").fetchone() == (1,)
+    release.set()
+    writer.join()
+
+
+def test_closed_pool_still_writes(pool):
+    pool.write(create_table)
+    pool.close()
+
+    pool.write(lambda connection: connection.execute("INSERT INTO item VALUES (1, 'a');"))
+    connection = sqlite3.connect(pool.path)
+    assert connection.execute("SELECT COUNT(*) FROM item;").fetchone() == (1,)
+    connection.close()
+
+
+def test_closed_pools_are_released(tmp_path):
+    sqlite_pool = SQLitePool(str(tmp_path / "plug.sqlite3"))
+    sqlite_pool.write(create_table)
+    sqlite_pool.close()
+    sqlite_pool._writer.join(timeout=1)
+    del sqlite_pool
+    gc.collect()
+
+    assert not any(pool.path.startswith(str(tmp_path))
+                   for pool in sqlite_pool_module._pools)
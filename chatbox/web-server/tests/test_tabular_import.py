@@ -0,0 +1,149 @@
+import datetime
+import io
+
+import openpyxl
+import pandas as pd
+import pytest
+
+from src.database.sqlite.pool import SQLitePool
+from src.helper.reader.csv_reader import CSVReader
+from src.helper.reader.xls_reader import PandasExcelReader
+from src.helper.tabular_import import clean_chunk, import_table_chunks
+
+TABLE_NAME = "plug/products"
+
+CSV = (
+    '﻿Product ID, "Name" ,Price,Zip,Name\n'
+    '1,"Widget ""A"" ",9.5,01234,x\n'
+    "2, Gadget ,10,02345,y\n"
+    ",,,,\n"
+    "3,Gizmo,,12345,x\n"
+    "4,Doohickey,12.25,54321,y\n"
+    "5,Thing,1,00001,x\n"
+)
+
+
+class GridOut(io.BytesIO):
+    # files are read straight from GridFS, which gives their length
+    @property
+    def length(self):
+        return len(self.getvalue())
+
+
+@pytest.fixture
+def pool(tmp_path):
+    sqlite_pool = SQLitePool(str(tmp_path / "plug.sqlite3"))
+    yield sqlite_pool
+    sqlite_pool.close()
+
+
+def select_all(pool):
+    with pool.read() as connection:
+        return connection.execute(
+            f'SELECT * FROM "{TABLE_NAME}" ORDER BY "index";').fetchall()
+
+
+def get_stats(table, name):
+    return next(stats for stats in table["columnStats"] if stats["name"] == name)
+
+
+def make_workbook(*rows):
+    workbook = openpyxl.Workbook()
+    for row in rows:
+        workbook.active.append(row)
+    file = GridOut()
+    workbook.save(file)
+    file.seek(0)
+    return file
+
+
+def test_csv_is_imported_chunk_by_chunk(pool):
+    chunks = list(CSVReader(chunk_size=2).iter_chunks(GridOut(CSV.encode("utf-8"))))
+    assert len(chunks) == 3
+    assert chunks[-1][1] == 1
+
+    progress = []
+    table = import_table_chunks(pool, TABLE_NAME, iter(chunks),
+                                on_progress=lambda rows, fraction: progress.append(rows))
+
+    assert table["columns"] == ["Product ID", "Name", "Price", "Zip", "Name.1"]
+    assert table["columnTypes"] == {"Product ID": "INTEGER", "Name": "TEXT", "Price": "REAL",
+                                    "Zip": "TEXT", "Name.1": "TEXT"}
+    assert table["rows"] == 5
+    assert progress == [2, 3, 5]
+    # the empty row is dropped, quotes and spaces of the cells are removed
+    assert select_all(pool) == [
+        (0, 1, "Widget A", 9.5, "01234", "x"),
+        (1, 2, "Gadget", 10.0, "02345", "y"),
+        (2, 3, "Gizmo", None, "12345", "x"),
+        (3, 4, "Doohickey", 12.25, "54321", "y"),
+        (4, 5, "Thing", 1.0, "00001", "x"),
+    ]
+
+
+def test_columns_are_profiled_and_indexed(pool):
+    table = import_table_chunks(
+        pool, TABLE_NAME, CSVReader().iter_chunks(GridOut(CSV.encode("utf-8"))))
+
+    product_id = get_stats(table, "Product ID")
+    assert product_id["idLike"] and product_id["unique"] and product_id["indexed"]
+    assert (product_id["min"], product_id["max"]) == (1, 5)
+    assert get_stats(table, "Price")["nulls"] == 1
+    assert not get_stats(table, "Price")["indexed"]
+    assert get_stats(table, "Name.1")["values"] == ["x", "y"]
+    with pool.read() as connection:
+        indexes = {name for (name,) in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index';")}
+    assert {f"ix_{TABLE_NAME}_index", f"ix_{TABLE_NAME}_Product ID"} <= indexes
+
+
+def test_reimport_replaces_the_table(pool):
+    import_table_chunks(pool, TABLE_NAME, CSVReader().iter_chunks(GridOut(CSV.encode("utf-8"))))
+    table = import_table_chunks(pool, TABLE_NAME, CSVReader().iter_chunks(
+        GridOut(b"Product ID,Name\n7,Other\n")))
+
+    assert table["rows"] == 1
+    assert select_all(pool) == [(0, 7, "Other")]
+
+
+def test_file_without_header_is_rejected(pool):
+    with pytest.raises(ValueError):
+        import_table_chunks(pool, TABLE_NAME, iter([]))
+    assert not pool.exists()
+
+
+def test_xlsx_with_mixed_object_columns(pool):
+    file = make_workbook(
+        ["id", " In stock ", "Opens", "Name", "Updated", "Note"],
+        [1, True, datetime.time(9, 0), ' "Alice" ', datetime.datetime(2023, 1, 2, 3, 4, 5),
+         datetime.datetime(2023, 5, 1)],
+        [2, None, datetime.time(9, 30), "Bob", datetime.datetime(2023, 1, 3), "n/a"],
+        [None, None, None, None, None, None],
+        [3, False, None, "O'Neil", None, 4],
+    )
+    table = import_table_chunks(
+        pool, TABLE_NAME, PandasExcelReader(chunk_size=2).iter_chunks(file, size=file.length))
+
+    assert table["columnTypes"] == {"id": "INTEGER", "In stock": "INTEGER", "Opens": "TEXT",
+                                    "Name": "TEXT", "Updated": "TIMESTAMP", "Note": "TEXT"}
+    assert select_all(pool) == [
+        (0, 1, 1, "09:00:00", "Alice", "2023-01-02 03:04:05", "2023-05-01 00:00:00"),
+        (1, 2, None, "09:30:00", "Bob", "2023-01-03 00:00:00", "n/a"),
+        (2, 3, 0, None, "ONeil", None, "4"),
+    ]
+
+
+def test_clean_chunk_only_changes_string_cells():
+    chunk = pd.DataFrame({
+        "index": [0, 1, 2],
+        "flag": [True, None, False],
+        "opens": [datetime.time(9, 0), None, "' 10:00 '"],
+        "count": [1, 2, 3],
+    })
+
+    cleaned = clean_chunk(chunk)
+
+    assert cleaned.columns.tolist() == ["flag", "opens", "count"]
+    assert cleaned["flag"].tolist() == [True, None, False]
+    assert cleaned["opens"].tolist() == [datetime.time(9, 0), None, "10:00"]
+    assert cleaned["count"].tolist() == [1, 2, 3]
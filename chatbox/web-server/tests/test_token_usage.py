@@ -0,0 +1,158 @@
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from src.helper import token_usage
+from src.helper.token_usage import DUPLICATE_KEY_ERROR, TokenUsageLedger
+from src.models import Plug, TokenUsage
+
+PLUG_ID = ObjectId()
+OTHER_PLUG_ID = ObjectId()
+CLIENT_ID = ObjectId()
+
+
+class FakeCollection:
+    def __init__(self):
+        self.calls = []
+        self.errors = []
+
+    def _call(self, *args):
+        self.calls.append(args)
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def insert_many(self, documents, ordered=True):
+        self._call(documents)
+
+    def bulk_write(self, operations, ordered=True):
+        self._call(operations)
+
+
+@pytest.fixture
+def usages(monkeypatch):
+    collection = FakeCollection()
+    monkeypatch.setattr(TokenUsage, "_get_collection", classmethod(lambda cls: collection))
+    return collection
+
+
+@pytest.fixture
+def plugs(monkeypatch):
+    collection = FakeCollection()
+    monkeypatch.setattr(Plug, "_get_collection", classmethod(lambda cls: collection))
+    return collection
+
+
+@pytest.fixture
+def ledger(monkeypatch, usages, plugs):
+    monkeypatch.setattr(token_usage, "analytics_rollup",
+                        SimpleNamespace(record=lambda *args, **counters: None))
+    return TokenUsageLedger(flush_interval=3600, batch_size=100)
+
+
+def tokens(llm, embedding=0):
+    return SimpleNamespace(total_llm_token_count=llm, total_embedding_token_count=embedding)
+
+
+def get_increments(operations):
+    return {(operation._filter["_id"], operation._filter.get("client._id")):
+            operation._doc["$inc"] for operation in operations}
+
+
+def bulk_write_error(*indexes):
+    return BulkWriteError({"writeErrors": [{"index": index, "code": 2} for index in indexes]})
+
+
+def test_flush_inserts_the_rows_and_sums_the_increments(ledger, usages, plugs):
+    assert ledger.record(PLUG_ID, tokens(10, 5), client_id=CLIENT_ID) == 15
+    ledger.record(PLUG_ID, tokens(20))
+    ledger.record(OTHER_PLUG_ID, tokens(1))
+    ledger.flush()
+
+    (documents,), = usages.calls
+    assert [document["totalTokens"] for document in documents] == [15, 20, 1]
+    (operations,), = plugs.calls
+    assert get_increments(operations) == {
+        (PLUG_ID, None): {"token": 35},
+        (OTHER_PLUG_ID, None): {"token": 1},
+        (PLUG_ID, CLIENT_ID): {"client.token": 15},
+    }
+    assert "$max" in operations[0]._doc
+
+    ledger.flush()
+    assert len(usages.calls) == len(plugs.calls) == 1
+
+
+def test_batch_size_flushes_on_record(ledger, usages):
+    ledger.batch_size = 2
+    ledger.record(PLUG_ID, tokens(1))
+    assert usages.calls == []
+
+    ledger.record(PLUG_ID, tokens(1))
+    assert len(usages.calls) == 1
+
+
+def test_only_failed_increments_are_retried(ledger, usages, plugs):
+    ledger.record(PLUG_ID, tokens(10), client_id=CLIENT_ID)
+    ledger.record(OTHER_PLUG_ID, tokens(1))
+    # the client increment (index 2) failed, the plug ones were applied
+    plugs.errors.append(bulk_write_error(2))
+    with pytest.raises(BulkWriteError):
+        ledger.flush()
+
+    ledger.record(OTHER_PLUG_ID, tokens(3))
+    ledger.flush()
+
+    assert len(usages.calls) == 2
+    assert get_increments(plugs.calls[-1][0]) == {
+        (OTHER_PLUG_ID, None): {"token": 3},
+        (PLUG_ID, CLIENT_ID): {"client.token": 10},
+    }
+
+
+def test_increments_are_dropped_when_their_outcome_is_unknown(ledger, usages, plugs):
+    ledger.record(PLUG_ID, tokens(10))
+    plugs.errors.append(TimeoutError("no reply"))
+    with pytest.raises(TimeoutError):
+        ledger.flush()
+
+    ledger.flush()
+    assert len(plugs.calls) == 1
+    # the rows are stored, they keep the usage
+    assert len(usages.calls) == 1
+
+
+def test_rows_and_increments_are_retried_when_the_insert_fails(ledger, usages, plugs):
+    ledger.record(PLUG_ID, tokens(10))
+    usages.errors.append(ConnectionError("down"))
+    with pytest.raises(ConnectionError):
+        ledger.flush()
+    assert plugs.calls == []
+
+    ledger.record(PLUG_ID, tokens(5))
+    ledger.flush()
+
+    failed_rows, retried_rows = usages.calls[0][0], usages.calls[1][0]
+    assert [row["_id"] for row in retried_rows[:1]] == [failed_rows[0]["_id"]]
+    assert len(retried_rows) == 2
+    assert get_increments(plugs.calls[0][0]) == {(PLUG_ID, None): {"token": 15}}
+
+
+def test_rows_already_stored_are_not_an_error(ledger, usages, plugs):
+    ledger.record(PLUG_ID, tokens(10))
+    usages.errors.append(BulkWriteError(
+        {"writeErrors": [{"index": 0, "code": DUPLICATE_KEY_ERROR}]}))
+    ledger.flush()
+
+    assert get_increments(plugs.calls[0][0]) == {(PLUG_ID, None): {"token": 10}}
+
+
+def test_flush_quietly_keeps_the_failed_increments(ledger, plugs):
+    ledger.record(PLUG_ID, tokens(10))
+    plugs.errors.append(bulk_write_error(0))
+    ledger.flush_quietly()
+    ledger.flush_quietly()
+
+    assert [get_increments(operations) for (operations,) in plugs.calls] == [
+        {(PLUG_ID, None): {"token": 10}}] * 2